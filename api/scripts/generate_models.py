@@ -1,10 +1,19 @@
-"""OpenAPI仕様からPydanticモデルを生成するスクリプト."""
+"""OpenAPI仕様からPydanticモデルを生成するスクリプト.
 
+Pydanticモデルに加えて、WebSocketのフレームをデコード・エンコードする
+コーデック(codecs.py)を生成する。エンコードはモデルを作成せずに、辞書を
+Pydanticのコンパイル済みのシリアライザで1回の処理でJSONに変換する。
+"""
+
+import json
 import logging
+import re
 import subprocess
 import sys
 from pathlib import Path
 
+import yaml
+
 # ロギングの設定
 logging.basicConfig(
     level=logging.INFO,
@@ -28,6 +37,122 @@ OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
 # __init__.py ファイルを生成
 (OUTPUT_DIR / "__init__.py").touch()
 
+# OpenAPIの型とPythonの型の対応
+PRIMITIVE_TYPES = {
+    "string": "str",
+    "boolean": "bool",
+    "integer": "int",
+    "number": "float",
+}
+
+CODECS_HEADER = '''# generated by scripts/generate_models.py
+#   filename:  {filename}
+
+"""WebSocketのフレームをデコード・エンコードするコーデック.
+
+デコードはJSONを中間の辞書に変換せずに、Pydanticのモデルで解析と検証を
+1回で行う。
+エンコードはモデルを作成せずに、辞書をコンパイル済みのシリアライザで
+JSONのバイト列に変換する。
+"""
+
+from typing import Literal, NotRequired
+
+from pydantic import TypeAdapter
+from typing_extensions import TypedDict
+
+from nexus_magi.api_gen import models
+'''
+
+
+def to_snake_case(name: str) -> str:
+    """スキーマ名を関数名に使用するスネークケースに変換する.
+
+    Args:
+        name: スキーマ名(パスカルケース)
+
+    Returns:
+        str: スネークケースの名前
+
+    """
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+
+
+def to_python_type(schema: dict) -> str:
+    """OpenAPIのスキーマをTypedDictのフィールドの型に変換する.
+
+    Args:
+        schema: プロパティのスキーマ
+
+    Returns:
+        str: Pythonの型の表記
+
+    """
+    if "$ref" in schema:
+        return f"{schema['$ref'].rsplit('/', 1)[-1]}Dict"
+    if "enum" in schema:
+        return f"Literal[{', '.join(json.dumps(value) for value in schema['enum'])}]"
+    if schema.get("type") == "array":
+        return f"list[{to_python_type(schema['items'])}]"
+    return PRIMITIVE_TYPES.get(schema.get("type", ""), "object")
+
+
+def generate_codecs(spec: dict, filename: str) -> str:
+    """OpenAPI仕様のオブジェクトのスキーマごとにコーデックを生成する.
+
+    Args:
+        spec: OpenAPI仕様
+        filename: OpenAPI仕様のファイル名
+
+    Returns:
+        str: codecs.pyのソースコード
+
+    """
+    schemas = {
+        name: schema
+        for name, schema in spec.get("components", {}).get("schemas", {}).items()
+        if schema.get("type") == "object"
+    }
+    lines = [CODECS_HEADER.format(filename=filename).rstrip("\n")]
+    for name, schema in schemas.items():
+        required = set(schema.get("required", []))
+        lines.extend(["", "", f"class {name}Dict(TypedDict):"])
+        lines.append(f'    """{name}をモデルを作成せずにエンコードするための辞書."""')
+        lines.append("")
+        for field, prop in schema.get("properties", {}).items():
+            field_type = to_python_type(prop)
+            if field not in required:
+                field_type = f"NotRequired[{field_type}]"
+            lines.append(f"    {field}: {field_type}")
+
+    for name in schemas:
+        snake = to_snake_case(name)
+        lines.extend(
+            [
+                "",
+                "",
+                f"_{snake}_adapter = TypeAdapter({name}Dict)",
+                f"_{snake}_list_adapter = TypeAdapter(list[{name}Dict])",
+                "",
+                "",
+                f"def decode_{snake}(data: str | bytes) -> models.{name}:",
+                f'    """JSONから{name}をデコードする."""',
+                f"    return models.{name}.model_validate_json(data)",
+                "",
+                "",
+                f"def encode_{snake}(value: {name}Dict) -> bytes:",
+                f'    """{name}の辞書をJSONにエンコードする."""',
+                f"    return _{snake}_adapter.dump_json(value)",
+                "",
+                "",
+                f"def encode_{snake}_list(values: list[{name}Dict]) -> bytes:",
+                f'    """{name}の辞書のリストをJSONの配列にエンコードする."""',
+                f"    return _{snake}_list_adapter.dump_json(values)",
+            ]
+        )
+    return "\n".join(lines) + "\n"
+
+
 # datamodel-code-generatorを使用してモデルを生成
 cmd = [
     "datamodel-codegen",
@@ -57,3 +182,11 @@ try:
 except subprocess.CalledProcessError:
     logger.exception("Error generating models")
     sys.exit(1)
+
+# 同じOpenAPI仕様からフレームのコーデックを生成
+logger.info("Generating codecs: %s", OUTPUT_DIR / "codecs.py")
+spec = yaml.safe_load(OPENAPI_SPEC.read_text(encoding="utf-8"))
+(OUTPUT_DIR / "codecs.py").write_text(
+    generate_codecs(spec, OPENAPI_SPEC.name), encoding="utf-8"
+)
+logger.info("Codec generation completed successfully.")
@@ -0,0 +1,13 @@
+#!/usr/bin/env bash
+#MISE description="Run benchmarks."
+#
+# 性能計測を行い、予算を超えた場合は失敗とするスクリプト。
+
+set -eu
+set -o pipefail
+
+echo "Benchmark startup time..."
+.venv/bin/python -m benchmarks.startup
+
+echo "Benchmark hot paths..."
+.venv/bin/python -m benchmarks.hot_paths
@@ -0,0 +1 @@
+"""バックエンドの性能計測スクリプト."""
@@ -0,0 +1,314 @@
+"""サーバー内の処理の実行時間を計測し、基準値から悪化していないかを確認するスクリプト.
+
+会話履歴の長さや応答の大きさに比例して時間がかかる以下の処理を、
+1から10000メッセージの会話履歴と、1KBから1MBの内容で計測する。
+
+- format_messages: 受信したメッセージを会話履歴に変換する処理
+- add_system_instructions: ペルソナのシステムプロンプトを差し替える処理
+- request_body: LLM APIに送信するリクエスト本文を作成する処理
+- create_prompt_messages: 討論・合議で質問に続けてプロンプトを送るメッセージの作成
+- create_debate_prompt / create_consensus_prompt: 討論・合議のプロンプトの作成
+- decode_chat_request: 受信したJSONをChatRequestに変換する処理
+- encode_frame: 応答をJSONに変換する処理
+
+各処理の1回あたりの時間の中央値を基準値(hot_paths_baseline.json)と比較し、
+閾値を超えて遅くなった処理があれば失敗とする。計測値は環境によって大きく
+異なるため基準値はリポジトリに含めず、比較する環境で変更前のコードを
+--update-baselineで計測して作成する。基準値が無い場合は計測結果を基準値として
+保存する。ネットワークには接続しない。
+
+使い方:
+    python -m benchmarks.hot_paths [--threshold 0.5] [--filter decode]
+    python -m benchmarks.hot_paths --update-baseline
+"""
+
+import argparse
+import json
+import logging
+import statistics
+import sys
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+# ロギングの設定
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+BENCHMARK_DIR = Path(__file__).parent.absolute()
+DEFAULT_BASELINE = BENCHMARK_DIR / "hot_paths_baseline.json"
+
+# 計測する会話履歴のメッセージ数
+HISTORY_SIZES = (1, 10, 100, 1000, 10000)
+# 会話履歴の各メッセージの大きさ
+HISTORY_MESSAGE_BYTES = 1024
+
+# 計測する内容の大きさ
+PAYLOAD_SIZES = {"1KB": 1024, "16KB": 16 * 1024, "256KB": 256 * 1024, "1MB": 1024**2}
+
+# 1回の計測にかける最短の秒数と、計測を繰り返す回数
+MIN_MEASURE_SECONDS = 0.05
+REPEAT = 9
+
+# 基準値との差がこれ未満の場合は、閾値を超えても悪化とみなさない
+# (1マイクロ秒未満の処理は計測の揺らぎの影響が大きいため)
+MIN_REGRESSION_US = 1.0
+
+# 日本語の文章を模した内容の単位(UTF-8で64バイト)
+TEXT_UNIT = "MAGIシステムはこの提案を検討しています。"
+
+
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数を解析する.
+
+    Returns:
+        argparse.Namespace: 解析された引数
+
+    """
+    parser = argparse.ArgumentParser(description="サーバー内の処理のベンチマーク")
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=DEFAULT_BASELINE,
+        help=f"基準値を保存したJSONファイル (デフォルト: {DEFAULT_BASELINE})",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.5,
+        help="基準値からの悪化を許容する割合 (デフォルト: 0.5)",
+    )
+    parser.add_argument(
+        "--filter", type=str, help="名前にこの文字列を含む計測のみ実行する"
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="計測結果を基準値として保存する",
+    )
+    return parser.parse_args()
+
+
+def create_text(size: int) -> str:
+    """指定した大きさ(UTF-8のバイト数)の文章を作成する.
+
+    Args:
+        size: バイト数
+
+    Returns:
+        str: 文章
+
+    """
+    unit_bytes = len(TEXT_UNIT.encode())
+    return TEXT_UNIT * max(size // unit_bytes, 1)
+
+
+def create_request_json(messages: list[dict[str, str]]) -> str:
+    """討論モードのリクエストのJSONを作成する.
+
+    Args:
+        messages: 会話履歴
+
+    Returns:
+        str: ChatRequestのJSON文字列
+
+    """
+    return json.dumps(
+        {"messages": messages, "debate": True, "debate_rounds": 1},
+        ensure_ascii=False,
+    )
+
+
+def create_history(count: int, size: int) -> list[dict[str, str]]:
+    """ユーザーとアシスタントが交互に発言する会話履歴を作成する.
+
+    Args:
+        count: メッセージ数
+        size: 各メッセージの大きさ
+
+    Returns:
+        list[dict[str, str]]: 会話履歴(最後はユーザーのメッセージ)
+
+    """
+    content = create_text(size)
+    return [
+        {
+            "role": "user" if (count - index) % 2 == 1 else "assistant",
+            "content": content,
+        }
+        for index in range(count)
+    ]
+
+
+def create_cases() -> dict[str, Callable[[], object]]:
+    """計測する処理を作成する.
+
+    Returns:
+        dict[str, Callable]: 計測名ごとの、処理を1回実行する関数
+
+    """
+    from nexus_magi.api_gen.codecs import (
+        decode_chat_request,
+        encode_web_socket_response,
+    )
+    from nexus_magi.app import create_frame, format_messages
+    from nexus_magi.debate_chat_model import DebateChatModel
+    from nexus_magi.message_history import Message, RequestBody
+
+    # 計測のみでLLM APIには接続しない
+    chat_model = DebateChatModel()
+    persona = chat_model.personas[0]
+    payload = {"model": chat_model.model, "stream": False}
+
+    cases: dict[str, Callable[[], object]] = {}
+
+    inputs = {
+        f"history={count}": create_history(count, HISTORY_MESSAGE_BYTES)
+        for count in HISTORY_SIZES
+    }
+    inputs.update(
+        {
+            f"payload={name}": create_history(1, size)
+            for name, size in PAYLOAD_SIZES.items()
+        }
+    )
+    for label, messages in inputs.items():
+        request_json = create_request_json(messages)
+        request = decode_chat_request(request_json)
+        history = format_messages(request.messages)
+        system_history = chat_model._add_system_instructions(history, persona)  # noqa: SLF001
+
+        cases[f"decode_chat_request/{label}"] = (
+            lambda data=request_json: decode_chat_request(data)
+        )
+        cases[f"format_messages/{label}"] = (
+            lambda chat_messages=request.messages: format_messages(chat_messages)
+        )
+        if label.startswith("history="):
+            cases[f"add_system_instructions/{label}"] = (
+                lambda messages=history: chat_model._add_system_instructions(  # noqa: SLF001
+                    messages, persona
+                )
+            )
+            cases[f"request_body/{label}"] = lambda messages=system_history: len(
+                RequestBody(payload, messages)
+            )
+
+    for name, size in PAYLOAD_SIZES.items():
+        text = create_text(size)
+        opinions = [(member.label, text) for member in chat_model.personas]
+        question = Message(role="user", content=text)
+        cases[f"create_prompt_messages/payload={name}"] = (
+            lambda question=question: chat_model._create_prompt_messages(  # noqa: SLF001
+                persona.system_prompt, question, "prompt"
+            )
+        )
+        cases[f"create_debate_prompt/payload={name}"] = (
+            lambda opinions=opinions: chat_model._create_debate_prompt(opinions)  # noqa: SLF001
+        )
+        cases[f"create_consensus_prompt/payload={name}"] = (
+            lambda opinions=opinions: chat_model._create_consensus_prompt(opinions)  # noqa: SLF001
+        )
+        cases[f"encode_frame/payload={name}"] = (
+            lambda text=text: encode_web_socket_response(
+                create_frame("consensus", text, "final")
+            )
+        )
+
+    return dict(sorted(cases.items()))
+
+
+def measure(function: Callable[[], object]) -> float:
+    """処理1回あたりの実行時間を計測する.
+
+    最短の計測時間を満たすまで実行回数を倍にして計測回数を決め、
+    繰り返し計測した中の中央値を使用する。
+    最小値と異なり、まれに速く終わった計測だけで基準値が決まることがない。
+
+    Args:
+        function: 計測する処理
+
+    Returns:
+        float: 1回あたりの実行時間(マイクロ秒)
+
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_MEASURE_SECONDS:
+            break
+        number *= 2
+
+    samples = [elapsed]
+    for _ in range(REPEAT - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) / number * 1e6
+
+
+def main() -> int:
+    """ベンチマークを実行し、基準値から悪化した処理があれば失敗とする.
+
+    Returns:
+        int: 終了コード(悪化した処理が無ければ0)
+
+    """
+    args = parse_args()
+    start = time.perf_counter()
+
+    cases = create_cases()
+    if args.filter:
+        cases = {name: case for name, case in cases.items() if args.filter in name}
+    baseline: dict[str, float] = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+
+    results: dict[str, float] = {}
+    regressions: list[str] = []
+    for name, case in cases.items():
+        result = measure(case)
+        results[name] = round(result, 3)
+        expected = baseline.get(name)
+        if expected is None:
+            logger.info("%s: %.2f us (基準値なし)", name, result)
+            continue
+        ratio = result / expected if expected > 0 else 1.0
+        if (
+            result > expected * (1 + args.threshold)
+            and result - expected > MIN_REGRESSION_US
+        ):
+            logger.error(
+                "%s: %.2f us (基準値 %.2f us の%.2f倍)", name, result, expected, ratio
+            )
+            regressions.append(name)
+        else:
+            logger.info(
+                "%s: %.2f us (基準値 %.2f us の%.2f倍)", name, result, expected, ratio
+            )
+
+    logger.info("計測時間: %.1f 秒", time.perf_counter() - start)
+    if args.update_baseline or not baseline:
+        args.baseline.write_text(json.dumps({**baseline, **results}, indent=2) + "\n")
+        logger.info("基準値を保存しました: %s", args.baseline)
+        return 0
+    if regressions:
+        logger.error(
+            "%d件の処理が基準値から%.0f%%以上遅くなりました: %s",
+            len(regressions),
+            args.threshold * 100,
+            ", ".join(regressions),
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
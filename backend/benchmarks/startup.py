@@ -0,0 +1,163 @@
+"""起動時間を計測し、予算内に収まっているかを確認するスクリプト.
+
+以下の項目を新しいPythonプロセスで複数回計測し、中央値を予算と比較する。
+
+- import_main_ms: CLIのエントリポイント(`nexus_magi.__main__`)の読み込み時間
+- import_app_ms: APIサーバー(`nexus_magi.app`)の読み込み時間
+- first_websocket_ms: サーバープロセスの起動から最初のWebSocket接続が
+  受け付けられるまでの時間
+
+使い方:
+    python -m benchmarks.startup [--runs 5] [--budget benchmarks/startup_budget.json]
+"""
+
+import argparse
+import json
+import logging
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# ロギングの設定
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+BENCHMARK_DIR = Path(__file__).parent.absolute()
+BACKEND_DIR = BENCHMARK_DIR.parent
+DEFAULT_BUDGET = BENCHMARK_DIR / "startup_budget.json"
+
+# サーバーの起動を待つ最大の秒数
+SERVER_START_TIMEOUT = 30.0
+# WebSocket接続を再試行する間隔の秒数
+CONNECT_RETRY_INTERVAL = 0.005
+
+IMPORT_SNIPPET = """
+import time
+start = time.perf_counter()
+import {module}
+print((time.perf_counter() - start) * 1000)
+"""
+
+
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数を解析する.
+
+    Returns:
+        argparse.Namespace: 解析された引数
+
+    """
+    parser = argparse.ArgumentParser(description="起動時間のベンチマーク")
+    parser.add_argument("--runs", type=int, default=5, help="計測回数 (デフォルト: 5)")
+    parser.add_argument(
+        "--budget",
+        type=Path,
+        default=DEFAULT_BUDGET,
+        help=f"予算を定義したJSONファイル (デフォルト: {DEFAULT_BUDGET})",
+    )
+    return parser.parse_args()
+
+
+def measure_import(module: str) -> float:
+    """新しいプロセスでモジュールの読み込み時間を計測する.
+
+    Args:
+        module: 読み込むモジュール名
+
+    Returns:
+        float: 読み込み時間(ミリ秒)
+
+    """
+    result = subprocess.run(  # noqa: S603 - 固定のコマンドのみ実行する
+        [sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=BACKEND_DIR,
+    )
+    return float(result.stdout.strip())
+
+
+def find_free_port() -> int:
+    """空いているTCPポートを取得する.
+
+    Returns:
+        int: ポート番号
+
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_first_websocket() -> float:
+    """サーバーの起動から最初のWebSocket接続が受け付けられるまでの時間を計測する.
+
+    Returns:
+        float: 接続が受け付けられるまでの時間(ミリ秒)
+
+    """
+    from websockets.sync.client import connect
+
+    port = find_free_port()
+    url = f"ws://127.0.0.1:{port}/api/chat/ws"
+
+    start = time.perf_counter()
+    server = subprocess.Popen(  # noqa: S603 - 固定のコマンドのみ実行する
+        [sys.executable, "-m", "nexus_magi", "--port", str(port)],
+        cwd=BACKEND_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < SERVER_START_TIMEOUT:
+            if server.poll() is not None:
+                msg = f"サーバーが終了しました: {server.returncode}"
+                raise RuntimeError(msg)
+            try:
+                with connect(url, open_timeout=1):
+                    return (time.perf_counter() - start) * 1000
+            except OSError:
+                time.sleep(CONNECT_RETRY_INTERVAL)
+        msg = "サーバーの起動を待機中にタイムアウトしました"
+        raise TimeoutError(msg)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main() -> int:
+    """ベンチマークを実行し、予算を超えた項目があれば失敗とする.
+
+    Returns:
+        int: 終了コード(予算内であれば0)
+
+    """
+    args = parse_args()
+    budget = json.loads(args.budget.read_text())
+
+    measurements = {
+        "import_main_ms": lambda: measure_import("nexus_magi.__main__"),
+        "import_app_ms": lambda: measure_import("nexus_magi.app"),
+        "first_websocket_ms": measure_first_websocket,
+    }
+
+    exit_code = 0
+    for name, measure in measurements.items():
+        median = statistics.median(measure() for _ in range(args.runs))
+        limit = budget.get(name)
+        if limit is not None and median > limit:
+            logger.error("%s: %.1f ms (予算 %.1f ms を超過)", name, median, limit)
+            exit_code = 1
+        else:
+            logger.info("%s: %.1f ms (予算 %s ms)", name, median, limit)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
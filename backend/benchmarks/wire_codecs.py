@@ -0,0 +1,143 @@
+"""WebSocketのフレーム1つあたりのデコード・エンコード時間を計測するスクリプト.
+
+生成されたコーデックを使用する現在の処理と、以前の処理を比較する。
+
+- decode: 受信したJSONをChatRequestに変換する時間
+  (以前: json.loadsで辞書に変換してからChatRequestを作成)
+- encode: 応答をJSONに変換する時間
+  (以前: WebSocketResponseを作成し、値を辞書に詰め直してjson.dumpsで変換)
+
+使い方:
+    python -m benchmarks.wire_codecs [--number 20000] [--history 10]
+"""
+
+import argparse
+import json
+import logging
+import sys
+import timeit
+
+# ロギングの設定
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# 計測に使用する応答の内容
+SAMPLE_RESPONSE = "科学的な観点から検討すると、この提案には利点と課題があります。" * 10
+
+
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数を解析する.
+
+    Returns:
+        argparse.Namespace: 解析された引数
+
+    """
+    parser = argparse.ArgumentParser(description="フレームのコーデックのベンチマーク")
+    parser.add_argument(
+        "--number", type=int, default=20000, help="計測回数 (デフォルト: 20000)"
+    )
+    parser.add_argument(
+        "--history",
+        type=int,
+        default=10,
+        help="リクエストに含める会話履歴のメッセージ数 (デフォルト: 10)",
+    )
+    return parser.parse_args()
+
+
+def create_request_json(history: int) -> str:
+    """計測に使用するリクエストのJSONを作成する.
+
+    Args:
+        history: 会話履歴のメッセージ数
+
+    Returns:
+        str: ChatRequestのJSON文字列
+
+    """
+    messages = [
+        {
+            "role": "user" if index % 2 == 0 else "assistant",
+            "content": SAMPLE_RESPONSE,
+        }
+        for index in range(history)
+    ]
+    return json.dumps(
+        {"messages": messages, "debate": True, "debate_rounds": 2},
+        ensure_ascii=False,
+    )
+
+
+def main() -> int:
+    """ベンチマークを実行し、フレーム1つあたりの時間を出力する.
+
+    Returns:
+        int: 終了コード
+
+    """
+    args = parse_args()
+
+    from nexus_magi.api_gen.codecs import (
+        decode_chat_request,
+        encode_web_socket_response,
+    )
+    from nexus_magi.api_gen.models import ChatRequest, WebSocketResponse
+    from nexus_magi.app import create_frame
+
+    request_json = create_request_json(args.history)
+
+    def decode_before() -> ChatRequest:
+        return ChatRequest(**json.loads(request_json))
+
+    def decode_after() -> ChatRequest:
+        return decode_chat_request(request_json)
+
+    def encode_before() -> str:
+        response_data = WebSocketResponse(
+            system="consensus", response=SAMPLE_RESPONSE, phase="final", route="debate"
+        )
+        response_dict = {
+            "system": response_data.system,
+            "response": response_data.response,
+            "phase": response_data.phase,
+        }
+        if response_data.route is not None:
+            response_dict["route"] = response_data.route.value
+        return json.dumps(response_dict, separators=(",", ":"), ensure_ascii=False)
+
+    def encode_after() -> str:
+        frame = create_frame("consensus", SAMPLE_RESPONSE, "final", "debate")
+        return encode_web_socket_response(frame).decode()
+
+    if decode_before() != decode_after():
+        msg = "デコード結果が一致しません"
+        raise RuntimeError(msg)
+    if json.loads(encode_before()) != json.loads(encode_after()):
+        msg = "エンコード結果が一致しません"
+        raise RuntimeError(msg)
+
+    cases = {
+        "decode": (decode_before, decode_after),
+        "encode": (encode_before, encode_after),
+    }
+    for name, (before, after) in cases.items():
+        # 各処理の最小値を使用し、他のプロセスによる揺らぎの影響を減らす
+        before_us = min(timeit.repeat(before, number=args.number, repeat=3))
+        after_us = min(timeit.repeat(after, number=args.number, repeat=3))
+        before_us *= 1e6 / args.number
+        after_us *= 1e6 / args.number
+        logger.info(
+            "%s: 以前 %.2f us/frame, 現在 %.2f us/frame (%.1f倍)",
+            name,
+            before_us,
+            after_us,
+            before_us / after_us,
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,8 +2,7 @@
 
 import argparse
 import sys
-
-from nexus_magi.app import run_app
+from pathlib import Path
 
 
 def parse_args() -> argparse.Namespace:
@@ -27,13 +26,17 @@ def parse_args() -> argparse.Namespace:
         "--api-type",
         type=str,
         default="ollama",
-        choices=["ollama", "litellm"],
-        help="使用するLLM APIの種類 (ollama または litellm) (デフォルト: ollama)",
+        choices=["ollama", "litellm", "litellm_sdk"],
+        help=(
+            "使用するLLM APIの種類 (ollama、litellm または litellm_sdk) "
+            "(デフォルト: ollama)。"
+            "litellm_sdkはLiteLLMプロキシを使わずにプロセス内でLiteLLMを呼び出す"
+        ),
     )
     parser.add_argument(
         "--api-base",
         type=str,
-        help="LLM APIのベースURL (デフォルト: ollamaの場合はhttp://localhost:11434/api、litellmの場合はhttp://localhost:4000)",
+        help="LLM APIのベースURL (デフォルト: ollamaの場合はhttp://localhost:11434/api、litellmの場合はhttp://localhost:4000、litellm_sdkの場合はプロバイダの既定値)",
     )
     parser.add_argument(
         "--model",
@@ -41,6 +44,163 @@ def parse_args() -> argparse.Namespace:
         default="phi4-mini",
         help="使用するモデル名 (デフォルト: phi4-mini)",
     )
+    parser.add_argument(
+        "--semantic-cache-threshold",
+        type=float,
+        help=(
+            "言い換えられた質問にも応答を再利用するセマンティックキャッシュの"
+            "類似度の閾値 (例: 0.92)。指定しない場合はキャッシュを使用しない"
+        ),
+    )
+    parser.add_argument(
+        "--semantic-cache-size",
+        type=int,
+        default=10000,
+        help="セマンティックキャッシュに保持する質問数 (デフォルト: 10000)",
+    )
+    parser.add_argument(
+        "--embedding-model",
+        type=str,
+        help="埋め込みベクトルの取得に使うモデル名 (デフォルト: --modelと同じ)",
+    )
+    parser.add_argument(
+        "--cascade-model",
+        type=str,
+        help=(
+            "カスケードモードで最初に回答する小さなモデル名 (デフォルト: --modelと同じ)"
+        ),
+    )
+    parser.add_argument(
+        "--cascade-confidence-threshold",
+        type=float,
+        default=0.8,
+        help=(
+            "カスケードモードで小さなモデルの回答を採用する確信度 (0から1) "
+            "(デフォルト: 0.8)"
+        ),
+    )
+    parser.add_argument(
+        "--personas",
+        type=Path,
+        help=(
+            "討論に参加するペルソナを定義したYAMLファイル "
+            "(デフォルト: MELCHIOR、BALTHASAR、CASPERの3システム)"
+        ),
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=Path,
+        help=(
+            "討論のプロファイル(speedscope形式とcollapsed stacks形式)を保存する"
+            "ディレクトリ。指定しない場合はプロファイルしない"
+        ),
+    )
+    parser.add_argument(
+        "--profile-sample-rate",
+        type=float,
+        default=0.0,
+        help="全ての討論のうちプロファイルする割合 (0から1) (デフォルト: 0)",
+    )
+    parser.add_argument(
+        "--profile-token",
+        type=str,
+        help=(
+            "リクエストのprofile_tokenと一致した場合にそのリクエストをプロファイルする"
+            "管理者用トークン"
+        ),
+    )
+    parser.add_argument(
+        "--frame-flush-ms",
+        type=int,
+        default=20,
+        help=(
+            "圧縮形式を指定したクライアントへ、続けて生成された応答を"
+            "まとめて送信する間隔のミリ秒数 (デフォルト: 20)"
+        ),
+    )
+    parser.add_argument(
+        "--no-ws-compression",
+        action="store_true",
+        help=(
+            "uvicornが既定で取り決めるWebSocketのpermessage-deflate拡張による"
+            "圧縮を無効にする"
+        ),
+    )
+    parser.add_argument(
+        "--store-path",
+        type=Path,
+        help=(
+            "会話履歴と各システムの応答を保存するSQLiteのファイル。"
+            "指定しない場合は保存しない"
+        ),
+    )
+    parser.add_argument(
+        "--store-retention-days",
+        type=float,
+        default=30.0,
+        help="最後の応答から会話の記録を保持する日数 (デフォルト: 30)",
+    )
+    parser.add_argument(
+        "--batch-window-ms",
+        type=int,
+        help=(
+            "同じバックエンドへのプロンプトをこのミリ秒数の間まとめ、"
+            "OpenAI互換のcompletionsエンドポイントへ1回のリクエストで送信する "
+            "(litellmのみ。vLLMやllama.cppのサーバー向け)。"
+            "指定しない場合はプロンプトごとに送信する"
+        ),
+    )
+    parser.add_argument(
+        "--batch-prompt-format",
+        type=str,
+        default="chatml",
+        choices=["chatml", "phi", "llama3"],
+        help=(
+            "まとめて送信するプロンプトに使うモデルのチャットテンプレート "
+            "(デフォルト: chatml)"
+        ),
+    )
+    parser.add_argument(
+        "--quota-tokens-per-minute",
+        type=int,
+        help=(
+            "クライアントが直近1分間に使用できるプロンプトと生成のトークン数の合計。"
+            "指定しない場合は制限しない"
+        ),
+    )
+    parser.add_argument(
+        "--quota-tokens-per-day",
+        type=int,
+        help=(
+            "クライアントが直近1日に使用できるプロンプトと生成のトークン数の合計。"
+            "指定しない場合は制限しない"
+        ),
+    )
+    parser.add_argument(
+        "--quota-path",
+        type=Path,
+        help=(
+            "クライアントごとのトークン使用量を保存するJSONファイル。"
+            "指定しない場合はメモリ上でのみ集計する"
+        ),
+    )
+    parser.add_argument(
+        "--api-keys",
+        type=Path,
+        help=(
+            "接続を許可するAPIキーを1行に1つずつ記載したファイル。"
+            "指定した場合はX-API-KeyヘッダーのAPIキーごとに、"
+            "指定しない場合は接続元のアドレスごとにトークン使用量を集計する"
+        ),
+    )
+    parser.add_argument(
+        "--allow-anonymous",
+        action="store_true",
+        help=(
+            "--api-keysを指定した場合も、APIキーを送信しないブラウザなどの接続を"
+            "許可し、接続元のアドレスごとにトークン使用量を集計する"
+        ),
+    )
     return parser.parse_args()
 
 
@@ -52,12 +212,38 @@ def main() -> int:
 
     """
     args = parse_args()
+
+    # --helpなどを高速に返すため、サーバー関連のモジュールは引数の解析後に読み込む
+    from nexus_magi.app import run_app
+
     run_app(
         host=args.host,
         port=args.port,
         api_base=args.api_base,
         model=args.model,
         api_type=args.api_type,
+        semantic_cache_threshold=args.semantic_cache_threshold,
+        semantic_cache_size=args.semantic_cache_size,
+        embedding_model=args.embedding_model,
+        cascade_model=args.cascade_model,
+        cascade_confidence_threshold=args.cascade_confidence_threshold,
+        personas_path=args.personas,
+        profile_dir=args.profile_dir,
+        profile_sample_rate=args.profile_sample_rate,
+        profile_token=args.profile_token,
+        frame_flush_interval=args.frame_flush_ms / 1000,
+        store_path=args.store_path,
+        store_retention_days=args.store_retention_days,
+        batch_window=(
+            args.batch_window_ms / 1000 if args.batch_window_ms is not None else None
+        ),
+        batch_prompt_format=args.batch_prompt_format,
+        quota_tokens_per_minute=args.quota_tokens_per_minute,
+        quota_tokens_per_day=args.quota_tokens_per_day,
+        quota_path=args.quota_path,
+        api_keys_path=args.api_keys,
+        allow_anonymous=args.allow_anonymous,
+        ws_compression=not args.no_ws_compression,
     )
     return 0
 
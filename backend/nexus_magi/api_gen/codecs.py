@@ -0,0 +1,138 @@
+# generated by scripts/generate_models.py
+#   filename:  openapi.yaml
+
+"""WebSocketのフレームをデコード・エンコードするコーデック.
+
+デコードはJSONを中間の辞書に変換せずに、Pydanticのモデルで解析と検証を
+1回で行う。
+エンコードはモデルを作成せずに、辞書をコンパイル済みのシリアライザで
+JSONのバイト列に変換する。
+"""
+
+from typing import Literal, NotRequired
+
+from pydantic import TypeAdapter
+from typing_extensions import TypedDict
+
+from nexus_magi.api_gen import models
+
+
+class ChatMessageDict(TypedDict):
+    """ChatMessageをモデルを作成せずにエンコードするための辞書."""
+
+    role: Literal["user", "assistant"]
+    content: str
+
+
+class ChatRequestDict(TypedDict):
+    """ChatRequestをモデルを作成せずにエンコードするための辞書."""
+
+    messages: list[ChatMessageDict]
+    stream: NotRequired[bool]
+    debate: NotRequired[bool]
+    debate_rounds: NotRequired[int]
+    async_debate: NotRequired[bool]
+    deadline_ms: NotRequired[int]
+    cascade: NotRequired[bool]
+    structured_verdicts: NotRequired[bool]
+    session_id: NotRequired[str]
+    draft: NotRequired[bool]
+    profile_token: NotRequired[str]
+    compact_frames: NotRequired[bool]
+    conversation_id: NotRequired[str]
+    conversation_token: NotRequired[str]
+
+
+class FrameSegmentDict(TypedDict):
+    """FrameSegmentをモデルを作成せずにエンコードするための辞書."""
+
+    text: NotRequired[str]
+    ref: NotRequired[str]
+
+
+class WebSocketResponseDict(TypedDict):
+    """WebSocketResponseをモデルを作成せずにエンコードするための辞書."""
+
+    system: str
+    response: str
+    phase: NotRequired[str]
+    route: NotRequired[Literal["direct", "debate"]]
+    segments: NotRequired[list[FrameSegmentDict]]
+    retry_after_ms: NotRequired[int]
+    conversation_token: NotRequired[str]
+
+
+_chat_message_adapter = TypeAdapter(ChatMessageDict)
+_chat_message_list_adapter = TypeAdapter(list[ChatMessageDict])
+
+
+def decode_chat_message(data: str | bytes) -> models.ChatMessage:
+    """JSONからChatMessageをデコードする."""
+    return models.ChatMessage.model_validate_json(data)
+
+
+def encode_chat_message(value: ChatMessageDict) -> bytes:
+    """ChatMessageの辞書をJSONにエンコードする."""
+    return _chat_message_adapter.dump_json(value)
+
+
+def encode_chat_message_list(values: list[ChatMessageDict]) -> bytes:
+    """ChatMessageの辞書のリストをJSONの配列にエンコードする."""
+    return _chat_message_list_adapter.dump_json(values)
+
+
+_chat_request_adapter = TypeAdapter(ChatRequestDict)
+_chat_request_list_adapter = TypeAdapter(list[ChatRequestDict])
+
+
+def decode_chat_request(data: str | bytes) -> models.ChatRequest:
+    """JSONからChatRequestをデコードする."""
+    return models.ChatRequest.model_validate_json(data)
+
+
+def encode_chat_request(value: ChatRequestDict) -> bytes:
+    """ChatRequestの辞書をJSONにエンコードする."""
+    return _chat_request_adapter.dump_json(value)
+
+
+def encode_chat_request_list(values: list[ChatRequestDict]) -> bytes:
+    """ChatRequestの辞書のリストをJSONの配列にエンコードする."""
+    return _chat_request_list_adapter.dump_json(values)
+
+
+_frame_segment_adapter = TypeAdapter(FrameSegmentDict)
+_frame_segment_list_adapter = TypeAdapter(list[FrameSegmentDict])
+
+
+def decode_frame_segment(data: str | bytes) -> models.FrameSegment:
+    """JSONからFrameSegmentをデコードする."""
+    return models.FrameSegment.model_validate_json(data)
+
+
+def encode_frame_segment(value: FrameSegmentDict) -> bytes:
+    """FrameSegmentの辞書をJSONにエンコードする."""
+    return _frame_segment_adapter.dump_json(value)
+
+
+def encode_frame_segment_list(values: list[FrameSegmentDict]) -> bytes:
+    """FrameSegmentの辞書のリストをJSONの配列にエンコードする."""
+    return _frame_segment_list_adapter.dump_json(values)
+
+
+_web_socket_response_adapter = TypeAdapter(WebSocketResponseDict)
+_web_socket_response_list_adapter = TypeAdapter(list[WebSocketResponseDict])
+
+
+def decode_web_socket_response(data: str | bytes) -> models.WebSocketResponse:
+    """JSONからWebSocketResponseをデコードする."""
+    return models.WebSocketResponse.model_validate_json(data)
+
+
+def encode_web_socket_response(value: WebSocketResponseDict) -> bytes:
+    """WebSocketResponseの辞書をJSONにエンコードする."""
+    return _web_socket_response_adapter.dump_json(value)
+
+
+def encode_web_socket_response_list(values: list[WebSocketResponseDict]) -> bytes:
+    """WebSocketResponseの辞書のリストをJSONの配列にエンコードする."""
+    return _web_socket_response_list_adapter.dump_json(values)
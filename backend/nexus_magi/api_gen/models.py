@@ -47,23 +47,72 @@ class ChatRequest(BaseModel):
     """
     討論ラウンド数
     """
+    async_debate: Optional[bool] = False
+    """
+    非同期討論モード（ラウンド間で他システムを待たない）を使用するかどうか
+    """
+    deadline_ms: Optional[int] = None
+    """
+    応答までの制限時間（ミリ秒）。指定すると討論ラウンド数と生成長を自動で調整する
+    """
+    cascade: Optional[bool] = False
+    """
+    カスケードモード（小さなモデルで回答できない質問だけ討論する）を使用するかどうか
+    """
+    structured_verdicts: Optional[bool] = False
+    """
+    構造化モード（各システムの判定を多数決で集計し、票が割れた場合のみ合議を行う）を使用するかどうか
+    """
+    session_id: Optional[str] = None
+    """
+    共有する討論セッションの名前。同じ名前のリクエストは1つの討論の結果を購読する（メッセージが空の場合は購読のみ）
+    """
+    draft: Optional[bool] = False
+    """
+    下書きかどうか。討論モードで送信前の入力を送ると初期応答の生成を先行して開始し、応答は返さない
+    """
+    profile_token: Optional[str] = None
+    """
+    管理者用のトークン。サーバーの--profile-tokenと一致した場合、このリクエストの討論をプロファイルする
+    """
+    compact_frames: Optional[bool] = False
+    """
+    圧縮形式で応答を受け取るかどうか。続けて生成された応答を配列にまとめて送信し、送信済みの応答を含む応答はその応答への参照を含むsegmentsとして送信する
+    """
+    conversation_id: Optional[str] = None
+    """
+    会話ID。サーバーで会話の記録を保存している場合、保存された会話履歴の後にmessagesを続けて討論し、messagesと各システムの応答を記録する（messagesには新しいメッセージのみを含める）。討論モードでのみ指定できる。新しい会話IDの最初の応答でconversation_tokenを返し、以降のリクエストではそのトークンが必要となる
+    """
+    conversation_token: Optional[str] = None
+    """
+    会話IDの最初の応答で返されたトークン。会話を続ける場合に指定する
+    """
+
+
+class FrameSegment(BaseModel):
+    text: Optional[str] = None
+    """
+    そのまま連結する文字列
+    """
+    ref: Optional[str] = None
+    """
+    参照先のシステム。このシステムが直前に送信したレスポンスの内容に置き換える
+    """
 
 
-class System(Enum):
+class Route(Enum):
     """
-    レスポンスを生成するシステム（MAGI）
+    カスケードモードで選択された経路（直接回答または討論）
     """
 
-    melchior = "melchior"
-    balthasar = "balthasar"
-    casper = "casper"
-    consensus = "consensus"
+    direct = "direct"
+    debate = "debate"
 
 
 class WebSocketResponse(BaseModel):
-    system: System
+    system: str
     """
-    レスポンスを生成するシステム（MAGI）
+    レスポンスを生成するシステム（ペルソナのIDまたはconsensus）
     """
     response: str
     """
@@ -71,5 +120,21 @@ class WebSocketResponse(BaseModel):
     """
     phase: Optional[str] = None
     """
-    現在のフェーズ
+    現在のフェーズ（トークン使用量の上限や会話IDの誤りによりリクエストを断った場合はrejected、新しい会話を開始した場合はcreated）
+    """
+    route: Optional[Route] = None
+    """
+    カスケードモードで選択された経路（直接回答または討論）
+    """
+    segments: Optional[List[FrameSegment]] = None
+    """
+    圧縮形式で参照に置き換えた応答の内容。各要素の文字列と参照先の応答を順に連結するとレスポンスの内容になる（この場合responseは空）
+    """
+    retry_after_ms: Optional[int] = None
+    """
+    トークン使用量の上限によりリクエストを断った場合（phaseがrejected）に、再び利用できるようになるまでのミリ秒数
+    """
+    conversation_token: Optional[str] = None
+    """
+    新しい会話IDを使用した場合に返す、その会話を続けるためのトークン（phaseがcreated）。GET /api/conversations/{conversation_id}ではX-Conversation-Tokenヘッダーに指定する
     """
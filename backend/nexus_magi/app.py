@@ -1,46 +1,348 @@
-"""チャットAPIサーバーを定義するモジュール."""
+"""チャットAPIサーバーを定義するモジュール.
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+起動時間を短くするため、チャットモデルと生成されたAPIモデルは最初に使用する時点で
+読み込む。サーバー起動後にはバックグラウンドで事前に読み込んでおき、
+最初のリクエストで読み込み時間がかからないようにする。
+"""
+
+import asyncio
+import dataclasses
+import hashlib
+import hmac
+import importlib
+import math
+import secrets
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from fastapi import (
+    FastAPI,
+    HTTPException,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+    status,
+)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.requests import HTTPConnection
+from fastapi.responses import PlainTextResponse
+
+from nexus_magi.broadcast import SessionRegistry
+from nexus_magi.frame_encoder import FrameEncoder
+from nexus_magi.message_history import Message, MessageHistory
+from nexus_magi.prompt_batcher import configure_batching
+from nexus_magi.usage_quota import (
+    QuotaExceededError,
+    QuotaLimit,
+    UsageQuota,
+    quota_scope,
+    reserve_tokens,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncGenerator, Awaitable, Callable, Sequence
+
+    from nexus_magi.api_gen.models import ChatMessage, ChatRequest
+    from nexus_magi.personas import PersonaConfig
+    from nexus_magi.semantic_cache import SemanticCache
+    from nexus_magi.simple_chat_model import SimpleChatModel
+    from nexus_magi.speculation import Speculation
+    from nexus_magi.transcript_store import TranscriptStore
+
+# サーバー起動後にバックグラウンドで読み込むモジュール
+PRELOAD_MODULES = (
+    "nexus_magi.api_gen.models",
+    "nexus_magi.api_gen.codecs",
+    "nexus_magi.simple_chat_model",
+    "nexus_magi.debate_chat_model",
+    "nexus_magi.cascade_chat_model",
+    "requests",
+)
 
-# 生成されたAPIモデルをインポート
-from nexus_magi.api_gen.models import ChatMessage, ChatRequest, WebSocketResponse
-from nexus_magi.debate_chat_model import DebateChatModel
-from nexus_magi.simple_chat_model import SimpleChatModel
+# 使用量の上限を設定できる期間の秒数
+MINUTE_SECONDS = 60.0
+DAY_SECONDS = 86400.0
+
+# トークン使用量を保存し、使用の無いクライアントをメモリから削除する間隔の秒数
+QUOTA_SAVE_INTERVAL = 60.0
 
 
 class APIConfig:
     """APIの設定を管理するクラス."""
 
-    def __init__(
+    def __init__(  # noqa: PLR0913
         self,
-        api_base: str = "http://localhost:11434/api",
+        api_base: str | None = "http://localhost:11434/api",
         model: str = "phi4-mini",
         api_type: str = "ollama",
+        semantic_cache_threshold: float | None = None,
+        semantic_cache_size: int = 10000,
+        embedding_model: str | None = None,
+        cascade_model: str | None = None,
+        cascade_confidence_threshold: float = 0.8,
+        personas_path: Path | None = None,
+        profile_dir: Path | None = None,
+        profile_sample_rate: float = 0.0,
+        profile_token: str | None = None,
+        frame_flush_interval: float = 0.02,
+        store_path: Path | None = None,
+        store_retention_days: float = 30.0,
+        quota_tokens_per_minute: int | None = None,
+        quota_tokens_per_day: int | None = None,
+        quota_path: Path | None = None,
+        api_keys_path: Path | None = None,
+        *,
+        allow_anonymous: bool = False,
     ) -> None:
         """APIConfigクラスを初期化.
 
         Args:
-            api_base: LLM APIのベースURL
+            api_base: LLM APIのベースURL(litellm_sdkの場合はNoneでプロバイダの既定値)
             model: 使用するモデル名
-            api_type: APIの種類("ollama"または"litellm")
+            api_type: APIの種類("ollama"、"litellm"または"litellm_sdk")
+            semantic_cache_threshold: 応答を再利用する類似度(Noneの場合は無効)
+            semantic_cache_size: キャッシュする質問数の上限
+            embedding_model: 埋め込みベクトルの取得に使うモデル名
+            cascade_model: カスケードモードで最初に回答する小さなモデル名
+            cascade_confidence_threshold: 小さなモデルの回答を採用する確信度
+            personas_path: 討論に参加するペルソナを定義したYAMLファイル
+            profile_dir: 討論のプロファイルを保存するディレクトリ(Noneの場合は無効)
+            profile_sample_rate: 全ての討論のうちプロファイルする割合
+            profile_token: リクエストごとにプロファイルを有効にする管理者用トークン
+            frame_flush_interval: 圧縮形式で応答をまとめて送信する間隔の秒数
+            store_path: 会話の記録を保存するSQLiteのファイル(Noneの場合は保存しない)
+            store_retention_days: 会話の記録を保持する日数
+            quota_tokens_per_minute: クライアントが1分間に使用できるトークン数
+            quota_tokens_per_day: クライアントが1日に使用できるトークン数
+            quota_path: トークン使用量を保存するJSONファイル(Noneの場合は保存しない)
+            api_keys_path: 接続を許可するAPIキーを1行に1つずつ記載したファイル
+                (Noneの場合はクライアントのアドレスで使用量を集計する)
+            allow_anonymous: APIキーを設定した場合に、APIキーを送信しない
+                クライアントの接続も許可するかどうか
 
         """
         self.api_base = api_base
         self.model = model
         self.api_type = api_type
+        self.semantic_cache_threshold = semantic_cache_threshold
+        self.semantic_cache_size = semantic_cache_size
+        self.embedding_model = embedding_model
+        self.cascade_model = cascade_model
+        self.cascade_confidence_threshold = cascade_confidence_threshold
+        self.personas_path = personas_path
+        self.profile_dir = profile_dir
+        self.profile_sample_rate = profile_sample_rate
+        self.profile_token = profile_token
+        self.frame_flush_interval = frame_flush_interval
+        self.store_path = store_path
+        self.store_retention_days = store_retention_days
+        self.quota_tokens_per_minute = quota_tokens_per_minute
+        self.quota_tokens_per_day = quota_tokens_per_day
+        self.quota_path = quota_path
+        self.api_keys_path = api_keys_path
+        self.allow_anonymous = allow_anonymous
 
 
 # APIの設定
 api_config = APIConfig()
 
+# 設定ファイルから読み込んだペルソナ構成
+_persona_config: "PersonaConfig | None" = None
+
+
+def get_persona_config() -> "PersonaConfig | None":
+    """討論に参加するペルソナ構成を取得する.
+
+    Returns:
+        PersonaConfig | None: ペルソナ構成(設定ファイルが無い場合はNone)
+
+    """
+    global _persona_config  # noqa: PLW0603
+    if api_config.personas_path is None:
+        return None
+    if _persona_config is None:
+        from nexus_magi.personas import load_persona_config
+
+        _persona_config = load_persona_config(api_config.personas_path)
+    return _persona_config
+
+
+# エンドポイントごとのセマンティックキャッシュ
+_semantic_caches: dict[str, "SemanticCache"] = {}
+
+
+def get_semantic_cache(name: str) -> "SemanticCache | None":
+    """エンドポイントで共有するセマンティックキャッシュを取得する.
+
+    通常チャットと討論では応答の内容が異なるため、キャッシュを分ける。
+
+    Args:
+        name: キャッシュの名前
+
+    Returns:
+        SemanticCache | None: キャッシュ(無効な場合はNone)
+
+    """
+    if api_config.semantic_cache_threshold is None:
+        return None
+    if name not in _semantic_caches:
+        # NumPyは読み込みに時間がかかるため、キャッシュを有効にした場合のみ読み込む
+        from nexus_magi.llm_client import LLMClient
+        from nexus_magi.semantic_cache import SemanticCache
+
+        client = LLMClient(
+            api_base=api_config.api_base,
+            model=api_config.embedding_model or api_config.model,
+            api_type=api_config.api_type,
+        )
+        _semantic_caches[name] = SemanticCache(
+            client,
+            threshold=api_config.semantic_cache_threshold,
+            capacity=api_config.semantic_cache_size,
+        )
+    return _semantic_caches[name]
+
+
+def get_debate_cache_name(request: "ChatRequest") -> str:
+    """討論の方式とラウンド数ごとのセマンティックキャッシュの名前を返す.
+
+    同じ質問でも討論の方式やラウンド数によって最終結果が異なるため、
+    キャッシュを分けて他の方式の結果を返さないようにする。
+
+    Args:
+        request: チャットリクエスト
+
+    Returns:
+        str: キャッシュの名前
+
+    """
+    if request.cascade:
+        mode = "cascade"
+    elif request.async_debate:
+        # 非同期討論は判定の形式を指定できない
+        return f"debate:async:rounds={request.debate_rounds}"
+    else:
+        mode = "sync"
+    if request.structured_verdicts:
+        mode += "+structured"
+    return f"debate:{mode}:rounds={request.debate_rounds}"
+
+
+# サーバーの起動時に開く会話の記録の保存先
+_transcript_store: "TranscriptStore | None" = None
+
+
+def get_transcript_store() -> "TranscriptStore | None":
+    """会話の記録の保存先を取得する.
+
+    Returns:
+        TranscriptStore | None: 保存先(保存しない場合はNone)
+
+    """
+    return _transcript_store
+
+
+# サーバーの起動時に作成するトークン使用量の制限
+_usage_quota: UsageQuota | None = None
+
+
+def get_usage_quota() -> UsageQuota | None:
+    """クライアントごとのトークン使用量の制限を取得する.
+
+    Returns:
+        UsageQuota | None: 使用量の制限(上限が設定されていない場合はNone)
+
+    """
+    return _usage_quota
+
+
+def create_usage_quota() -> UsageQuota | None:
+    """設定に応じてトークン使用量の制限を作成し、保存した使用量を読み込む.
+
+    Returns:
+        UsageQuota | None: 使用量の制限(上限が設定されていない場合はNone)
+
+    """
+    limits = []
+    if api_config.quota_tokens_per_minute is not None:
+        limits.append(QuotaLimit(MINUTE_SECONDS, api_config.quota_tokens_per_minute))
+    if api_config.quota_tokens_per_day is not None:
+        limits.append(QuotaLimit(DAY_SECONDS, api_config.quota_tokens_per_day))
+    if not limits:
+        return None
+    quota = UsageQuota(limits, api_config.quota_path)
+    quota.load()
+    return quota
+
+
+async def save_usage_quota_periodically(quota: UsageQuota) -> None:
+    """トークン使用量を一定の間隔で保存する.
+
+    Args:
+        quota: 使用量の制限
+
+    """
+    while True:
+        await asyncio.sleep(QUOTA_SAVE_INTERVAL)
+        await asyncio.to_thread(quota.save)
+
+
+# 接続を許可するAPIキー
+_api_keys: frozenset[str] | None = None
+
+
+def get_api_keys() -> frozenset[str] | None:
+    """接続を許可するAPIキーを取得する.
+
+    Returns:
+        frozenset[str] | None: APIキー(設定ファイルが無い場合はNone)
+
+    """
+    global _api_keys  # noqa: PLW0603
+    if api_config.api_keys_path is None:
+        return None
+    if _api_keys is None:
+        lines = api_config.api_keys_path.read_text().splitlines()
+        _api_keys = frozenset(line.strip() for line in lines if line.strip())
+    return _api_keys
+
+
+def get_client_id(connection: HTTPConnection) -> str | None:
+    """トークン使用量を集計するクライアントを接続から識別する.
+
+    APIキーを設定した場合は、X-API-KeyヘッダーのAPIキーで識別する。
+    APIキーはヘッダーでのみ受け付け、URLに含めさせない。APIキーを送信しない
+    クライアントは、匿名の接続を許可した場合のみ接続元のアドレスで識別する。
+    APIキーを設定していない場合は、全てのクライアントを接続元のアドレスで識別する。
+
+    Args:
+        connection: クライアントとのWebSocket接続またはHTTPリクエスト
+
+    Returns:
+        str | None: クライアントの識別子(接続を許可しない場合はNone)
+
+    """
+    api_keys = get_api_keys()
+    api_key = connection.headers.get("x-api-key")
+    if api_keys is None or (api_key is None and api_config.allow_anonymous):
+        host = connection.client.host if connection.client else "unknown"
+        return f"addr:{host}"
+    if api_key not in api_keys:
+        return None
+    # 保存する使用量にAPIキーそのものを含めない
+    return f"key:{hashlib.sha256(api_key.encode()).hexdigest()[:16]}"
+
 
 class ConnectionManager:
-    """WebSocket接続を管理するクラス."""
+    """WebSocket接続と、接続間で共有する討論セッションを管理するクラス."""
 
     def __init__(self) -> None:
         """WebSocket接続管理クラスを初期化."""
         self.active_connections: list[WebSocket] = []
+        # 複数のクライアントが同じ討論を購読するための名前付きセッション
+        self.sessions = SessionRegistry()
 
     async def connect(self, websocket: WebSocket) -> None:
         """WebSocket接続を確立."""
@@ -52,10 +354,52 @@ class ConnectionManager:
         self.active_connections.remove(websocket)
 
 
+def _preload_modules() -> None:
+    """リクエスト処理で使用するモジュールを事前に読み込む."""
+    for module_name in PRELOAD_MODULES:
+        importlib.import_module(module_name)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI) -> AsyncIterator[None]:
+    """サーバーの起動・終了時の処理.
+
+    接続の受け付けを遅らせないよう、モジュールの事前読み込みは別スレッドで行う。
+    会話の記録を保存する場合は、終了時に未書き込みの記録を書き込んでから閉じる。
+    トークン使用量は一定の間隔と終了時に保存する。
+    """
+    global _transcript_store, _usage_quota  # noqa: PLW0603
+    preload = asyncio.create_task(asyncio.to_thread(_preload_modules))
+    _usage_quota = create_usage_quota()
+    quota_saver = None
+    if _usage_quota is not None:
+        quota_saver = asyncio.create_task(save_usage_quota_periodically(_usage_quota))
+    if api_config.store_path is not None:
+        from nexus_magi.transcript_store import TranscriptStore
+
+        _transcript_store = TranscriptStore(
+            api_config.store_path, retention_days=api_config.store_retention_days
+        )
+        await _transcript_store.start()
+    try:
+        yield
+    finally:
+        await preload
+        if _transcript_store is not None:
+            await _transcript_store.close()
+            _transcript_store = None
+        if quota_saver is not None:
+            quota_saver.cancel()
+        if _usage_quota is not None:
+            await asyncio.to_thread(_usage_quota.save)
+            _usage_quota = None
+
+
 app = FastAPI(
     title="Nexus MAGI API",
     description="MAGIシステムによるチャットAPI",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
 # CORS設定を追加
@@ -71,12 +415,33 @@ app.add_middleware(
 manager = ConnectionManager()
 
 
-def format_messages(messages: list[ChatMessage]) -> list[dict[str, str]]:
-    """Pydanticモデルのメッセージリストを辞書リストに変換.
+def format_messages(messages: list["ChatMessage"]) -> MessageHistory:
+    """Pydanticモデルのメッセージリストを会話履歴に変換.
 
     Enumオブジェクトを文字列に変換して返します。
+    会話履歴は全てのペルソナとフェーズで複製せずに共有します。
+    """
+    return MessageHistory(
+        Message(role=msg.role.value, content=msg.content) for msg in messages
+    )
+
+
+def create_frame_encoder(websocket: WebSocket, request: "ChatRequest") -> FrameEncoder:
+    """リクエストで指定された形式で応答を送信する送信処理を作成する.
+
+    Args:
+        websocket: 応答を送信するWebSocket接続
+        request: チャットリクエスト
+
+    Returns:
+        FrameEncoder: 応答の送信処理
+
     """
-    return [{"role": msg.role.value, "content": msg.content} for msg in messages]
+    return FrameEncoder(
+        websocket.send_text,
+        api_config.frame_flush_interval,
+        compact=bool(request.compact_frames),
+    )
 
 
 @app.get("/")
@@ -85,18 +450,96 @@ async def root() -> dict[str, str]:
     return {"message": "MAGI合議システム API"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> str:
+    """Prometheusのテキスト形式でメトリクスを返すエンドポイント."""
+    from nexus_magi.concurrency_limiter import get_all_limiters
+
+    lines = [
+        "# HELP nexus_magi_concurrency_limit 現在のLLM API同時呼び出し数の上限",
+        "# TYPE nexus_magi_concurrency_limit gauge",
+        "# HELP nexus_magi_concurrency_inflight 実行中のLLM API呼び出し数",
+        "# TYPE nexus_magi_concurrency_inflight gauge",
+        "# HELP nexus_magi_concurrency_waiting 枠の空きを待っているLLM API呼び出し数",
+        "# TYPE nexus_magi_concurrency_waiting gauge",
+    ]
+    for backend, limiter in sorted(get_all_limiters().items()):
+        stats = limiter.get_stats()
+        label = backend.replace("\\", "\\\\").replace('"', '\\"')
+        lines.extend(
+            [
+                f'nexus_magi_concurrency_limit{{backend="{label}"}} {stats.limit}',
+                f'nexus_magi_concurrency_inflight{{backend="{label}"}} '
+                f"{stats.inflight}",
+                f'nexus_magi_concurrency_waiting{{backend="{label}"}} {stats.waiting}',
+            ]
+        )
+    return "\n".join(lines) + "\n"
+
+
+@app.get("/api/conversations/{conversation_id}")
+async def conversation_entries(
+    request: Request,
+    conversation_id: str,
+    before: int | None = None,
+    limit: int = 50,
+) -> dict:
+    """会話の記録を新しい方から1ページずつ返すエンドポイント.
+
+    さらに古い記録は、返されたnext_beforeをbeforeに指定して取得する。
+    WebSocketのエンドポイントと同じく、許可されていないクライアントは拒否する。
+    会話の開始時に返したトークンをX-Conversation-Tokenヘッダーに指定する必要があり、
+    トークンが一致しない会話は、存在を知らせないために見つからないものとして扱う。
+    """
+    if get_client_id(request) is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="APIキーが無いか、許可されていないAPIキーです",
+        )
+    store = get_transcript_store()
+    if store is None:
+        raise HTTPException(status_code=404, detail="会話の記録は保存されていません")
+    owner = await store.get_owner(conversation_id)
+    if not is_conversation_owner(owner, request.headers.get("x-conversation-token")):
+        raise HTTPException(status_code=404, detail="会話が見つかりません")
+    page = await store.load_page(conversation_id, before=before, limit=limit)
+    return dataclasses.asdict(page)
+
+
 @app.websocket("/api/chat/ws")
 async def chat_websocket_endpoint(websocket: WebSocket) -> None:
     """通常チャット用WebSocketエンドポイント."""
+    client_id = get_client_id(websocket)
+    if client_id is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
     await manager.connect(websocket)
+
+    # 接続の受け付けを優先し、モデルは受け付け後に読み込む
+    from nexus_magi.api_gen.codecs import decode_chat_request
+    from nexus_magi.simple_chat_model import SimpleChatModel
+
     try:
         while True:
             # クライアントからのメッセージを待機
-            data = await websocket.receive_json()
+            data = await websocket.receive_text()
 
-            # ChatRequestの形式に変換
-            request = ChatRequest(**data)
+            # 辞書を経由せずにChatRequestの形式に変換
+            request = decode_chat_request(data)
             messages = format_messages(request.messages)
+            encoder = create_frame_encoder(websocket, request)
+
+            if request.conversation_id is not None:
+                # 通常チャットは会話を記録しないため、続けられる会話として扱わない
+                await encoder.send(
+                    create_frame(
+                        "conversation",
+                        "会話IDは討論モードでのみ指定できます",
+                        "rejected",
+                    )
+                )
+                await encoder.close()
+                continue
 
             # グローバル設定を使用
             api_base = api_config.api_base
@@ -105,114 +548,653 @@ async def chat_websocket_endpoint(websocket: WebSocket) -> None:
 
             # SimpleChatModelを使用
             chat_model = SimpleChatModel(
-                api_base=api_base, model=model, api_type=api_type
+                api_base=api_base,
+                model=model,
+                api_type=api_type,
+                semantic_cache=get_semantic_cache("chat"),
             )
 
-            if request.stream:
-                # ストリーミングモードの場合
-
-                # コールバック関数を定義
-                async def send_update(system: str, response: str) -> None:
-                    """ストリーミングモードでの更新をクライアントに送信."""
-                    # OpenAPI生成モデルを使用してレスポンスを作成
-                    response_data = WebSocketResponse(
-                        system=system,
-                        response=response,
-                        phase="initial",  # 互換性のためにphaseを追加
-                    )
-                    # モデルをJSONに変換する際にEnumの値を取得するための辞書を作成
-                    response_dict = {
-                        "system": response_data.system.value,
-                        "response": response_data.response,
-                        "phase": response_data.phase,
-                    }
-                    await websocket.send_json(response_dict)
-
-                # ストリーミングレスポンスを生成
-                async for _response in chat_model.get_response_streaming(
-                    messages, send_update
-                ):
-                    # すでにコールバックで処理されているので、ここでは何もしない
-                    pass
-            else:
-                # 非ストリーミングモードの場合
-                response = await chat_model.get_response(messages)
-                # OpenAPI生成モデルを使用してレスポンスを作成
-                response_data = WebSocketResponse(
-                    system="melchior",  # シンプルモードではmelchiorとして応答
-                    response=response,
-                    phase="initial",  # 単一の応答なのでinitialフェーズとする
-                )
-                # モデルをJSONに変換する際にEnumの値を取得するための辞書を作成
-                response_dict = {
-                    "system": response_data.system.value,
-                    "response": response_data.response,
-                    "phase": response_data.phase,
-                }
-                await websocket.send_json(response_dict)
+            with quota_scope(get_usage_quota(), client_id):
+                try:
+                    await run_chat_request(encoder, request, chat_model, messages)
+                except QuotaExceededError as e:
+                    await encoder.send(create_rejection_frame(e))
+            await encoder.close()
 
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
 
+async def run_chat_request(
+    encoder: FrameEncoder,
+    request: "ChatRequest",
+    chat_model: "SimpleChatModel",
+    messages: MessageHistory,
+) -> None:
+    """通常チャットの応答を生成し、クライアントへ送信する.
+
+    Args:
+        encoder: クライアントへの応答の送信処理
+        request: チャットリクエスト
+        chat_model: 応答を生成するチャットモデル
+        messages: これまでの会話履歴
+
+    """
+    if request.stream:
+        # ストリーミングモードの場合
+
+        # コールバック関数を定義
+        async def send_update(system: str, response: str) -> None:
+            """ストリーミングモードでの更新をクライアントに送信."""
+            # 互換性のためにphaseを追加
+            await encoder.send(create_frame(system, response, "initial"))
+
+        async def send_delta(system: str, delta: str) -> None:
+            """生成途中の応答の、新たに生成された部分をクライアントに送信."""
+            await encoder.send_delta(system, delta, "initial")
+
+        # ストリーミングレスポンスを生成
+        async for _response in chat_model.get_response_streaming(
+            messages, send_update, send_delta
+        ):
+            # すでにコールバックで処理されているので、ここでは何もしない
+            pass
+    else:
+        # 非ストリーミングモードの場合
+        response = await chat_model.get_response(messages)
+        # シンプルモードではmelchiorとして応答し、
+        # 単一の応答なのでinitialフェーズとする
+        await encoder.send(create_frame("melchior", response, "initial"))
+
+
+def create_frame(
+    system: str, response: str, phase: str, route: str | None = None
+) -> dict[str, str]:
+    """クライアントへ送信する応答を作成する.
+
+    Args:
+        system: 応答を生成したシステム
+        response: 応答の内容
+        phase: 現在のフェーズ
+        route: カスケードモードで選択された経路
+
+    Returns:
+        dict: JSONとして送信する応答(WebSocketResponseの形式)
+
+    """
+    # モデルは作成せず、送信時に生成されたコーデックでJSONに変換する
+    frame = {"system": system, "response": response, "phase": phase}
+    if route is not None:
+        frame["route"] = route
+    return frame
+
+
+def create_rejection_frame(error: QuotaExceededError) -> dict:
+    """トークン使用量の上限によりリクエストを断ったことを伝える応答を作成する.
+
+    Args:
+        error: 上限に達したことを表す例外
+
+    Returns:
+        dict: JSONとして送信する応答(WebSocketResponseの形式)
+
+    """
+    frame: dict = create_frame("quota", str(error), "rejected")
+    frame["retry_after_ms"] = math.ceil(error.retry_after * 1000)
+    return frame
+
+
+def create_error_frame(error: Exception) -> dict:
+    """討論の実行中に発生した例外を伝える応答を作成する.
+
+    Args:
+        error: 討論の実行中に発生した例外
+
+    Returns:
+        dict: JSONとして送信する応答(WebSocketResponseの形式)
+
+    """
+    if isinstance(error, QuotaExceededError):
+        return create_rejection_frame(error)
+    return create_frame("consensus", f"エラーが発生しました: {error}", "final")
+
+
+def reserve_debate_tokens(
+    request: "ChatRequest", messages: "Sequence[Message]"
+) -> None:
+    """討論全体で使用するトークン数を見積もり、クライアントの使用量から確保する.
+
+    使用量の上限を超える討論は、途中で打ち切らずに開始前に断る。
+
+    Args:
+        request: チャットリクエスト
+        messages: これまでの会話履歴
+
+    Raises:
+        QuotaExceededError: 確保すると使用量の上限を超える場合
+
+    """
+    if get_usage_quota() is None:
+        return
+
+    from nexus_magi.cascade_chat_model import CascadeChatModel
+    from nexus_magi.debate_chat_model import DebateChatModel
+
+    if request.cascade:
+        # 討論の前に呼び出す小さなモデルの回答も含めて見積もる
+        chat_model: CascadeChatModel | DebateChatModel = CascadeChatModel(
+            api_base=api_config.api_base,
+            model=api_config.model,
+            api_type=api_config.api_type,
+            cascade_model=api_config.cascade_model,
+            persona_config=get_persona_config(),
+        )
+    else:
+        chat_model = DebateChatModel(
+            api_base=api_config.api_base,
+            model=api_config.model,
+            api_type=api_config.api_type,
+            persona_config=get_persona_config(),
+        )
+    reserve_tokens(chat_model.estimate_tokens(messages, request.debate_rounds or 0))
+
+
+def create_debate_responses(
+    request: "ChatRequest",
+    messages: "Sequence[Message]",
+    send_update: "Callable[..., Awaitable[None]]",
+    speculation: "Speculation | None" = None,
+    *,
+    client_id: str | None = None,
+) -> "AsyncGenerator[dict[str, str], None]":
+    """リクエストに応じた討論を実行するジェネレータを作成する.
+
+    プロファイルが有効な場合は、対象のリクエストの討論を実行する間の
+    スタックと各フェーズの所要時間を採取する。
+
+    Args:
+        request: チャットリクエスト
+        messages: これまでの会話履歴
+        send_update: 各システムの応答を受け取るコールバック関数
+        speculation: 下書きから先行して生成した初期応答
+        client_id: 失敗した討論を再開できるクライアントの識別子
+
+    Returns:
+        AsyncGenerator: 討論を含むストリーミングレスポンス
+
+    """
+    store = get_transcript_store()
+    if store is not None and request.conversation_id is not None:
+        # 各システムの応答を会話の記録に追加する
+        send_update = store.record_frames(request.conversation_id, send_update)
+
+    if api_config.profile_dir is not None:
+        from nexus_magi.profiling import (
+            DebateProfile,
+            create_profile_name,
+            profile_debate,
+            record_phases,
+            should_profile,
+        )
+
+        if should_profile(
+            request.profile_token,
+            api_config.profile_token,
+            api_config.profile_sample_rate,
+        ):
+            profile = DebateProfile(
+                create_profile_name(), barrier=not request.async_debate
+            )
+            updates = _create_debate_responses(
+                request,
+                messages,
+                record_phases(send_update, profile.timeline),
+                speculation,
+                client_id=client_id,
+            )
+            return profile_debate(updates, profile, api_config.profile_dir)
+    return _create_debate_responses(
+        request, messages, send_update, speculation, client_id=client_id
+    )
+
+
+def _create_debate_responses(
+    request: "ChatRequest",
+    messages: "Sequence[Message]",
+    send_update: "Callable[..., Awaitable[None]]",
+    speculation: "Speculation | None" = None,
+    *,
+    client_id: str | None = None,
+) -> "AsyncGenerator[dict[str, str], None]":
+    """リクエストの設定に応じたチャットモデルで討論を実行するジェネレータを作成する.
+
+    Args:
+        request: チャットリクエスト
+        messages: これまでの会話履歴
+        send_update: 各システムの応答を受け取るコールバック関数
+        speculation: 下書きから先行して生成した初期応答
+        client_id: 失敗した討論を再開できるクライアントの識別子
+
+    Returns:
+        AsyncGenerator: 討論を含むストリーミングレスポンス
+
+    """
+    from nexus_magi.cascade_chat_model import CascadeChatModel
+    from nexus_magi.debate_chat_model import DebateChatModel
+
+    # グローバル設定を使用
+    api_base = api_config.api_base
+    model = api_config.model
+    api_type = api_config.api_type
+
+    if request.cascade:
+        # 小さなモデルが回答できない質問だけを討論に回すカスケードモード
+        cascade_model = CascadeChatModel(
+            api_base=api_base,
+            model=model,
+            api_type=api_type,
+            cascade_model=api_config.cascade_model,
+            confidence_threshold=api_config.cascade_confidence_threshold,
+            semantic_cache=get_semantic_cache(get_debate_cache_name(request)),
+            persona_config=get_persona_config(),
+            speculation=speculation,
+            checkpoint_owner=client_id,
+        )
+        return cascade_model.get_response_with_cascade(
+            messages,
+            send_update,
+            debate_rounds=request.debate_rounds,
+            deadline_ms=request.deadline_ms,
+            structured_verdicts=request.structured_verdicts,
+        )
+
+    # 討論モードはDebateChatModelを使用
+    chat_model = DebateChatModel(
+        api_base=api_base,
+        model=model,
+        api_type=api_type,
+        semantic_cache=get_semantic_cache(get_debate_cache_name(request)),
+        persona_config=get_persona_config(),
+        speculation=speculation,
+        checkpoint_owner=client_id,
+    )
+    if request.async_debate:
+        # ラウンド間の待ち合わせを行わない非同期討論モード
+        return chat_model.get_response_with_async_debate(
+            messages, send_update, max_turns=request.debate_rounds
+        )
+    return chat_model.get_response_with_debate(
+        messages,
+        send_update,
+        debate_rounds=request.debate_rounds,
+        deadline_ms=request.deadline_ms,
+        structured_verdicts=request.structured_verdicts,
+    )
+
+
+class ConversationAccessError(Exception):
+    """会話のトークンが無いか一致しないため、会話を使用できないことを表す例外."""
+
+
+def hash_conversation_token(token: str) -> str:
+    """会話のトークンを、保存する値に変換する.
+
+    Args:
+        token: クライアントに返した会話のトークン
+
+    Returns:
+        str: トークンのハッシュ値
+
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def is_conversation_owner(owner: str | None, token: str | None) -> bool:
+    """会話のトークンが、保存された所有者と一致するかを確認する.
+
+    Args:
+        owner: 保存された所有者(会話が無い場合はNone)
+        token: クライアントが指定したトークン
+
+    Returns:
+        bool: 一致する場合はTrue
+
+    """
+    return (
+        owner is not None
+        and token is not None
+        and hmac.compare_digest(owner, hash_conversation_token(token))
+    )
+
+
+async def open_conversation(
+    request: "ChatRequest", *, create: bool = True
+) -> str | None:
+    """リクエストの会話IDを使用できるかを確認し、新しい会話であれば開始する.
+
+    会話IDはクライアントが決めるため、接続元のアドレスなどではなく、会話の開始時に
+    推測できないトークンを作成してクライアントに返し、以降はそのトークンを求める。
+
+    Args:
+        request: 会話IDとトークンを含むチャットリクエスト
+        create: 新しい会話を開始するかどうか(下書きの場合はFalse)
+
+    Returns:
+        str | None: 新しい会話を開始した場合はその会話のトークン
+
+    Raises:
+        ConversationAccessError: 既存の会話のトークンが無いか一致しない場合
+
+    """
+    store = get_transcript_store()
+    if store is None or request.conversation_id is None:
+        return None
+    owner = await store.get_owner(request.conversation_id)
+    if owner is not None:
+        if not is_conversation_owner(owner, request.conversation_token):
+            msg = "会話のトークンが無いか、一致しません"
+            raise ConversationAccessError(msg)
+        return None
+    if not create:
+        return None
+    token = secrets.token_urlsafe(32)
+    if not await store.claim(request.conversation_id, hash_conversation_token(token)):
+        # 同時に送信された他のリクエストが先に会話を開始した
+        msg = "会話のトークンが無いか、一致しません"
+        raise ConversationAccessError(msg)
+    return token
+
+
+async def load_conversation(
+    request: "ChatRequest", messages: MessageHistory
+) -> MessageHistory:
+    """保存された会話履歴の後に、リクエストのメッセージを続けた会話履歴を作成する.
+
+    Args:
+        request: 会話IDを含むチャットリクエスト
+        messages: リクエストのメッセージ
+
+    Returns:
+        MessageHistory: 会話履歴(会話IDが無い場合はリクエストのメッセージ)
+
+    """
+    store = get_transcript_store()
+    if store is None or request.conversation_id is None:
+        return messages
+    history = await store.load_messages(request.conversation_id)
+    return MessageHistory([*history, *messages])
+
+
+def record_messages(request: "ChatRequest", messages: MessageHistory) -> None:
+    """保存された会話履歴に続く、リクエストのメッセージを記録する.
+
+    Args:
+        request: 会話IDを含むチャットリクエスト
+        messages: リクエストのメッセージ
+
+    """
+    store = get_transcript_store()
+    if store is not None and request.conversation_id is not None:
+        store.append_messages(request.conversation_id, messages)
+
+
+def update_speculation(
+    speculation: "Speculation | None", messages: "Sequence[Message]"
+) -> "Speculation | None":
+    """下書きに合わせて初期応答の先行生成を開始する.
+
+    実行中の先行生成を下書きにも再利用できる場合はそのまま続け、
+    そうでない場合は取り消して新しい下書きで開始し直す。
+
+    Args:
+        speculation: 実行中の先行生成
+        messages: 最後のメッセージを下書きとした会話履歴
+
+    Returns:
+        Speculation | None: 実行中の先行生成(下書きが空の場合はNone)
+
+    """
+    if speculation is not None:
+        if speculation.matches(messages):
+            return speculation
+        speculation.cancel()
+    if not messages or messages[-1]["role"] != "user" or not messages[-1]["content"]:
+        return None
+
+    from nexus_magi.debate_chat_model import DebateChatModel
+
+    chat_model = DebateChatModel(
+        api_base=api_config.api_base,
+        model=api_config.model,
+        api_type=api_config.api_type,
+        persona_config=get_persona_config(),
+    )
+    return chat_model.start_speculation(messages)
+
+
+async def stream_debate_session(
+    encoder: FrameEncoder,
+    request: "ChatRequest",
+    messages: "Sequence[Message]",
+    speculation: "Speculation | None" = None,
+    *,
+    client_id: str | None = None,
+) -> None:
+    """名前付きの討論セッションを購読し、応答をクライアントへ送信する.
+
+    セッションの討論がまだ開始されていなければ、このリクエストの内容で開始する。
+    メッセージの無いリクエストは購読のみを行い、討論の開始を待つ。
+
+    Args:
+        encoder: クライアントへの応答の送信処理
+        request: セッションIDを含むチャットリクエスト
+        messages: これまでの会話履歴
+        speculation: 下書きから先行して生成した初期応答
+        client_id: 失敗した討論を再開できるクライアントの識別子
+
+    Raises:
+        QuotaExceededError: 討論を開始すると使用量の上限を超える場合
+
+    """
+    session = manager.sessions.get_or_create(request.session_id)
+    if not session.started and messages:
+        reserve_debate_tokens(request, messages)
+
+        async def publish_update(
+            system: str, response: str, phase: str, route: str | None = None
+        ) -> None:
+            """討論セッションの購読者全員に更新を配信."""
+            session.publish(create_frame(system, response, phase, route))
+
+        async def run_debate() -> None:
+            async for _response in create_debate_responses(
+                request, messages, publish_update, speculation, client_id=client_id
+            ):
+                # すでにコールバックで配信されているので、ここでは何もしない
+                pass
+
+        # 討論が途中で失敗した場合も、購読者へ最終の応答を配信して終了する
+        session.start(run_debate, create_error_frame)
+
+    async for frame in session.subscribe():
+        await encoder.send(frame)
+
+
+async def run_debate_request(
+    encoder: FrameEncoder,
+    request: "ChatRequest",
+    messages: "Sequence[Message]",
+    speculation: "Speculation | None" = None,
+    *,
+    client_id: str | None = None,
+) -> None:
+    """討論を実行し、応答をクライアントへ送信する.
+
+    Args:
+        encoder: クライアントへの応答の送信処理
+        request: チャットリクエスト
+        messages: これまでの会話履歴
+        speculation: 下書きから先行して生成した初期応答
+        client_id: 失敗した討論を再開できるクライアントの識別子
+
+    Raises:
+        QuotaExceededError: 討論を開始すると使用量の上限を超える場合
+
+    """
+    if request.session_id is not None:
+        # 同じ討論を複数のクライアントで共有する
+        await stream_debate_session(
+            encoder, request, messages, speculation, client_id=client_id
+        )
+        return
+
+    reserve_debate_tokens(request, messages)
+
+    # コールバック関数を定義
+    async def send_update(
+        system: str, response: str, phase: str, route: str | None = None
+    ) -> None:
+        """討論モードでの更新をクライアントに送信."""
+        await encoder.send(create_frame(system, response, phase, route))
+
+    # 討論を含むストリーミングレスポンスを生成
+    async for _response in create_debate_responses(
+        request, messages, send_update, speculation, client_id=client_id
+    ):
+        # すでにコールバックで処理されているので、ここでは何もしない
+        pass
+
+
+async def respond_to_debate_request(  # noqa: PLR0913
+    websocket: WebSocket,
+    request: "ChatRequest",
+    messages: "Sequence[Message]",
+    speculation: "Speculation | None",
+    *,
+    client_id: str,
+    conversation_token: str | None,
+) -> None:
+    """討論を実行し、上限により断った場合も含めて応答をクライアントへ送信する.
+
+    Args:
+        websocket: クライアントとのWebSocket接続
+        request: チャットリクエスト
+        messages: これまでの会話履歴
+        speculation: 下書きから先行して生成した初期応答
+        client_id: リクエストしたクライアントの識別子
+        conversation_token: 新しい会話を開始した場合はその会話のトークン
+
+    """
+    encoder = create_frame_encoder(websocket, request)
+    if conversation_token is not None:
+        # 会話を続けるためのトークンは、この応答でのみ返す
+        frame = create_frame("conversation", "", "created")
+        frame["conversation_token"] = conversation_token
+        await encoder.send(frame)
+    with quota_scope(get_usage_quota(), client_id):
+        try:
+            await run_debate_request(
+                encoder, request, messages, speculation, client_id=client_id
+            )
+        except QuotaExceededError as e:
+            await encoder.send(create_rejection_frame(e))
+    await encoder.close()
+
+
 @app.websocket("/api/debate/ws")
 async def debate_websocket_endpoint(websocket: WebSocket) -> None:
     """討論モード用WebSocketエンドポイント."""
+    client_id = get_client_id(websocket)
+    if client_id is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
     await manager.connect(websocket)
+
+    # 接続の受け付けを優先し、モデルは受け付け後に読み込む
+    from nexus_magi.api_gen.codecs import decode_chat_request
+
+    # 下書きから先行して生成している初期応答
+    speculation: Speculation | None = None
     try:
         while True:
             # クライアントからのメッセージを待機
-            data = await websocket.receive_json()
+            data = await websocket.receive_text()
 
-            # ChatRequestの形式に変換
-            request = ChatRequest(**data)
-            messages = format_messages(request.messages)
+            # 辞書を経由せずにChatRequestの形式に変換
+            request = decode_chat_request(data)
+            try:
+                conversation_token = await open_conversation(
+                    request, create=not request.draft
+                )
+            except ConversationAccessError as e:
+                encoder = create_frame_encoder(websocket, request)
+                await encoder.send(create_frame("conversation", str(e), "rejected"))
+                await encoder.close()
+                continue
+            new_messages = format_messages(request.messages)
+            messages = await load_conversation(request, new_messages)
 
-            # グローバル設定を使用
-            api_base = api_config.api_base
-            model = api_config.model
-            api_type = api_config.api_type
+            if request.draft:
+                # 送信前の入力から初期応答の生成を先行して開始する
+                with quota_scope(get_usage_quota(), client_id):
+                    speculation = update_speculation(speculation, messages)
+                continue
 
-            # 討論モードはDebateChatModelを使用
-            chat_model = DebateChatModel(
-                api_base=api_base, model=model, api_type=api_type
+            # 送信された質問が下書きと異なる場合は先行生成を使用しない
+            if speculation is not None and not speculation.matches(messages):
+                speculation.cancel()
+                speculation = None
+
+            record_messages(request, new_messages)
+            await respond_to_debate_request(
+                websocket,
+                request,
+                messages,
+                speculation,
+                client_id=client_id,
+                conversation_token=conversation_token,
             )
 
-            # コールバック関数を定義
-            async def send_update(system: str, response: str, phase: str) -> None:
-                """討論モードでの更新をクライアントに送信."""
-                # OpenAPI生成モデルを使用してレスポンスを作成
-                response_data = WebSocketResponse(
-                    system=system,
-                    response=response,
-                    phase=phase,
-                )
-                # モデルをJSONに変換する際にEnumの値を取得するための辞書を作成
-                response_dict = {
-                    "system": response_data.system.value,
-                    "response": response_data.response,
-                    "phase": response_data.phase,
-                }
-                await websocket.send_json(response_dict)
-
-            # 討論を含むストリーミングレスポンスを生成
-            async for _response in chat_model.get_response_with_debate(
-                messages, send_update, debate_rounds=request.debate_rounds
-            ):
-                # すでにコールバックで処理されているので、ここでは何もしない
-                pass
+            # 使用されなかった先行生成を取り消す
+            if speculation is not None:
+                speculation.cancel()
+                speculation = None
 
     except WebSocketDisconnect:
         manager.disconnect(websocket)
+    finally:
+        if speculation is not None:
+            speculation.cancel()
 
 
 # アプリケーションを実行する関数
-def run_app(
+def run_app(  # noqa: PLR0913
     host: str = "127.0.0.1",
     port: int = 8000,
     api_base: str | None = None,
     model: str | None = None,
     api_type: str | None = None,
+    semantic_cache_threshold: float | None = None,
+    semantic_cache_size: int | None = None,
+    embedding_model: str | None = None,
+    cascade_model: str | None = None,
+    cascade_confidence_threshold: float | None = None,
+    personas_path: Path | None = None,
+    profile_dir: Path | None = None,
+    profile_sample_rate: float | None = None,
+    profile_token: str | None = None,
+    frame_flush_interval: float | None = None,
+    store_path: Path | None = None,
+    store_retention_days: float = 30.0,
+    batch_window: float | None = None,
+    batch_prompt_format: str = "chatml",
+    quota_tokens_per_minute: int | None = None,
+    quota_tokens_per_day: int | None = None,
+    quota_path: Path | None = None,
+    api_keys_path: Path | None = None,
+    *,
+    allow_anonymous: bool = False,
+    ws_compression: bool = True,
 ) -> None:
     """APIサーバーを実行する.
 
@@ -221,7 +1203,31 @@ def run_app(
         port: サーバーのポート
         api_base: LLM APIのベースURL
         model: 使用するモデル名
-        api_type: APIの種類("ollama"または"litellm")
+        api_type: APIの種類("ollama"、"litellm"または"litellm_sdk")
+        semantic_cache_threshold: 応答を再利用する類似度(Noneの場合は無効)
+        semantic_cache_size: キャッシュする質問数の上限
+        embedding_model: 埋め込みベクトルの取得に使うモデル名
+        cascade_model: カスケードモードで最初に回答する小さなモデル名
+        cascade_confidence_threshold: 小さなモデルの回答を採用する確信度
+        personas_path: 討論に参加するペルソナを定義したYAMLファイル
+        profile_dir: 討論のプロファイルを保存するディレクトリ(Noneの場合は無効)
+        profile_sample_rate: 全ての討論のうちプロファイルする割合
+        profile_token: リクエストごとにプロファイルを有効にする管理者用トークン
+        frame_flush_interval: 圧縮形式で応答をまとめて送信する間隔の秒数
+        store_path: 会話の記録を保存するSQLiteのファイル(Noneの場合は保存しない)
+        store_retention_days: 会話の記録を保持する日数
+        batch_window: 同じバックエンドへのプロンプトをまとめて送信する間隔の秒数
+            (Noneの場合はまとめない)
+        batch_prompt_format: まとめて送信するプロンプトの形式
+        quota_tokens_per_minute: クライアントが1分間に使用できるトークン数
+        quota_tokens_per_day: クライアントが1日に使用できるトークン数
+        quota_path: トークン使用量を保存するJSONファイル(Noneの場合は保存しない)
+        api_keys_path: 接続を許可するAPIキーを1行に1つずつ記載したファイル。
+            APIキーはX-API-Keyヘッダーでのみ受け付ける
+        allow_anonymous: APIキーを設定した場合に、APIキーを送信しない
+            ブラウザなどのクライアントの接続も許可するかどうか
+        ws_compression: Falseの場合、uvicornが既定で取り決める
+            WebSocketのpermessage-deflate拡張による圧縮を無効にする
 
     """
     import uvicorn
@@ -229,10 +1235,40 @@ def run_app(
     # グローバル設定を更新
     if api_base is not None:
         api_config.api_base = api_base
+    elif api_type == "litellm_sdk":
+        # LiteLLM SDKはモデル名からプロバイダの既定のURLを決定する
+        api_config.api_base = None
     if model is not None:
         api_config.model = model
     if api_type is not None:
         api_config.api_type = api_type
+    api_config.semantic_cache_threshold = semantic_cache_threshold
+    if semantic_cache_size is not None:
+        api_config.semantic_cache_size = semantic_cache_size
+    api_config.embedding_model = embedding_model
+    api_config.cascade_model = cascade_model
+    if cascade_confidence_threshold is not None:
+        api_config.cascade_confidence_threshold = cascade_confidence_threshold
+    api_config.personas_path = personas_path
+    if personas_path is not None:
+        # 設定ファイルの誤りはサーバーの起動前に検出する
+        get_persona_config()
+    api_config.profile_dir = profile_dir
+    if profile_sample_rate is not None:
+        api_config.profile_sample_rate = profile_sample_rate
+    api_config.profile_token = profile_token
+    if frame_flush_interval is not None:
+        api_config.frame_flush_interval = frame_flush_interval
+    api_config.store_path = store_path
+    api_config.store_retention_days = store_retention_days
+    configure_batching(batch_window, batch_prompt_format)
+    api_config.quota_tokens_per_minute = quota_tokens_per_minute
+    api_config.quota_tokens_per_day = quota_tokens_per_day
+    api_config.quota_path = quota_path
+    api_config.api_keys_path = api_keys_path
+    api_config.allow_anonymous = allow_anonymous
+    # APIキーのファイルの誤りはサーバーの起動前に検出する
+    get_api_keys()
 
     # サーバー起動
-    uvicorn.run(app, host=host, port=port)
+    uvicorn.run(app, host=host, port=port, ws_per_message_deflate=ws_compression)
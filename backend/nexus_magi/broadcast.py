@@ -0,0 +1,177 @@
+"""1つの討論の結果を複数のクライアントへ配信するモジュール."""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+# 終了したセッションを保持する秒数
+SESSION_RETENTION_SECONDS = 600.0
+
+# 保持するセッション数の上限
+MAX_SESSIONS = 256
+
+
+class DebateSession:
+    """名前付きの討論セッション.
+
+    討論は最初にメッセージを送ったクライアントのリクエストで1回だけ実行し、
+    生成された応答を全ての購読者へ配信する。途中から購読したクライアントには
+    それまでの応答を再送した上で、以降の応答を配信する。
+    """
+
+    def __init__(self, session_id: str) -> None:
+        """セッションを初期化.
+
+        Args:
+            session_id: セッションの名前
+
+        """
+        self.session_id = session_id
+        self.frames: list[dict[str, str]] = []
+        self.done = False
+        self.finished_at: float | None = None
+        self._subscribers: set[asyncio.Queue[dict[str, str] | None]] = set()
+        self._task: asyncio.Task[None] | None = None
+
+    @property
+    def started(self) -> bool:
+        """討論の実行を開始済みかどうか."""
+        return self._task is not None
+
+    @property
+    def subscriber_count(self) -> int:
+        """購読中のクライアント数."""
+        return len(self._subscribers)
+
+    def publish(self, frame: dict[str, str]) -> None:
+        """応答を記録し、全ての購読者へ配信する.
+
+        Args:
+            frame: クライアントへ送信する応答
+
+        """
+        self.frames.append(frame)
+        for queue in self._subscribers:
+            queue.put_nowait(frame)
+
+    def finish(self) -> None:
+        """セッションを終了し、購読者へ終了を通知する."""
+        self.done = True
+        self.finished_at = time.monotonic()
+        for queue in self._subscribers:
+            queue.put_nowait(None)
+
+    def start(
+        self,
+        run: Callable[[], Awaitable[None]],
+        error_frame: Callable[[Exception], dict[str, str]] | None = None,
+    ) -> None:
+        """討論の実行を開始する.
+
+        討論はクライアントの接続とは独立したタスクで実行するため、
+        開始したクライアントが切断しても他の購読者への配信は続く。
+        討論が失敗した場合は、失敗を伝える応答を配信してからセッションを終了する。
+
+        Args:
+            run: 討論を実行し、応答をpublishする関数
+            error_frame: 討論が失敗した場合に配信する応答を例外から作成する関数
+
+        """
+
+        async def run_session() -> None:
+            try:
+                await run()
+            except Exception as e:
+                logger.exception(
+                    "討論セッションの実行に失敗しました: %s", self.session_id
+                )
+                if error_frame is not None:
+                    self.publish(error_frame(e))
+            finally:
+                self.finish()
+
+        self._task = asyncio.create_task(run_session())
+
+    async def subscribe(self) -> AsyncIterator[dict[str, str]]:
+        """これまでの応答を再送し、以降の応答をセッションの終了まで返す.
+
+        Yields:
+            dict: クライアントへ送信する応答
+
+        """
+        # 再送する応答と配信される応答の間に抜けや重複が無いよう、
+        # 待機せずに購読の登録と再送する応答の取得を行う
+        queue: asyncio.Queue[dict[str, str] | None] = asyncio.Queue()
+        replay = list(self.frames)
+        done = self.done
+        self._subscribers.add(queue)
+        try:
+            for frame in replay:
+                yield frame
+            if done:
+                return
+            while (frame := await queue.get()) is not None:
+                yield frame
+        finally:
+            self._subscribers.discard(queue)
+
+
+class SessionRegistry:
+    """名前付きの討論セッションを管理するクラス."""
+
+    def __init__(
+        self,
+        retention_seconds: float = SESSION_RETENTION_SECONDS,
+        max_sessions: int = MAX_SESSIONS,
+    ) -> None:
+        """セッション管理を初期化.
+
+        Args:
+            retention_seconds: 終了したセッションを保持する秒数
+            max_sessions: 保持するセッション数の上限
+
+        """
+        self.retention_seconds = retention_seconds
+        self.max_sessions = max_sessions
+        self._sessions: OrderedDict[str, DebateSession] = OrderedDict()
+
+    def get_or_create(self, session_id: str) -> DebateSession:
+        """セッションを取得し、存在しなければ作成する.
+
+        Args:
+            session_id: セッションの名前
+
+        Returns:
+            DebateSession: 討論セッション
+
+        """
+        self._expire()
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = DebateSession(session_id)
+            self._sessions[session_id] = session
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def _expire(self) -> None:
+        """保持期間を過ぎたセッションと、上限を超えた古い終了済みセッションを破棄する."""
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            if (
+                session.finished_at is not None
+                and now - session.finished_at > self.retention_seconds
+            ):
+                del self._sessions[session_id]
+
+        # 実行中のセッションと、討論の開始を待つ購読者がいるセッションは破棄しない
+        excess = len(self._sessions) - self.max_sessions
+        for session_id, session in list(self._sessions.items()):
+            if excess <= 0:
+                break
+            if session.done or (not session.started and session.subscriber_count == 0):
+                del self._sessions[session_id]
+                excess -= 1
@@ -0,0 +1,224 @@
+"""小さなモデルで回答できない質問だけを討論に回すカスケードのモジュール."""
+
+import re
+import time
+from collections.abc import AsyncGenerator, Callable, Sequence
+from typing import TYPE_CHECKING
+
+from nexus_magi.debate_chat_model import DebateChatModel
+from nexus_magi.llm_client import LLMClient, is_error_response
+from nexus_magi.message_history import Message
+
+if TYPE_CHECKING:
+    from nexus_magi.personas import PersonaConfig
+    from nexus_magi.semantic_cache import SemanticCache
+    from nexus_magi.speculation import Speculation
+
+# 小さなモデルの回答をそのまま採用する確信度の既定値
+DEFAULT_CONFIDENCE_THRESHOLD = 0.8
+
+# 小さなモデルの回答の生成トークン数の上限
+# 使用量の見積もりに含めるため、討論の前の呼び出しにも上限を設ける
+DIRECT_MAX_TOKENS = 1024
+
+# 小さなモデルに回答と確信度を求めるシステムプロンプト
+CASCADE_SYSTEM_PROMPT = (
+    "ユーザーの質問に簡潔に回答してください。"
+    "回答の最後の行には、回答が正確で十分であることへの確信度を0から100の整数で"
+    "「確信度: 数値」の形式で必ず記載してください。"
+    "専門的な判断、倫理的な判断、複数の観点からの検討が必要な質問では"
+    "確信度を低くしてください。"
+)
+
+# 回答から確信度を取り出す正規表現
+# 全角のコロンや強調の記号が付いた場合も読み取る
+CONFIDENCE_PATTERN = re.compile(
+    r"^[\s*]*確信度[\s*]*[:\uff1a][\s*]*(\d+(?:\.\d+)?)\s*%?[\s*]*$", re.MULTILINE
+)
+
+# 確信度の最大値
+MAX_CONFIDENCE = 100.0
+
+
+def parse_confidence(response: str) -> tuple[str, float | None]:
+    """小さなモデルの回答から確信度を取り出す.
+
+    Args:
+        response: 小さなモデルの回答
+
+    Returns:
+        tuple[str, float | None]: 確信度の行を除いた回答と、0から1の確信度
+            (記載が無い場合はNone)
+
+    """
+    matches = list(CONFIDENCE_PATTERN.finditer(response))
+    if not matches:
+        return response.strip(), None
+    match = matches[-1]
+    answer = (response[: match.start()] + response[match.end() :]).strip()
+    confidence = min(float(match.group(1)), MAX_CONFIDENCE) / MAX_CONFIDENCE
+    return answer, confidence
+
+
+class CascadeChatModel:
+    """小さなモデルが先に回答し、難しい質問だけを討論に回すチャットモデル.
+
+    小さなモデルは回答と同時に自己評価した確信度を返す。確信度が閾値以上であれば
+    その回答を採用し、閾値未満または確信度が読み取れない場合は討論を行う。
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        api_base: str | None = "http://localhost:11434/api",
+        model: str = "phi4-mini",
+        api_type: str = "ollama",
+        cascade_model: str | None = None,
+        confidence_threshold: float = DEFAULT_CONFIDENCE_THRESHOLD,
+        semantic_cache: "SemanticCache | None" = None,
+        persona_config: "PersonaConfig | None" = None,
+        speculation: "Speculation | None" = None,
+        checkpoint_owner: str | None = None,
+    ) -> None:
+        """チャットモデルを初期化.
+
+        Args:
+            api_base: APIサーバーのベースURL
+            model: 討論に使用するモデル名
+            api_type: APIの種類("ollama"、"litellm" または "litellm_sdk")
+            cascade_model: 最初に回答する小さなモデル名(Noneの場合はmodelと同じ)
+            confidence_threshold: 小さなモデルの回答を採用する確信度(0から1)
+            semantic_cache: 討論の最終結果を再利用するセマンティックキャッシュ
+            persona_config: 討論に参加するペルソナ構成
+            speculation: 下書きから先行して生成した討論の初期応答
+            checkpoint_owner: 失敗した討論を再開できるクライアントの識別子
+
+        """
+        self.confidence_threshold = confidence_threshold
+        self.client = LLMClient(
+            api_base=api_base, model=cascade_model or model, api_type=api_type
+        )
+        self.debate_model = DebateChatModel(
+            api_base=api_base,
+            model=model,
+            api_type=api_type,
+            semantic_cache=semantic_cache,
+            persona_config=persona_config,
+            speculation=speculation,
+            checkpoint_owner=checkpoint_owner,
+        )
+
+    def _create_direct_messages(self, messages: Sequence[Message]) -> list[Message]:
+        """小さなモデルに回答と確信度を求めるメッセージを作成する.
+
+        Args:
+            messages: これまでの会話履歴
+
+        Returns:
+            list[Message]: 小さなモデルに送信するメッセージ
+
+        """
+        return [
+            {"role": "system", "content": CASCADE_SYSTEM_PROMPT},
+            *(msg for msg in messages if msg["role"] != "system"),
+        ]
+
+    def estimate_tokens(
+        self, messages: Sequence[Message], debate_rounds: int = 1
+    ) -> int:
+        """小さなモデルの回答と討論で使用するトークン数を見積もる.
+
+        小さなモデルが回答できるかは呼び出すまで分からないため、
+        常に討論まで行うものとして見積もる。
+
+        Args:
+            messages: これまでの会話履歴
+            debate_rounds: 討論のラウンド数
+
+        Returns:
+            int: 見積もったトークン数
+
+        """
+        from nexus_magi.usage_quota import estimate_tokens
+
+        direct_tokens = sum(
+            estimate_tokens(msg["content"])
+            for msg in self._create_direct_messages(messages)
+        )
+        return (
+            direct_tokens
+            + DIRECT_MAX_TOKENS
+            + self.debate_model.estimate_tokens(messages, debate_rounds)
+        )
+
+    async def _get_direct_response(
+        self, messages: Sequence[Message]
+    ) -> tuple[str, float | None]:
+        """小さなモデルから回答と確信度を取得する.
+
+        Args:
+            messages: これまでの会話履歴
+
+        Returns:
+            tuple[str, float | None]: 回答と確信度(取得できない場合はNone)
+
+        """
+        response = await self.client.call(
+            self._create_direct_messages(messages), DIRECT_MAX_TOKENS
+        )
+        if is_error_response(response):
+            return response, None
+        return parse_confidence(response)
+
+    async def get_response_with_cascade(
+        self,
+        messages: Sequence[Message],
+        callback: Callable[[str, str, str, str], None] | None = None,
+        debate_rounds: int = 1,
+        deadline_ms: int | None = None,
+        *,
+        structured_verdicts: bool = False,
+    ) -> AsyncGenerator[dict[str, str], None]:
+        """小さなモデルの確信度に応じて、直接回答するか討論を行う.
+
+        Args:
+            messages: これまでの会話履歴
+            callback: システム、応答、フェーズ、経路を受け取るコールバック関数
+            debate_rounds: 討論を行う場合のラウンド数
+            deadline_ms: 応答までの制限時間(ミリ秒、指定しない場合はNone)
+            structured_verdicts: 討論を行う場合に判定の多数決で合議するかどうか
+
+        Yields:
+            dict: 応答状態の更新(経路を"route"に含む)
+
+        """
+        start = time.monotonic()
+        answer, confidence = await self._get_direct_response(messages)
+
+        if confidence is not None and confidence >= self.confidence_threshold:
+            if callback:
+                await callback("consensus", answer, "final", "direct")
+            yield {
+                "system": "consensus",
+                "response": answer,
+                "phase": "final",
+                "route": "direct",
+            }
+            return
+
+        # 小さなモデルの呼び出しにかかった時間を制限時間から差し引く
+        if deadline_ms is not None:
+            elapsed_ms = int((time.monotonic() - start) * 1000)
+            deadline_ms = max(deadline_ms - elapsed_ms, 0)
+
+        async def send_debate_update(system: str, response: str, phase: str) -> None:
+            if callback:
+                await callback(system, response, phase, "debate")
+
+        async for update in self.debate_model.get_response_with_debate(
+            messages,
+            send_debate_update,
+            debate_rounds=debate_rounds,
+            deadline_ms=deadline_ms,
+            structured_verdicts=structured_verdicts,
+        ):
+            yield {**update, "route": "debate"}
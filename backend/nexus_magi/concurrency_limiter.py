@@ -0,0 +1,276 @@
+"""LLM APIの同時呼び出し数を応答時間から自動で調整するモジュール.
+
+TCP Vegasと同様に、負荷の無い状態の応答時間を基準として、実測した応答時間との比から
+バックエンドの待ち行列の長さを推定する。待ち行列が短い間は同時呼び出し数を1ずつ増やし、
+待ち行列が長くなった場合や、サーバーエラー・タイムアウトが発生した場合は乗算的に減らす。
+
+LLMの応答時間は生成トークン数に比例するため、トークン数が分かる場合は
+1トークンあたりの時間を応答時間として扱う。
+
+投機的な呼び出しは通常の呼び出しが待っておらず、通常の呼び出し用に空きを残せる
+場合のみ実行するため、通常の呼び出しを待たせることはない。
+"""
+
+import asyncio
+import math
+import threading
+from collections import deque
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+# 同時呼び出し数の初期値と範囲
+DEFAULT_INITIAL_LIMIT = 4
+DEFAULT_MIN_LIMIT = 1
+DEFAULT_MAX_LIMIT = 64
+
+# 応答時間が伸びた場合と、エラーが発生した場合に同時呼び出し数へ掛ける係数
+LATENCY_BACKOFF_RATIO = 0.9
+FAILURE_BACKOFF_RATIO = 0.5
+
+# 基準の応答時間を測り直すまでの計測回数
+# モデルの切り替えなどで負荷の無い状態の応答時間が変わっても追従できるようにする
+BASELINE_RESET_SAMPLES = 500
+
+# 投機的な呼び出しを実行する場合に、通常の呼び出し用に残しておく枠の数
+SPECULATIVE_RESERVED_SLOTS = 1
+
+
+@dataclass
+class LimiterStats:
+    """同時呼び出し数の制御状態."""
+
+    limit: int
+    inflight: int
+    waiting: int
+    # 負荷の無い状態の応答時間(1トークンあたりの秒数、計測前はNone)
+    baseline_seconds: float | None
+
+
+class AdaptiveConcurrencyLimiter:
+    """応答時間に応じて同時呼び出し数の上限を調整するクラス.
+
+    枠の取得と解放はイベントループ内で行い、計測値の記録はスレッドプールからも
+    行われるため、上限と枠の状態の更新はロックで保護する。
+    待機中の呼び出しはイベントループ上で再開する。
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = DEFAULT_INITIAL_LIMIT,
+        min_limit: int = DEFAULT_MIN_LIMIT,
+        max_limit: int = DEFAULT_MAX_LIMIT,
+    ) -> None:
+        """制御を初期化.
+
+        Args:
+            initial_limit: 同時呼び出し数の初期値
+            min_limit: 同時呼び出し数の下限
+            max_limit: 同時呼び出し数の上限
+
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._limit = float(initial_limit)
+        self._inflight = 0
+        self._waiters: deque[asyncio.Future[None]] = deque()
+        self._speculative_waiters: deque[asyncio.Future[None]] = deque()
+        self._baseline: dict[str, float] = {}
+        self._samples = 0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self) -> int:
+        """現在の同時呼び出し数の上限."""
+        return max(int(self._limit), self.min_limit)
+
+    def get_stats(self) -> LimiterStats:
+        """現在の制御状態を取得する.
+
+        Returns:
+            LimiterStats: 制御状態
+
+        """
+        with self._lock:
+            return LimiterStats(
+                limit=self.limit,
+                inflight=self._inflight,
+                waiting=len(self._waiters) + len(self._speculative_waiters),
+                baseline_seconds=self._baseline.get(
+                    "token", self._baseline.get("request")
+                ),
+            )
+
+    @asynccontextmanager
+    async def acquire(self, *, speculative: bool = False) -> AsyncIterator[None]:
+        """同時呼び出しの枠を取得し、終了時に解放する.
+
+        Args:
+            speculative: 投機的な呼び出しかどうか。投機的な呼び出しは通常の呼び出しが
+                全て枠を取得した後、空きが残っている場合のみ枠を取得する
+
+        Yields:
+            None: 枠を取得した状態
+
+        """
+        waiters = self._speculative_waiters if speculative else self._waiters
+        waiter: asyncio.Future[None] | None = None
+        with self._lock:
+            if self._can_start(speculative=speculative):
+                self._inflight += 1
+            else:
+                waiter = asyncio.get_running_loop().create_future()
+                waiters.append(waiter)
+        if waiter is not None:
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._lock:
+                    queued = waiter in waiters
+                    if queued:
+                        waiters.remove(waiter)
+                # 枠を割り当てた後に取り消された場合は次の待機者に譲る。
+                # Futureの完了前に取り消された場合は_resolveで譲る
+                if not queued and not waiter.cancelled():
+                    self._release()
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _can_start(self, *, speculative: bool) -> bool:
+        """待たずに枠を取得できるかどうかを判定する.
+
+        ロックを取得した状態で呼び出す。
+
+        Args:
+            speculative: 投機的な呼び出しかどうか
+
+        Returns:
+            bool: 枠を取得できる場合はTrue
+
+        """
+        if self._waiters:
+            return False
+        if speculative:
+            return self._inflight + SPECULATIVE_RESERVED_SLOTS < self.limit
+        return self._inflight < self.limit
+
+    def _release(self) -> None:
+        """枠を解放し、上限に空きがあれば待機中の呼び出しを再開する."""
+        with self._lock:
+            self._inflight -= 1
+            self._notify_waiters()
+
+    def _notify_waiters(self) -> None:
+        """上限の空きの数だけ待機中の呼び出しに枠を割り当てて再開する.
+
+        通常の呼び出しを優先して再開し、投機的な呼び出しは通常の呼び出しの
+        待機が無くなった後に再開する。ロックを取得した状態で呼び出す。
+        """
+        limit = self.limit
+        while self._waiters and self._inflight < limit:
+            self._wake(self._waiters.popleft())
+        while (
+            not self._waiters
+            and self._speculative_waiters
+            and self._inflight + SPECULATIVE_RESERVED_SLOTS < limit
+        ):
+            self._wake(self._speculative_waiters.popleft())
+
+    def _wake(self, waiter: asyncio.Future[None]) -> None:
+        """待機中の呼び出しに枠を割り当てて再開する.
+
+        Args:
+            waiter: 待機中の呼び出しのFuture
+
+        """
+        if not waiter.done():
+            self._inflight += 1
+            # スレッドプールから呼び出された場合も、Futureはイベントループ上で完了させる
+            waiter.get_loop().call_soon_threadsafe(self._resolve, waiter)
+
+    def _resolve(self, waiter: asyncio.Future[None]) -> None:
+        """枠を割り当てた待機中の呼び出しを再開する.
+
+        Args:
+            waiter: 待機中の呼び出しのFuture
+
+        """
+        if waiter.done():
+            # 枠を割り当てた後、再開する前に取り消された場合は次の待機者に譲る
+            self._release()
+        else:
+            waiter.set_result(None)
+
+    def record_latency(
+        self, elapsed_seconds: float, completion_tokens: int | None = None
+    ) -> None:
+        """成功した呼び出しの応答時間を記録し、上限を調整する.
+
+        Args:
+            elapsed_seconds: 呼び出し全体にかかった時間
+            completion_tokens: 生成されたトークン数(不明な場合はNone)
+
+        """
+        if completion_tokens:
+            unit, sample = "token", elapsed_seconds / completion_tokens
+        else:
+            unit, sample = "request", elapsed_seconds
+        if sample <= 0:
+            return
+
+        with self._lock:
+            self._samples += 1
+            if self._samples % BASELINE_RESET_SAMPLES == 0:
+                self._baseline[unit] = sample
+            baseline = min(self._baseline.get(unit, sample), sample)
+            self._baseline[unit] = baseline
+
+            # 基準との比から、バックエンドで待たされている呼び出し数を推定する
+            queue = self._limit * (1 - baseline / sample)
+            log_limit = math.log10(max(self._limit, 1.0))
+            alpha = max(3 * log_limit, 1.0)
+            beta = max(6 * log_limit, 2.0)
+            if queue > beta:
+                self._limit = max(self._limit * LATENCY_BACKOFF_RATIO, self.min_limit)
+            elif queue < alpha and self._inflight * 2 >= self.limit:
+                # 上限近くまで使われている場合のみ増やす
+                self._limit = min(self._limit + 1, self.max_limit)
+                # 増やした枠の数だけ、解放を待たずに待機中の呼び出しを再開する
+                self._notify_waiters()
+
+    def record_failure(self) -> None:
+        """サーバーエラーやタイムアウトを記録し、上限を乗算的に減らす."""
+        with self._lock:
+            self._limit = max(self._limit * FAILURE_BACKOFF_RATIO, self.min_limit)
+
+
+# バックエンドごとに共有する制御
+_limiters: dict[str, AdaptiveConcurrencyLimiter] = {}
+
+
+def get_limiter(backend: str) -> AdaptiveConcurrencyLimiter:
+    """バックエンドの同時呼び出し数の制御を取得する.
+
+    Args:
+        backend: バックエンドを識別する名前
+
+    Returns:
+        AdaptiveConcurrencyLimiter: 同じバックエンドで共有する制御
+
+    """
+    if backend not in _limiters:
+        _limiters[backend] = AdaptiveConcurrencyLimiter()
+    return _limiters[backend]
+
+
+def get_all_limiters() -> dict[str, AdaptiveConcurrencyLimiter]:
+    """全てのバックエンドの同時呼び出し数の制御を取得する.
+
+    Returns:
+        dict[str, AdaptiveConcurrencyLimiter]: バックエンド名ごとの制御
+
+    """
+    return dict(_limiters)
@@ -1,189 +1,265 @@
 """討論モード対話を管理するモジュール."""
 
 import asyncio
+import difflib
+import hashlib
 import json
-from collections.abc import AsyncGenerator, Callable
-from enum import Enum
-from typing import Any
+import uuid
+from collections import OrderedDict
+from collections.abc import AsyncGenerator, Awaitable, Callable, Mapping, Sequence
+from dataclasses import asdict, dataclass
+from typing import TYPE_CHECKING, Annotated, Any, TypedDict
 
-import requests
+from nexus_magi.latency_estimator import latency_estimator
+from nexus_magi.llm_client import LLMClient, is_error_response
+from nexus_magi.message_history import Message, MessageHistory, as_history
+from nexus_magi.personas import Persona, PersonaConfig, split_into_groups
+from nexus_magi.verdict import (
+    VERDICT_INSTRUCTION,
+    Verdict,
+    format_verdict,
+    parse_verdict,
+    tally_verdicts,
+)
 
-# HTTPステータスコード
-HTTP_OK = 200
+if TYPE_CHECKING:
+    from langgraph.runtime import Runtime
 
+    from nexus_magi.semantic_cache import SemanticCache
+    from nexus_magi.speculation import Speculation
 
-class MagiSystem(Enum):
-    """MAGIシステムの種類を表す列挙型."""
+# 非同期討論モードで収束したとみなす前回応答との類似度
+CONVERGENCE_THRESHOLD = 0.9
 
-    MELCHIOR = "melchior"
-    BALTHASAR = "balthasar"
-    CASPER = "casper"
+# 他システムの見解がまだ無い場合に討論プロンプトへ埋め込む文言
+PENDING_RESPONSE = "(まだ見解を述べていません)"
 
+# チェックポイントを保持する討論の最大数
+MAX_DEBATE_CHECKPOINTS = 128
 
-class MagiPersonality(Enum):
-    """MAGIシステムの個性を表す列挙型."""
+# 制限時間のうち、推定に基づく計画で使用する割合(推定誤差への余裕)
+DEADLINE_SAFETY_RATIO = 0.9
 
-    MELCHIOR = "科学者: 論理的・分析的に考えるシステム"
-    BALTHASAR = "母親: 共感的・感情的に考えるシステム"
-    CASPER = "女性: 直感的・創造的に考えるシステム"
+# 制限時間に合わせて生成長を制限する場合の最小トークン数
+MIN_PLANNED_TOKENS = 32
+
+# 制限時間内に合議が完了しなかった場合の最終判断
+DEADLINE_EXCEEDED_RESPONSE = (
+    "制限時間内に合議が完了しなかったため、"
+    "各システムの最新の見解を最終判断の代わりとします。"
+)
+
+# 討論のフェーズが失敗した場合に最終判断の後に続ける文言
+DEBATE_RETRY_NOTE = "(同じ条件で再試行すると、最後に完了したフェーズから再開します)"
+
+
+class DebatePhaseError(Exception):
+    """討論グラフのフェーズでLLM APIの呼び出しが失敗したことを表す例外.
+
+    ノードから送出することで、失敗したフェーズをチェックポイントに保存せず、
+    再試行時にそのフェーズから再開できるようにする。
+    """
+
+
+@dataclass
+class DebatePlan:
+    """制限時間に合わせて決定した討論の実行計画."""
+
+    # 実行する討論ラウンド数(0の場合は討論を省略する)
+    debate_rounds: int
+    # 各MAGIシステムの応答の生成トークン数の上限
+    max_tokens: int | None = None
+    # 合議の応答の生成トークン数の上限
+    consensus_max_tokens: int | None = None
+    # 最終フェーズで構造化された判定を求め、多数決で合議するかどうか
+    structured: bool = False
+
+
+def _merge_responses(left: dict[str, str], right: dict[str, str]) -> dict[str, str]:
+    """並列分岐から書き込まれた各システムの応答をまとめる."""
+    return {**left, **right}
+
+
+def _append_frames(
+    left: list[dict[str, str]], right: list[dict[str, str]]
+) -> list[dict[str, str]]:
+    """並列分岐から書き込まれた送信済みの応答を追記する."""
+    return left + right
+
+
+class DebateState(TypedDict):
+    """討論グラフの状態."""
+
+    debate_rounds: int
+    completed_rounds: int
+    max_tokens: int | None
+    consensus_max_tokens: int | None
+    structured: bool
+    # 各システムの最新の応答を保持する
+    responses: Annotated[dict[str, str], _merge_responses]
+    # 構造化モードで各システムが最終フェーズに返した判定を保持する
+    verdicts: Annotated[dict[str, dict[str, Any] | None], _merge_responses]
+    # クライアントへ送信した応答を保持し、再開時の再送に使用する
+    frames: Annotated[list[dict[str, str]], _append_frames]
+
+
+@dataclass
+class DebateContext:
+    """討論グラフの実行時に各ノードへ渡す値.
+
+    会話履歴はチェックポイントに保存すると討論ごとに複製されるため、
+    状態には含めずに実行時に渡す。
+    """
+
+    messages: MessageHistory
+
+
+# 討論グラフのチェックポイント保存先はプロセス内で共有する
+# メモリ上にのみ保存するため、サーバーを再起動するとチェックポイントは失われる
+_debate_checkpointer: Any = None
+_debate_threads: OrderedDict[str, None] = OrderedDict()
+# 実行中の討論のスレッドID
+_active_debate_threads: set[str] = set()
+
+
+def _get_debate_checkpointer() -> Any:  # noqa: ANN401
+    """討論グラフで共有する、メモリ上のチェックポイント保存先を取得する."""
+    global _debate_checkpointer  # noqa: PLW0603
+    if _debate_checkpointer is None:
+        from langgraph.checkpoint.memory import MemorySaver
+
+        _debate_checkpointer = MemorySaver()
+    return _debate_checkpointer
+
+
+def _remember_debate_thread(thread_id: str) -> None:
+    """討論のスレッドIDを記録し、古いチェックポイントを破棄する."""
+    _debate_threads[thread_id] = None
+    _debate_threads.move_to_end(thread_id)
+    # 実行中の討論のチェックポイントは破棄しない
+    for old_thread_id in list(_debate_threads):
+        if len(_debate_threads) <= MAX_DEBATE_CHECKPOINTS:
+            break
+        if old_thread_id not in _active_debate_threads:
+            _forget_debate_thread(old_thread_id)
+
+
+def _forget_debate_thread(thread_id: str) -> None:
+    """完了した討論のチェックポイントを破棄する."""
+    _debate_threads.pop(thread_id, None)
+    _get_debate_checkpointer().delete_thread(thread_id)
+
+
+def _raise_for_error(response: str) -> None:
+    """LLM APIの呼び出しが失敗した応答であれば例外を送出する.
+
+    Args:
+        response: LLM APIの呼び出しの結果
+
+    Raises:
+        DebatePhaseError: 呼び出しが失敗した応答の場合
+
+    """
+    if is_error_response(response):
+        raise DebatePhaseError(response)
 
 
 class DebateChatModel:
     """討論モードのチャットモデルを管理するクラス."""
 
-    def __init__(
+    def __init__(  # noqa: PLR0913
         self,
-        api_base: str = "http://localhost:11434/api",
+        api_base: str | None = "http://localhost:11434/api",
         model: str = "phi4-mini",
         api_type: str = "ollama",
+        semantic_cache: "SemanticCache | None" = None,
+        persona_config: PersonaConfig | None = None,
+        speculation: "Speculation | None" = None,
+        checkpoint_owner: str | None = None,
     ) -> None:
         """チャットモデルを初期化.
 
         Args:
             api_base: APIサーバーのベースURL
             model: 使用するモデル名
-            api_type: APIの種類("ollama" または "litellm")
+            api_type: APIの種類("ollama"、"litellm" または "litellm_sdk")
+            semantic_cache: 最終結果を再利用するセマンティックキャッシュ
+            persona_config: 討論に参加するペルソナ構成(Noneの場合はMAGIの3システム)
+            speculation: 下書きから先行して生成した初期応答(初期応答に使用する)
+            checkpoint_owner: 失敗した討論を再開できるクライアントの識別子。
+                他のクライアントとはチェックポイントを共有しない
 
         """
         self.api_base = api_base
         self.model = model
         self.api_type = api_type
+        self.client = LLMClient(api_base=api_base, model=model, api_type=api_type)
+        self.semantic_cache = semantic_cache
+        self.persona_config = persona_config or PersonaConfig()
+        self.personas = self.persona_config.personas
+        self.speculation = speculation
+        self.checkpoint_owner = checkpoint_owner
+        self._debate_graph: Any = None
 
-    def _add_system_instructions(
-        self, messages: list[dict[str, str]], magi_type: MagiSystem
-    ) -> list[dict[str, str]]:
-        """各MAGIシステムの特性に合わせたシステムプロンプトを追加する.
-
-        Args:
-            messages: 元のメッセージリスト
-            magi_type: MAGIシステムの種類
-
-        Returns:
-            list[dict[str, str]]: システムプロンプトを追加したメッセージリスト
-
-        """
-        # メッセージのコピーを作成
-        new_messages = messages.copy()
-
-        # システム指示を作成
-        personality = MagiPersonality[magi_type.name].value
-
-        # システムメッセージがあれば更新、なければ追加
-        system_msg_found = False
-        for i, msg in enumerate(new_messages):
-            if msg["role"] == "system":
-                new_messages[i] = {
-                    "role": "system",
-                    "content": (
-                        f"あなたはMAGIシステムの{magi_type.value}です。"
-                        f"{personality}として回答してください。"
-                    ),
-                }
-                system_msg_found = True
-                break
-
-        if not system_msg_found:
-            # 先頭にシステムメッセージを追加
-            new_messages.insert(
-                0,
-                {
-                    "role": "system",
-                    "content": (
-                        f"あなたはMAGIシステムの{magi_type.value}です。"
-                        f"{personality}として回答してください。"
-                    ),
-                },
-            )
-
-        return new_messages
+    def start_speculation(self, messages: Sequence[Message]) -> "Speculation":
+        """下書きの質問に対する各ペルソナの初期応答の生成を先行して開始する.
 
-    def _call_ollama_api(self, messages: list[dict[str, str]]) -> str:
-        """OllamaのAPIを呼び出して応答を取得する.
+        先行生成は同時呼び出しの枠に空きがある場合のみ実行し、
+        通常のリクエストの呼び出しを待たせない。
 
         Args:
-            messages: これまでの会話履歴
+            messages: 最後のメッセージを下書きとした会話履歴
 
         Returns:
-            str: LLMからの応答
+            Speculation: 先行生成の状態
 
         """
-        # Ollamaの場合、会話履歴を整形する
-        formatted_messages = [
-            {"role": msg["role"], "content": msg["content"]} for msg in messages
-        ]
-
-        # APIリクエストを送信する
-        response = requests.post(
-            f"{self.api_base}/chat",
-            json={
-                "model": self.model,
-                "messages": formatted_messages,
-                "stream": False,
-            },
-            timeout=60,
-        )
-
-        if response.status_code != HTTP_OK:
-            return f"エラーが発生しました: {response.status_code} - {response.text}"
+        from nexus_magi.speculation import Speculation
+
+        messages = as_history(messages)
+        speculation = Speculation(messages)
+        for persona in self.personas:
+            speculation.start(
+                persona.id,
+                self.client.call(
+                    self._add_system_instructions(messages, persona), speculative=True
+                ),
+            )
+        return speculation
 
-        try:
-            result = response.json()
-            # Ollamaの応答形式に合わせてパースする
-            # Ollamaの応答は {"message": {"content": "応答テキスト"}} 形式
-            return result["message"]["content"]
-        except (KeyError, json.JSONDecodeError) as e:
-            return f"応答の解析に失敗しました: {e!s}"
+    def _add_system_instructions(
+        self, messages: Sequence[Message], persona: Persona
+    ) -> MessageHistory:
+        """各ペルソナの特性に合わせたシステムプロンプトを追加する.
 
-    def _call_litellm_api(self, messages: list[dict[str, str]]) -> str:
-        """LiteLLMのAPIを呼び出して応答を取得する.
+        会話履歴は複製せず、システムプロンプトだけを差し替えた見え方を作成する。
 
         Args:
-            messages: これまでの会話履歴
+            messages: 元のメッセージリスト
+            persona: ペルソナ
 
         Returns:
-            str: LLMからの応答
+            MessageHistory: システムプロンプトを追加したメッセージリスト
 
         """
-        # LiteLLMの場合、会話履歴を整形する
-        formatted_messages = [
-            {"role": msg["role"], "content": msg["content"]} for msg in messages
-        ]
-
-        # APIリクエストを送信する
-        response = requests.post(
-            f"{self.api_base}/chat/completions",
-            json={
-                "model": self.model,
-                "messages": formatted_messages,
-                "stream": False,
-            },
-            timeout=60,
-        )
-
-        if response.status_code != HTTP_OK:
-            return f"エラーが発生しました: {response.status_code} - {response.text}"
+        return as_history(messages).with_system(persona.system_prompt)
 
-        try:
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
-        except (KeyError, json.JSONDecodeError) as e:
-            return f"応答の解析に失敗しました: {e!s}"
-
-    def _call_api(self, messages: list[dict[str, Any]]) -> str:
-        """APIタイプに応じて適切なAPI呼び出しを行う.
+    def _add_verdict_instruction(
+        self, messages: Sequence[Message | Mapping[str, str]]
+    ) -> MessageHistory:
+        """判定をJSONで返すように求める指示をシステムプロンプトに追加する.
 
         Args:
-            messages: メッセージリスト
+            messages: 先頭にシステムメッセージを含むメッセージリスト
 
         Returns:
-            str: API呼び出しの結果
+            MessageHistory: 指示を追加したメッセージリスト
 
         """
-        if self.api_type == "ollama":
-            return self._call_ollama_api(messages)
-        return self._call_litellm_api(messages)
+        history = as_history(messages)
+        return history.with_system(f"{history[0].content}{VERDICT_INSTRUCTION}")
 
-    async def get_response(self, messages: list[dict[str, str]]) -> str:
+    async def get_response(self, messages: Sequence[Message]) -> str:
         """会話履歴を元に次の応答を生成する.
 
         Args:
@@ -202,316 +278,1155 @@ class DebateChatModel:
         # 最終的な合議結果を返す
         return final_response or "応答の生成に失敗しました"
 
-    async def _get_magi_debate_response(
+    async def _get_magi_debate_response(  # noqa: PLR0913
         self,
-        magi_type: MagiSystem,
-        magi_personality: MagiPersonality,
+        persona: Persona,
+        question: Message,
         debate_prompt: str,
         callback: Callable[[str, str, str], None] | None,
         phase: str,
+        max_tokens: int | None = None,
+        *,
+        json_mode: bool = False,
     ) -> str:
-        """特定のMAGIシステムの討論応答を取得する.
+        """特定のペルソナの討論応答を取得する.
 
         Args:
-            magi_type: MAGIシステムの種類
-            magi_personality: MAGIシステムの個性
+            persona: ペルソナ
+            question: ユーザーの質問のメッセージ
             debate_prompt: 討論用のプロンプト
             callback: コールバック関数
             phase: 現在のフェーズ
+            max_tokens: 生成トークン数の上限(指定しない場合はNone)
+            json_mode: 判定をJSONオブジェクトとして求めるかどうか
 
         Returns:
             str: MAGIシステムの討論応答
 
         """
-        debate_messages = [
-            {
-                "role": "system",
-                "content": (
-                    f"あなたはMAGIシステムの{magi_type.value}です。"
-                    f"{magi_personality.value}として回答してください。"
-                ),
-            },
-            {"role": "user", "content": debate_prompt},
-        ]
+        debate_messages = self._create_prompt_messages(
+            persona.system_prompt, question, debate_prompt
+        )
+        if json_mode:
+            debate_messages = self._add_verdict_instruction(debate_messages)
 
         # API呼び出しを実行
-        response = await asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: self._call_api(debate_messages),
+        response = await self.client.call(
+            debate_messages, max_tokens, json_mode=json_mode
         )
 
         # コールバックを実行
         if callback:
-            await callback(magi_type.value, response, phase)
+            await callback(persona.id, response, phase)
 
         # 結果をyieldするためのdictを返す
         return response
 
-    def _create_debate_prompt(
-        self,
-        user_question: str,
-        melchior_response: str,
-        balthasar_response: str,
-        casper_response: str,
-    ) -> str:
+    def _create_prompt_messages(
+        self, system_prompt: str, question: Message, prompt: str
+    ) -> MessageHistory:
+        """質問に続けてプロンプトを送るメッセージリストを作成する.
+
+        質問は会話履歴のメッセージをそのまま共有し、プロンプトに埋め込まない。
+        長い文書を含む質問でも、討論や合議のたびに複製やシリアライズをしない。
+
+        Args:
+            system_prompt: システムプロンプト
+            question: ユーザーの質問のメッセージ
+            prompt: 質問の後に送るプロンプト
+
+        Returns:
+            MessageHistory: システムプロンプト、質問、プロンプトの順のメッセージリスト
+
+        """
+        return MessageHistory(
+            [
+                Message(role="system", content=system_prompt),
+                question,
+                Message(role="user", content=prompt),
+            ]
+        )
+
+    def _format_opinions(self, opinions: list[tuple[str, str]], suffix: str) -> str:
+        """見解の一覧をプロンプトに埋め込む形式に整形する.
+
+        Args:
+            opinions: 表示名と見解の組のリスト
+            suffix: 見出しの表示名の後に付ける語句
+
+        Returns:
+            str: 整形した見解の一覧
+
+        """
+        return "\n\n".join(
+            f"【{label}の{suffix}】\n{opinion}" for label, opinion in opinions
+        )
+
+    def _create_debate_prompt(self, opinions: list[tuple[str, str]]) -> str:
         """討論用のプロンプトを作成する.
 
+        プロンプトは質問のメッセージの後に送る。
+
         Args:
-            user_question: ユーザーの質問
-            melchior_response: MELCHIORの応答
-            balthasar_response: BALTHASARの応答
-            casper_response: CASPERの応答
+            opinions: 討論に参加するペルソナの表示名と応答の組のリスト
 
         Returns:
             str: 討論用のプロンプト
 
         """
         return f"""
-これまでの議論を踏まえて、あなたの立場から意見を改めて述べてください。
+直前の質問について、これまでの議論を踏まえて、あなたの立場から意見を改めて述べてください。
 他のMAGIシステムの意見に対して同意または反論し、自分の視点から分析してください。
 
-【質問】
-{user_question}
-
-【MELCHIOR(科学者)の見解】
-{melchior_response}
-
-【BALTHASAR(母親)の見解】
-{balthasar_response}
-
-【CASPER(女性)の見解】
-{casper_response}
+{self._format_opinions(opinions, "見解")}
 
 あなたの立場からの分析と結論を述べてください。
 """
 
-    def _create_consensus_prompt(
-        self,
-        user_question: str,
-        melchior_final: str,
-        balthasar_final: str,
-        casper_final: str,
-    ) -> str:
+    def _create_consensus_prompt(self, opinions: list[tuple[str, str]]) -> str:
         """合議結果用のプロンプトを作成する.
 
+        プロンプトは質問のメッセージの後に送る。
+
         Args:
-            user_question: ユーザーの質問
-            melchior_final: MELCHIORの最終応答
-            balthasar_final: BALTHASARの最終応答
-            casper_final: CASPERの最終応答
+            opinions: 合議する見解の表示名と最終応答の組のリスト
 
         Returns:
             str: 合議結果用のプロンプト
 
         """
         return f"""
-以下のMAGIシステム3つの分析結果に基づいて、最終的な判断を下してください。
+直前の質問について、以下のMAGIシステム{len(opinions)}つの分析結果に基づいて、最終的な判断を下してください。
 各システムの視点を統合し、バランスの取れた結論を導き出してください。
 
-【質問】
-{user_question}
+{self._format_opinions(opinions, "最終見解")}
 
-【MELCHIOR(科学者)の最終見解】
-{melchior_final}
-
-【BALTHASAR(母親)の最終見解】
-{balthasar_final}
-
-【CASPER(女性)の最終見解】
-{casper_final}
-
-3つの視点を総合した最終判断を述べてください。
+{len(opinions)}つの視点を総合した最終判断を述べてください。
 """
 
     def _create_final_response(
-        self,
-        melchior_final: str,
-        balthasar_final: str,
-        casper_final: str,
-        consensus_response: str,
+        self, finals: list[tuple[str, str]], consensus_response: str
     ) -> str:
         """最終的な合議結果を作成する.
 
         Args:
-            melchior_final: MELCHIORの最終応答
-            balthasar_final: BALTHASARの最終応答
-            casper_final: CASPERの最終応答
+            finals: 各ペルソナの表示名と最終応答の組のリスト
             consensus_response: 合議システムの応答
 
         Returns:
             str: 最終的な合議結果
 
         """
+        sections = "".join(
+            f"■ {label}の最終見解:\n{final}\n\n" for label, final in finals
+        )
         return (
             f"【MAGI合議システム - 討論結果】\n\n"
-            f"■ MELCHIOR(科学者)の最終見解:\n{melchior_final}\n\n"
-            f"■ BALTHASAR(母親)の最終見解:\n{balthasar_final}\n\n"
-            f"■ CASPER(女性)の最終見解:\n{casper_final}\n\n"
+            f"{sections}"
             f"【最終判断】\n{consensus_response}\n"
         )
 
+    def _collect_opinions(
+        self, responses: dict[str, str], personas: tuple[Persona, ...] | None = None
+    ) -> list[tuple[str, str]]:
+        """ペルソナの順に表示名と応答の組を並べる.
+
+        Args:
+            responses: ペルソナのIDごとの応答
+            personas: 対象のペルソナ(Noneの場合は全ペルソナ)
+
+        Returns:
+            list[tuple[str, str]]: 表示名と応答の組のリスト
+
+        """
+        return [
+            (persona.label, responses.get(persona.id, PENDING_RESPONSE))
+            for persona in personas or self.personas
+        ]
+
     async def get_response_with_debate(
         self,
-        messages: list[dict[str, str]],
+        messages: Sequence[Message],
         callback: Callable[[str, str, str], None] | None = None,
         debate_rounds: int = 1,
+        deadline_ms: int | None = None,
+        *,
+        structured_verdicts: bool = False,
     ) -> AsyncGenerator[dict[str, str], None]:
         """会話履歴を元に次の応答を生成し、MAGIシステム間で討論を行った上で結果を返す.
 
+        討論は各MAGIシステムを並列の分岐とし、合議で合流する状態グラフとして実行する。
+        成功したノードのみチェックポイントに保存されるため、LLM APIの呼び出しが
+        失敗した討論を同じクライアントが同じ条件で再実行すると、失敗したフェーズから
+        再開する。チェックポイントはメモリ上にのみ保存し、サーバーを再起動すると
+        失われる。最後まで完了した討論のチェックポイントは破棄する。
+
+        制限時間を指定した場合は、モデルごとの応答時間の推定値から討論ラウンド数と
+        生成長を決定する。制限時間を過ぎた場合は、それまでに得られた見解から
+        最終結果を返す。
+
+        構造化モードでは、最終フェーズで各システムに判定・確信度・理由をJSONで
+        求め、合議は多数決で決定する。合議システムの呼び出しは票が割れた場合のみ行う。
+
         Args:
             messages: これまでの会話履歴
             callback: 各MAGIシステムの応答を受け取るコールバック関数
             debate_rounds: 討論のラウンド数(デフォルト: 1)
+            deadline_ms: 応答までの制限時間(ミリ秒、指定しない場合はNone)
+            structured_verdicts: 構造化された判定の多数決で合議するかどうか
 
         Yields:
             dict: MAGIシステムの応答状態の更新
 
         """
-        # 初期の状態
-        state = {"messages": messages}
-        user_question = messages[-1]["content"]
+        messages = as_history(messages)
+        async for update in self._with_semantic_cache(
+            messages,
+            callback,
+            self._run_debate(
+                messages,
+                callback,
+                debate_rounds,
+                deadline_ms,
+                structured_verdicts=structured_verdicts,
+            ),
+        ):
+            yield update
+
+    async def _run_debate(
+        self,
+        messages: Sequence[Message],
+        callback: Callable[[str, str, str], None] | None,
+        debate_rounds: int,
+        deadline_ms: int | None,
+        *,
+        structured_verdicts: bool = False,
+    ) -> AsyncGenerator[dict[str, str], None]:
+        """討論グラフを制限時間の有無に応じて実行する.
+
+        Args:
+            messages: これまでの会話履歴
+            callback: 各MAGIシステムの応答を受け取るコールバック関数
+            debate_rounds: 討論のラウンド数
+            deadline_ms: 応答までの制限時間(ミリ秒、指定しない場合はNone)
+            structured_verdicts: 構造化された判定の多数決で合議するかどうか
 
-        # 各MAGIシステムの初期応答を取得
-        # MELCHIOR(科学者)の初期応答
-        state = await self._get_magi_response(state, MagiSystem.MELCHIOR)
-        melchior_response = state.get(
-            "melchior_response", "レスポンスが取得できませんでした"
+        Yields:
+            dict: MAGIシステムの応答状態の更新
+
+        """
+        if deadline_ms is None:
+            plan = DebatePlan(
+                debate_rounds=debate_rounds, structured=structured_verdicts
+            )
+            async for update in self._stream_debate_graph(messages, plan, callback):
+                yield update
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + deadline_ms / 1000
+        plan = self._plan_for_deadline(deadline_ms / 1000, debate_rounds)
+        plan.structured = structured_verdicts
+        updates = self._stream_debate_graph(messages, plan, callback)
+
+        latest: dict[str, str] = {}
+        try:
+            while True:
+                update = await asyncio.wait_for(
+                    anext(updates), max(deadline - loop.time(), 0)
+                )
+                latest[update["system"]] = update["response"]
+                yield update
+        except StopAsyncIteration:
+            return
+        except TimeoutError:
+            await updates.aclose()
+
+        # 制限時間を過ぎた場合は、完了したフェーズの見解から最終結果を作成する
+        final_response = self._create_final_response(
+            self._collect_opinions(latest), DEADLINE_EXCEEDED_RESPONSE
         )
         if callback:
-            await callback("melchior", melchior_response, "initial")
-        yield {"system": "melchior", "response": melchior_response, "phase": "initial"}
+            await callback("consensus", final_response, "final")
+        yield {"system": "consensus", "response": final_response, "phase": "final"}
+
+    async def _with_semantic_cache(
+        self,
+        messages: Sequence[Message],
+        callback: Callable[[str, str, str], None] | None,
+        updates: AsyncGenerator[dict[str, str], None],
+    ) -> AsyncGenerator[dict[str, str], None]:
+        """セマンティックキャッシュを使って討論の最終結果を再利用する.
+
+        類似した質問の最終結果がキャッシュにあれば討論を行わずにそれを返し、
+        無ければ討論を実行して最終結果をキャッシュに登録する。
+
+        Args:
+            messages: これまでの会話履歴
+            callback: 各MAGIシステムの応答を受け取るコールバック関数
+            updates: 討論を実行するジェネレータ
+
+        Yields:
+            dict: MAGIシステムの応答状態の更新
+
+        """
+        question = None
+        if self.semantic_cache is not None:
+            from nexus_magi.semantic_cache import get_cacheable_question
+
+            question = get_cacheable_question(messages)
+
+        if question is not None:
+            cached = await self.semantic_cache.lookup(question)
+            if cached is not None:
+                await updates.aclose()
+                if callback:
+                    await callback("consensus", cached, "final")
+                yield {"system": "consensus", "response": cached, "phase": "final"}
+                return
+
+        # 各システムの最新の見解
+        latest: dict[str, str] = {}
+        async for update in updates:
+            yield update
+            if update["system"] != "consensus":
+                latest[update["system"]] = update["response"]
+                continue
+            if (
+                question is not None
+                and update["phase"] == "final"
+                # 制限時間切れで作成した暫定の結果や、
+                # LLM APIの呼び出しが失敗した結果はキャッシュしない
+                and DEADLINE_EXCEEDED_RESPONSE not in update["response"]
+                and not is_error_response(update["response"])
+                and not any(is_error_response(opinion) for opinion in latest.values())
+            ):
+                await self.semantic_cache.store(question, update["response"])
+
+    def _plan_for_deadline(
+        self, deadline_seconds: float, debate_rounds: int
+    ) -> DebatePlan:
+        """制限時間内に完了するように討論の実行計画を決定する.
+
+        初期応答・各討論ラウンド・合議の各段階はそれぞれ直列に実行されるため、
+        推定される1回の応答時間からラウンド数を減らし、それでも間に合わない場合は
+        討論を省略した上で生成長を制限する。
 
-        # BALTHASAR(母親)の初期応答
-        state = await self._get_magi_response(state, MagiSystem.BALTHASAR)
-        balthasar_response = state.get(
-            "balthasar_response", "レスポンスが取得できませんでした"
+        Args:
+            deadline_seconds: 制限時間(秒)
+            debate_rounds: 要求された討論ラウンド数
+
+        Returns:
+            DebatePlan: 討論の実行計画
+
+        """
+        budget = deadline_seconds * DEADLINE_SAFETY_RATIO
+        call_seconds = latency_estimator.estimate(self.model)
+        consensus_levels = self._count_consensus_levels()
+        for rounds in range(debate_rounds, -1, -1):
+            # 初期応答 + 討論ラウンド + 合議の各段階
+            if (rounds + 1 + consensus_levels) * call_seconds <= budget:
+                return DebatePlan(debate_rounds=rounds)
+
+        # 初期応答と合議の各段階で制限時間を分け合う
+        max_tokens = max(
+            latency_estimator.max_tokens_within(
+                self.model, budget / (1 + consensus_levels)
+            ),
+            MIN_PLANNED_TOKENS,
         )
-        if callback:
-            await callback("balthasar", balthasar_response, "initial")
-        yield {
-            "system": "balthasar",
-            "response": balthasar_response,
-            "phase": "initial",
-        }
+        return DebatePlan(
+            debate_rounds=0, max_tokens=max_tokens, consensus_max_tokens=max_tokens
+        )
+
+    async def _stream_debate_graph(
+        self,
+        messages: Sequence[Message],
+        plan: DebatePlan,
+        callback: Callable[[str, str, str], None] | None = None,
+    ) -> AsyncGenerator[dict[str, str], None]:
+        """討論グラフを実行し、各ノードの応答を順に返す.
+
+        フェーズが失敗した場合は、エラーを最終判断として返して終了する。
+        同じ討論が実行中の場合は、チェックポイントを共有せずに独立して実行する。
+
+        Args:
+            messages: これまでの会話履歴
+            plan: 討論の実行計画
+            callback: 各MAGIシステムの応答を受け取るコールバック関数
+
+        Yields:
+            dict: MAGIシステムの応答状態の更新
+
+        """
+        messages = as_history(messages)
+        graph = self._get_debate_graph()
+        thread_id = self._create_debate_thread_id(messages, plan)
+        resumable = thread_id not in _active_debate_threads
+        if not resumable:
+            # 実行中の討論のチェックポイントを読み書きしないよう、
+            # この実行だけのスレッドで実行し、終了後に破棄する
+            thread_id = f"{thread_id}:{uuid.uuid4().hex}"
+        config = {"configurable": {"thread_id": thread_id}}
+        _active_debate_threads.add(thread_id)
+        if resumable:
+            _remember_debate_thread(thread_id)
+        try:
+            async for update in self._stream_debate_thread(
+                graph, config, messages, plan, callback
+            ):
+                yield update
+        finally:
+            _active_debate_threads.discard(thread_id)
+            if not resumable:
+                _forget_debate_thread(thread_id)
+
+    async def _stream_debate_thread(
+        self,
+        graph: Any,  # noqa: ANN401
+        config: dict[str, Any],
+        messages: MessageHistory,
+        plan: DebatePlan,
+        callback: Callable[[str, str, str], None] | None,
+    ) -> AsyncGenerator[dict[str, str], None]:
+        """1つのスレッドで討論グラフを実行し、各ノードの応答を順に返す.
+
+        Args:
+            graph: チェックポイント付きでコンパイルされた討論グラフ
+            config: スレッドIDを含む実行時の設定
+            messages: これまでの会話履歴
+            plan: 討論の実行計画
+            callback: 各MAGIシステムの応答を受け取るコールバック関数
+
+        Yields:
+            dict: MAGIシステムの応答状態の更新
+
+        """
+        # 途中で失敗した討論のチェックポイントがあれば、
+        # 完了済みの応答を再送してから再開する
+        snapshot = await graph.aget_state(config)
+        sent: set[tuple[str, str]] = set()
+        if snapshot.values and snapshot.next:
+            async for update in self._send_frames(
+                snapshot.values.get("frames", []), sent, callback
+            ):
+                yield update
+            graph_input = None
+        else:
+            graph_input = {
+                "debate_rounds": plan.debate_rounds,
+                "completed_rounds": 0,
+                "max_tokens": plan.max_tokens,
+                "consensus_max_tokens": plan.consensus_max_tokens,
+                "structured": plan.structured,
+                "responses": {},
+                "verdicts": {},
+                "frames": [],
+            }
+
+        try:
+            async for chunk in graph.astream(
+                graph_input,
+                config,
+                context=DebateContext(messages=messages),
+                stream_mode="updates",
+            ):
+                for node_update in chunk.values():
+                    async for update in self._send_frames(
+                        (node_update or {}).get("frames", []), sent, callback
+                    ):
+                        yield update
+        except DebatePhaseError as e:
+            # 失敗したフェーズのチェックポイントは残し、再試行時に再開する
+            frame = {
+                "system": "consensus",
+                "response": f"{e}\n{DEBATE_RETRY_NOTE}",
+                "phase": "final",
+            }
+            async for update in self._send_frames([frame], sent, callback):
+                yield update
+            return
+
+        # 再開時に適用された保留中の書き込みなど、未送信の応答があれば送信する
+        snapshot = await graph.aget_state(config)
+        async for update in self._send_frames(
+            snapshot.values.get("frames", []), sent, callback
+        ):
+            yield update
+        # 完了した討論は再利用しない。応答の再利用はセマンティックキャッシュで行う
+        _forget_debate_thread(config["configurable"]["thread_id"])
+
+    async def _send_frames(
+        self,
+        frames: list[dict[str, str]],
+        sent: set[tuple[str, str]],
+        callback: Callable[[str, str, str], None] | None,
+    ) -> AsyncGenerator[dict[str, str], None]:
+        """まだ送信していない応答をコールバックに渡して返す.
+
+        Args:
+            frames: 討論グラフが生成した応答
+            sent: 送信済みの(システム, フェーズ)の組
+            callback: 応答を受け取るコールバック関数
+
+        Yields:
+            dict: 未送信のMAGIシステムの応答
+
+        """
+        for update in frames:
+            key = (update["system"], update["phase"])
+            if key in sent:
+                continue
+            sent.add(key)
+            if callback:
+                await callback(update["system"], update["response"], update["phase"])
+            yield update
+
+    def _create_debate_thread_id(
+        self, messages: MessageHistory, plan: DebatePlan
+    ) -> str:
+        """討論のチェックポイントを識別するスレッドIDを作成する.
+
+        同じクライアントの同じ設定・会話履歴・実行計画の討論は同じIDとなり、
+        失敗した討論を再試行時に再開できる。
+
+        Args:
+            messages: これまでの会話履歴
+            plan: 討論の実行計画
+
+        Returns:
+            str: スレッドID
 
-        # CASPER(女性)の初期応答
-        state = await self._get_magi_response(state, MagiSystem.CASPER)
-        casper_response = state.get(
-            "casper_response", "レスポンスが取得できませんでした"
+        """
+        key = json.dumps(
+            {
+                "owner": self.checkpoint_owner,
+                "api_base": self.api_base,
+                "model": self.model,
+                "api_type": self.api_type,
+                "debate_rounds": plan.debate_rounds,
+                "max_tokens": plan.max_tokens,
+                "consensus_max_tokens": plan.consensus_max_tokens,
+                "structured": plan.structured,
+                "personas": [asdict(persona) for persona in self.personas],
+                "consensus_group_size": self.persona_config.consensus_group_size,
+            },
+            ensure_ascii=False,
+            sort_keys=True,
         )
-        if callback:
-            await callback("casper", casper_response, "initial")
-        yield {"system": "casper", "response": casper_response, "phase": "initial"}
+        digest = hashlib.sha256(key.encode())
+        # 会話履歴はメッセージごとにキャッシュしたシリアライズ結果から計算する
+        for message in messages:
+            digest.update(message.encoded)
+        return digest.hexdigest()
 
-        # 討論ラウンド
-        melchior_final = melchior_response
-        balthasar_final = balthasar_response
-        casper_final = casper_response
+    def _get_debate_graph(self) -> Any:  # noqa: ANN401
+        """討論の状態グラフを取得する.
 
-        # 討論ラウンドを実行
-        for round_num in range(debate_rounds):
-            phase = f"debate_{round_num + 1}"
+        Returns:
+            CompiledStateGraph: チェックポイント付きでコンパイルされた討論グラフ
 
-            # 討論用のプロンプトを作成
-            debate_prompt = self._create_debate_prompt(
-                user_question, melchior_final, balthasar_final, casper_final
-            )
+        """
+        if self._debate_graph is None:
+            self._debate_graph = self._build_debate_graph()
+        return self._debate_graph
 
-            # 各MAGIシステムの討論応答を取得
-            melchior_debate_response = await self._get_magi_debate_response(
-                MagiSystem.MELCHIOR,
-                MagiPersonality.MELCHIOR,
-                debate_prompt,
-                callback,
-                phase,
+    def _build_debate_graph(self) -> Any:  # noqa: ANN401
+        """各ペルソナを並列分岐、合議を合流点とする討論グラフを構築する.
+
+        Returns:
+            CompiledStateGraph: チェックポイント付きでコンパイルされた討論グラフ
+
+        """
+        from langgraph.graph import END, START, StateGraph
+
+        builder = StateGraph(DebateState, context_schema=DebateContext)
+        for persona in self.personas:
+            builder.add_node(
+                f"initial_{persona.id}", self._create_initial_node(persona)
             )
-            melchior_final = melchior_debate_response
-            yield {
-                "system": "melchior",
-                "response": melchior_debate_response,
-                "phase": phase,
-            }
+            builder.add_node(f"debate_{persona.id}", self._create_debate_node(persona))
+            builder.add_edge(START, f"initial_{persona.id}")
+        builder.add_node("initial_done", self._initial_done_node)
+        builder.add_node("round_done", self._round_done_node)
+        builder.add_node("consensus", self._consensus_node)
+
+        # 全ペルソナの応答が揃った時点で次のフェーズへ進む
+        builder.add_edge(
+            [f"initial_{persona.id}" for persona in self.personas], "initial_done"
+        )
+        builder.add_edge(
+            [f"debate_{persona.id}" for persona in self.personas], "round_done"
+        )
+        builder.add_conditional_edges("initial_done", self._route_next_phase)
+        builder.add_conditional_edges("round_done", self._route_next_phase)
+        builder.add_edge("consensus", END)
 
-            balthasar_debate_response = await self._get_magi_debate_response(
-                MagiSystem.BALTHASAR,
-                MagiPersonality.BALTHASAR,
-                debate_prompt,
-                callback,
-                phase,
+        return builder.compile(checkpointer=_get_debate_checkpointer())
+
+    def _create_initial_node(
+        self, persona: Persona
+    ) -> Callable[..., Awaitable[dict[str, Any]]]:
+        """指定したペルソナの初期応答を求めるグラフの処理を作成する.
+
+        Args:
+            persona: ペルソナ
+
+        Returns:
+            Callable: 初期応答を状態に書き込むノード関数
+
+        """
+
+        async def initial_node(
+            state: DebateState, runtime: "Runtime[DebateContext]"
+        ) -> dict[str, Any]:
+            # 討論を行わない場合は初期応答が最終フェーズとなる
+            json_mode = state["structured"] and state["debate_rounds"] == 0
+            result = await self._get_magi_response(
+                {"messages": runtime.context.messages},
+                persona,
+                state["max_tokens"],
+                json_mode=json_mode,
             )
-            balthasar_final = balthasar_debate_response
-            yield {
-                "system": "balthasar",
-                "response": balthasar_debate_response,
-                "phase": phase,
-            }
+            response = result.get(
+                f"{persona.id}_response", "レスポンスが取得できませんでした"
+            )
+            _raise_for_error(response)
+            return self._create_node_update(
+                persona, response, "initial", json_mode=json_mode
+            )
+
+        return initial_node
+
+    def _create_debate_node(
+        self, persona: Persona
+    ) -> Callable[..., Awaitable[dict[str, Any]]]:
+        """指定したペルソナの討論応答を求めるグラフの処理を作成する.
 
-            casper_debate_response = await self._get_magi_debate_response(
-                MagiSystem.CASPER,
-                MagiPersonality.CASPER,
+        プロンプトが参加者数に比例して長くならないよう、討論は同じグループの
+        ペルソナの見解だけを参照して行う。
+
+        Args:
+            persona: ペルソナ
+
+        Returns:
+            Callable: 討論応答を状態に書き込むノード関数
+
+        """
+        group = self.persona_config.group_of(persona)
+
+        async def debate_node(
+            state: DebateState, runtime: "Runtime[DebateContext]"
+        ) -> dict[str, Any]:
+            phase = f"debate_{state['completed_rounds'] + 1}"
+            json_mode = (
+                state["structured"]
+                and state["completed_rounds"] + 1 == state["debate_rounds"]
+            )
+            debate_prompt = self._create_debate_prompt(
+                self._collect_opinions(state["responses"], group)
+            )
+            response = await self._get_magi_debate_response(
+                persona,
+                runtime.context.messages[-1],
                 debate_prompt,
-                callback,
+                None,
                 phase,
+                state["max_tokens"],
+                json_mode=json_mode,
+            )
+            _raise_for_error(response)
+            return self._create_node_update(
+                persona, response, phase, json_mode=json_mode
             )
-            casper_final = casper_debate_response
-            yield {
-                "system": "casper",
-                "response": casper_debate_response,
-                "phase": phase,
-            }
 
-        # 最終的な合議結果を生成
-        consensus_prompt = self._create_consensus_prompt(
-            user_question, melchior_final, balthasar_final, casper_final
-        )
+        return debate_node
 
-        consensus_messages = [
-            {
-                "role": "system",
-                "content": "あなたはMAGI合議システムです。3つのMAGIシステムの判断を"
-                "総合して最終的な結論を出してください。",
-            },
-            {"role": "user", "content": consensus_prompt},
+    def _create_node_update(
+        self,
+        persona: Persona,
+        response: str,
+        phase: str,
+        *,
+        json_mode: bool,
+    ) -> dict[str, Any]:
+        """ペルソナの応答から討論グラフの状態の更新を作成する.
+
+        JSONで判定を求めた場合は、判定を状態に保存し、表示用に整形した判定を
+        応答とする。
+
+        Args:
+            persona: ペルソナ
+            response: ペルソナの応答
+            phase: 現在のフェーズ
+            json_mode: 判定をJSONオブジェクトとして求めたかどうか
+
+        Returns:
+            dict: 討論グラフの状態の更新
+
+        """
+        update: dict[str, Any] = {}
+        if json_mode:
+            verdict = parse_verdict(response)
+            update["verdicts"] = {persona.id: asdict(verdict) if verdict else None}
+            if verdict is not None:
+                response = format_verdict(verdict)
+        update["responses"] = {persona.id: response}
+        update["frames"] = [
+            {"system": persona.id, "response": response, "phase": phase}
         ]
+        return update
+
+    async def _initial_done_node(self, _state: DebateState) -> dict[str, Any]:
+        """初期応答フェーズの合流ノード."""
+        return {}
+
+    async def _round_done_node(self, state: DebateState) -> dict[str, Any]:
+        """討論ラウンドの合流ノード."""
+        return {"completed_rounds": state["completed_rounds"] + 1}
+
+    def _route_next_phase(self, state: DebateState) -> list[str] | str:
+        """次に実行するフェーズのノードを決定する.
+
+        Args:
+            state: 現在の討論状態
+
+        Returns:
+            list[str] | str: 次に実行するノード名
+
+        """
+        if state["completed_rounds"] < state["debate_rounds"]:
+            return [f"debate_{persona.id}" for persona in self.personas]
+        return "consensus"
+
+    async def _consensus_node(
+        self, state: DebateState, runtime: "Runtime[DebateContext]"
+    ) -> dict[str, Any]:
+        """最終的な合議結果を生成するノード."""
+        question = runtime.context.messages[-1]
+        if state["structured"]:
+            final_response = await self._create_vote_response(state, question)
+        else:
+            finals = self._collect_opinions(state["responses"])
+            consensus_response = await self._reduce_opinions(
+                question, finals, state["consensus_max_tokens"]
+            )
+            _raise_for_error(consensus_response)
+            # 最終的な合議結果
+            final_response = self._create_final_response(finals, consensus_response)
+        return {
+            "frames": [
+                {"system": "consensus", "response": final_response, "phase": "final"}
+            ]
+        }
+
+    async def _create_vote_response(self, state: DebateState, question: Message) -> str:
+        """各ペルソナの判定の多数決から最終的な合議結果を作成する.
+
+        票が割れた場合や有効な判定が無い場合のみ、合議システムに判断させる。
+
+        Args:
+            state: 現在の討論状態
+            question: ユーザーの質問のメッセージ
+
+        Returns:
+            str: 最終的な合議結果
+
+        """
+        # 並列分岐の完了順によらず結果が決まるように、ペルソナの順に並べる
+        verdicts: dict[str, Verdict | None] = {}
+        for persona in self.personas:
+            verdict = state["verdicts"].get(persona.id)
+            verdicts[persona.id] = Verdict(**verdict) if verdict else None
+        result = tally_verdicts(verdicts)
+
+        lines = ["【MAGI合議システム - 投票結果】\n"]
+        for persona in self.personas:
+            verdict = verdicts[persona.id]
+            if verdict is None:
+                lines.append(f"■ {persona.label}: 判定なし")
+            else:
+                lines.append(
+                    f"■ {persona.label}: {verdict.verdict} "
+                    f"(確信度: {verdict.confidence:.0%})"
+                )
+
+        if result.verdict is not None:
+            supporters = "、".join(
+                self.persona_config.by_id[system].name for system in result.supporters
+            )
+            decision = (
+                f"{result.verdict}\n"
+                f"({len(result.supporters)}/{result.valid_votes}票: {supporters})"
+            )
+        else:
+            # 票が割れた場合のみ合議システムが判断する
+            decision = await self._reduce_opinions(
+                question,
+                self._collect_opinions(state["responses"]),
+                state["consensus_max_tokens"],
+            )
+            _raise_for_error(decision)
+            decision = f"票が割れたため、合議システムが判断しました。\n{decision}"
+
+        lines.append(f"\n【最終判断】\n{decision}\n")
+        return "\n".join(lines)
+
+    def _count_consensus_groups(self) -> list[int]:
+        """木構造の合議で、最後の合議より前の各段階のグループ数を数える.
+
+        Returns:
+            list[int]: 段階ごとのグループ数
+
+        """
+        size = self.persona_config.consensus_group_size
+        count = len(self.personas)
+        counts = []
+        while count > size:
+            groups = len(split_into_groups(range(count), size))
+            if groups == 1:
+                break
+            counts.append(groups)
+            count = groups
+        return counts
+
+    def _count_consensus_levels(self) -> int:
+        """木構造の合議で直列に実行される段階数を数える.
+
+        Returns:
+            int: 合議の段階数
 
-        consensus_response = await asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: self._call_api(consensus_messages),
+        """
+        return len(self._count_consensus_groups()) + 1
+
+    def _count_consensus_calls(self) -> int:
+        """木構造の合議で呼び出す合議システムの回数を数える.
+
+        Returns:
+            int: 合議システムの呼び出し回数
+
+        """
+        return sum(self._count_consensus_groups()) + 1
+
+    def estimate_tokens(
+        self, messages: Sequence[Message], debate_rounds: int = 1
+    ) -> int:
+        """討論全体で使用するプロンプトと生成のトークン数を見積もる.
+
+        プロンプトは文字数から、各応答の生成トークン数はモデルの実測の平均から
+        見積もる。使用量の上限を超える討論を開始前に断るために使用する。
+
+        Args:
+            messages: これまでの会話履歴
+            debate_rounds: 討論のラウンド数
+
+        Returns:
+            int: 見積もったトークン数
+
+        """
+        from nexus_magi.usage_quota import estimate_tokens
+
+        history = as_history(messages)
+        completion = round(latency_estimator.get_stats(self.model).completion_tokens)
+        history_tokens = sum(estimate_tokens(message.content) for message in history)
+        question_tokens = estimate_tokens(history[-1].content) if history else 0
+
+        total = 0
+        for persona in self.personas:
+            system_tokens = estimate_tokens(persona.system_prompt)
+            # 初期応答はシステムプロンプトと会話履歴、討論は質問と同じグループの見解
+            total += system_tokens + history_tokens + completion
+            group_size = len(self.persona_config.group_of(persona))
+            total += debate_rounds * (
+                system_tokens + question_tokens + (group_size + 1) * completion
+            )
+        # 合議は質問と最大でグループの大きさ分の見解
+        group_size = self.persona_config.consensus_group_size
+        total += self._count_consensus_calls() * (
+            question_tokens + (group_size + 1) * completion
         )
+        return total
 
-        # 最終的な合議結果
-        final_response = self._create_final_response(
-            melchior_final, balthasar_final, casper_final, consensus_response
+    async def _reduce_opinions(
+        self,
+        question: Message,
+        opinions: list[tuple[str, str]],
+        max_tokens: int | None = None,
+    ) -> str:
+        """見解をグループごとに合議し、1つの結論になるまで繰り返す.
+
+        1回の合議で扱う見解の数をおおむねconsensus_group_size以下に抑えるため、
+        プロンプトの長さはペルソナ数に比例して長くならない。
+        同じ段階のグループの合議は並行して実行し、失敗したグループがあれば
+        その応答を合議システムの応答として返す。
+
+        Args:
+            question: ユーザーの質問のメッセージ
+            opinions: 表示名と見解の組のリスト
+            max_tokens: 生成トークン数の上限(指定しない場合はNone)
+
+        Returns:
+            str: 合議システムの応答
+
+        """
+        size = self.persona_config.consensus_group_size
+        level = 1
+        while len(opinions) > size:
+            groups = split_into_groups(opinions, size)
+            if len(groups) == 1:
+                # 2つ以上の見解を含むグループに分けられない場合はまとめて合議する
+                break
+
+            async def merge(
+                index: int, group: tuple[tuple[str, str], ...], level: int = level
+            ) -> tuple[str, str]:
+                response = await self._get_consensus_response(
+                    question, list(group), max_tokens
+                )
+                return (f"第{level}段階・グループ{index + 1}の合議", response)
+
+            opinions = list(
+                await asyncio.gather(
+                    *(merge(index, group) for index, group in enumerate(groups))
+                )
+            )
+            for _, opinion in opinions:
+                if is_error_response(opinion):
+                    return opinion
+            level += 1
+
+        return await self._get_consensus_response(question, opinions, max_tokens)
+
+    async def _get_consensus_response(
+        self,
+        question: Message,
+        opinions: list[tuple[str, str]],
+        max_tokens: int | None = None,
+    ) -> str:
+        """見解の一覧から合議システムの応答を取得する.
+
+        Args:
+            question: ユーザーの質問のメッセージ
+            opinions: 表示名と最終応答の組のリスト
+            max_tokens: 生成トークン数の上限(指定しない場合はNone)
+
+        Returns:
+            str: 合議システムの応答
+
+        """
+        consensus_messages = self._create_prompt_messages(
+            f"あなたはMAGI合議システムです。{len(opinions)}つの"
+            "MAGIシステムの判断を総合して最終的な結論を出してください。",
+            question,
+            self._create_consensus_prompt(opinions),
         )
 
+        return await self.client.call(consensus_messages, max_tokens)
+
+    def _has_converged(self, previous: str, current: str, threshold: float) -> bool:
+        """前回の応答から見解がほぼ変化していないかを判定する.
+
+        Args:
+            previous: 前回の応答
+            current: 今回の応答
+            threshold: 収束とみなす類似度(0.0〜1.0)
+
+        Returns:
+            bool: 収束していればTrue
+
+        """
+        return difflib.SequenceMatcher(None, previous, current).ratio() >= threshold
+
+    async def get_response_with_async_debate(
+        self,
+        messages: Sequence[Message],
+        callback: Callable[[str, str, str], None] | None = None,
+        max_turns: int = 1,
+        convergence_threshold: float = CONVERGENCE_THRESHOLD,
+    ) -> AsyncGenerator[dict[str, str], None]:
+        """ラウンド間の待ち合わせを行わない非同期討論で応答を生成する.
+
+        各MAGIシステムは自分の応答が終わり次第、その時点で他システムが出している
+        最新の見解を使って次のターンを開始する。
+        ターン数の上限に達するか、応答が前回から収束した時点で討論を終え、
+        全システムが終了した後に合議を行う。
+
+        Args:
+            messages: これまでの会話履歴
+            callback: 各MAGIシステムの応答を受け取るコールバック関数
+            max_turns: 各システムが行う討論ターン数の上限(デフォルト: 1)
+            convergence_threshold: 収束とみなす前回応答との類似度
+
+        Yields:
+            dict: MAGIシステムの応答状態の更新
+
+        """
+        messages = as_history(messages)
+        async for update in self._with_semantic_cache(
+            messages,
+            callback,
+            self._run_async_debate(
+                messages, callback, max_turns, convergence_threshold
+            ),
+        ):
+            yield update
+
+    async def _run_async_debate(
+        self,
+        messages: Sequence[Message],
+        callback: Callable[[str, str, str], None] | None,
+        max_turns: int,
+        convergence_threshold: float,
+    ) -> AsyncGenerator[dict[str, str], None]:
+        """非同期討論を実行する.
+
+        Args:
+            messages: これまでの会話履歴
+            callback: 各MAGIシステムの応答を受け取るコールバック関数
+            max_turns: 各システムが行う討論ターン数の上限
+            convergence_threshold: 収束とみなす前回応答との類似度
+
+        Yields:
+            dict: MAGIシステムの応答状態の更新
+
+        """
+        state: dict[str, Any] = {"messages": messages}
+        question = messages[-1]
+        latest: dict[str, str] = {}
+        queue: asyncio.Queue[dict[str, str] | None] = asyncio.Queue()
+        # LLM APIの呼び出しが失敗したシステムの例外
+        failures: list[DebatePhaseError] = []
+
+        async def run_magi(persona: Persona) -> None:
+            """1つのペルソナの初期応答と討論ターンを順に実行する."""
+            group = self.persona_config.group_of(persona)
+            try:
+                await self._get_magi_response(state, persona)
+                response = state.get(
+                    f"{persona.id}_response", "レスポンスが取得できませんでした"
+                )
+                _raise_for_error(response)
+                latest[persona.id] = response
+                await queue.put(
+                    {"system": persona.id, "response": response, "phase": "initial"}
+                )
+
+                for turn in range(max_turns):
+                    phase = f"debate_{turn + 1}"
+                    # 同じグループの他ペルソナはその時点での最新の見解を使う
+                    debate_prompt = self._create_debate_prompt(
+                        self._collect_opinions(latest, group)
+                    )
+                    previous = latest[persona.id]
+                    response = await self._get_magi_debate_response(
+                        persona, question, debate_prompt, None, phase
+                    )
+                    _raise_for_error(response)
+                    latest[persona.id] = response
+                    await queue.put(
+                        {"system": persona.id, "response": response, "phase": phase}
+                    )
+
+                    if self._has_converged(previous, response, convergence_threshold):
+                        break
+            except DebatePhaseError as e:
+                failures.append(e)
+            finally:
+                # 終了の合図
+                await queue.put(None)
+
+        tasks = [asyncio.create_task(run_magi(persona)) for persona in self.personas]
+        try:
+            async for update in self._drain_async_updates(
+                len(tasks), queue, failures, callback
+            ):
+                yield update
+            # 例外が発生したシステムがあれば再送出する
+            await asyncio.gather(*tasks)
+
+            finals = self._collect_opinions(latest)
+            consensus_response = await self._reduce_opinions(question, finals)
+            _raise_for_error(consensus_response)
+            final_response = self._create_final_response(finals, consensus_response)
+        except DebatePhaseError as e:
+            # 失敗した応答を見解として合議せず、失敗を最終判断として返す
+            final_response = str(e)
+        finally:
+            for task in tasks:
+                task.cancel()
+
         if callback:
             await callback("consensus", final_response, "final")
         yield {"system": "consensus", "response": final_response, "phase": "final"}
 
+    async def _drain_async_updates(
+        self,
+        remaining: int,
+        queue: asyncio.Queue[dict[str, str] | None],
+        failures: list[DebatePhaseError],
+        callback: Callable[[str, str, str], None] | None,
+    ) -> AsyncGenerator[dict[str, str], None]:
+        """非同期討論の各システムの応答を、全システムが終了するまで順に返す.
+
+        Args:
+            remaining: 実行中のシステム数
+            queue: 各システムの応答と終了の合図を受け取るキュー
+            failures: LLM APIの呼び出しが失敗したシステムの例外
+            callback: 各MAGIシステムの応答を受け取るコールバック関数
+
+        Yields:
+            dict: MAGIシステムの応答状態の更新
+
+        Raises:
+            DebatePhaseError: いずれかのシステムの呼び出しが失敗した場合
+
+        """
+        while remaining > 0:
+            update = await queue.get()
+            if update is None:
+                # 失敗したシステムがあれば、他のシステムを待たずに討論を打ち切る
+                if failures:
+                    raise failures[0]
+                remaining -= 1
+                continue
+            # コールバックは送信順序を保つためにここでまとめて実行する
+            if callback:
+                await callback(update["system"], update["response"], update["phase"])
+            yield update
+
     async def _get_magi_response(
-        self, state: dict[str, Any], magi_type: MagiSystem
+        self,
+        state: dict[str, Any],
+        persona: Persona,
+        max_tokens: int | None = None,
+        *,
+        json_mode: bool = False,
     ) -> dict[str, Any]:
-        """指定したMAGIシステムの応答を非同期で取得する.
+        """指定したペルソナの応答を非同期で取得する.
 
         Args:
             state: 現在の状態
-            magi_type: MAGIシステムの種類
+            persona: ペルソナ
+            max_tokens: 生成トークン数の上限(指定しない場合はNone)
+            json_mode: 判定をJSONオブジェクトとして求めるかどうか
 
         Returns:
             dict: 更新された状態
 
         """
-        messages = self._add_system_instructions(state["messages"], magi_type)
-
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(None, lambda: self._call_api(messages))
-
-        # MAGIシステムに応じた応答を状態に追加
-        if magi_type == MagiSystem.MELCHIOR:
-            state["melchior_response"] = response
-        elif magi_type == MagiSystem.BALTHASAR:
-            state["balthasar_response"] = response
-        elif magi_type == MagiSystem.CASPER:
-            state["casper_response"] = response
+        # 生成長の制限やJSONの指示が無い初期応答は、先行生成した応答を使用する
+        speculative = None
+        if self.speculation is not None and max_tokens is None and not json_mode:
+            speculative = self.speculation.take(persona.id)
+        if speculative is not None:
+            response = await speculative
+        else:
+            messages = self._add_system_instructions(state["messages"], persona)
+            if json_mode:
+                messages = self._add_verdict_instruction(messages)
+            response = await self.client.call(messages, max_tokens, json_mode=json_mode)
+
+        # ペルソナに応じた応答を状態に追加
+        state[f"{persona.id}_response"] = response
 
         return state
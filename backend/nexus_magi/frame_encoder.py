@@ -0,0 +1,241 @@
+"""WebSocketで送信する応答の量と送信回数を減らすモジュール.
+
+圧縮形式を指定したクライアントには、短い間隔で続けて生成された応答を
+1つのメッセージ(応答の配列)にまとめて送信する。また、最終結果のように既に送信した
+応答を含む応答は、その部分を送信済みの応答への参照に置き換えて送信する。
+
+クライアントは各システムが直前に送信した応答を保持しておき、
+参照をその応答に置き換えて連結することで元の応答を復元できる。
+生成途中の応答は、直前の応答への参照と新たに生成された部分として送信する。
+"""
+
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+# 応答をまとめる既定の間隔(20ミリ秒)
+DEFAULT_FLUSH_INTERVAL = 0.02
+
+# まとめた応答の文字数がこれを超えた場合は、間隔を待たずに送信する
+MAX_BATCH_CHARS = 64 * 1024
+
+# 参照に置き換える応答の文字数の下限
+# 短い応答は参照に置き換えても小さくならないため、そのまま送信する
+MIN_REFERENCE_CHARS = 32
+
+
+def compact_frame(frame: dict[str, str], latest: dict[str, str]) -> dict:
+    """応答に含まれる送信済みの応答を参照に置き換える.
+
+    Args:
+        frame: 送信する応答
+        latest: システムごとの直前に送信した応答
+
+    Returns:
+        dict: 参照に置き換えた応答(置き換える部分が無い場合は元の応答)
+
+    """
+    text = frame["response"]
+    candidates = sorted(
+        (
+            (system, response)
+            for system, response in latest.items()
+            if len(response) >= MIN_REFERENCE_CHARS
+        ),
+        key=lambda item: len(item[1]),
+        reverse=True,
+    )
+
+    # 長い応答から順に、重ならない位置を参照に置き換える
+    spans: list[tuple[int, int, str]] = []
+    for system, response in candidates:
+        start = text.find(response)
+        while start >= 0:
+            end = start + len(response)
+            if all(end <= s or start >= e for s, e, _ in spans):
+                spans.append((start, end, system))
+                start = text.find(response, end)
+            else:
+                start = text.find(response, start + 1)
+    if not spans:
+        return frame
+
+    segments: list[dict[str, str]] = []
+    position = 0
+    for start, end, system in sorted(spans):
+        if position < start:
+            segments.append({"text": text[position:start]})
+        segments.append({"ref": system})
+        position = end
+    if position < len(text):
+        segments.append({"text": text[position:]})
+    return {**frame, "response": "", "segments": segments}
+
+
+class FrameEncoder:
+    """クライアントへ応答を送信するクラス.
+
+    圧縮形式では、前回の送信から間隔が空いている応答はすぐに送信し、
+    間隔内に続けて生成された応答はまとめて送信する。そのため、単独の応答の
+    遅延は増やさずに、同時に完了した各システムの応答を1回で送信できる。
+    """
+
+    def __init__(
+        self,
+        send_text: Callable[[str], Awaitable[None]],
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        *,
+        compact: bool = False,
+    ) -> None:
+        """送信処理を初期化.
+
+        Args:
+            send_text: WebSocketでテキストメッセージを送信する関数
+            flush_interval: 応答をまとめる間隔の秒数
+            compact: 圧縮形式で送信するかどうか(Falseの場合は1つずつそのまま送信)
+
+        """
+        # 生成されたモデルは読み込みに時間がかかるため、使用する時点で読み込む
+        from nexus_magi.api_gen.codecs import (
+            encode_web_socket_response,
+            encode_web_socket_response_list,
+        )
+
+        self._encode = encode_web_socket_response
+        self._encode_list = encode_web_socket_response_list
+        self.flush_interval = flush_interval
+        self.compact = compact
+        self._send_text = send_text
+        self._batch: list[dict] = []
+        self._batch_chars = 0
+        # システムごとの直前に送信した応答
+        self._latest: dict[str, str] = {}
+        # システムごとの生成途中の応答。新たに生成された部分をリストで保持する
+        self._parts: dict[str, list[str]] = {}
+        self._lock = asyncio.Lock()
+        self._timer: asyncio.TimerHandle | None = None
+        self._pending: set[asyncio.Task[None]] = set()
+        self._last_flush = float("-inf")
+        self._error: BaseException | None = None
+
+    async def send(self, frame: dict[str, str]) -> None:
+        """応答を送信する.
+
+        Args:
+            frame: クライアントへ送信する応答
+
+        """
+        if not self.compact:
+            self._parts.pop(frame["system"], None)
+            await self._send_text(self._encode(frame).decode())
+            return
+        self._raise_error()
+
+        # 生成途中の応答は、参照に置き換える候補にする時点で連結する
+        for system, parts in self._parts.items():
+            self._latest[system] = "".join(parts)
+        self._parts.pop(frame["system"], None)
+        compacted = compact_frame(frame, self._latest)
+        self._latest[frame["system"]] = frame["response"]
+        await self._enqueue(compacted)
+
+    async def send_delta(self, system: str, delta: str, phase: str) -> None:
+        """生成途中の応答の、新たに生成された部分を送信する.
+
+        圧縮形式では、そのシステムの直前の応答への参照と新たに生成された部分だけを
+        送信するため、応答が長くなっても1回の送信量は増えない。
+        圧縮形式でない場合は、生成済みの応答全体を送信する。
+        生成途中の応答は、同じシステムの次のsendで完了したものとする。
+
+        Args:
+            system: 応答を生成しているシステム
+            delta: 新たに生成された部分
+            phase: 現在のフェーズ
+
+        """
+        parts = self._parts.setdefault(system, [])
+        parts.append(delta)
+        if not self.compact:
+            frame = {"system": system, "response": "".join(parts), "phase": phase}
+            await self._send_text(self._encode(frame).decode())
+            return
+        self._raise_error()
+
+        if len(parts) == 1:
+            frame = {"system": system, "response": delta, "phase": phase}
+        else:
+            frame = {
+                "system": system,
+                "response": "",
+                "phase": phase,
+                "segments": [{"ref": system}, {"text": delta}],
+            }
+        await self._enqueue(frame)
+
+    async def _enqueue(self, compacted: dict) -> None:
+        """圧縮形式の応答をまとめて送信する応答に追加する.
+
+        Args:
+            compacted: 送信済みの応答を参照に置き換えた応答
+
+        """
+        self._batch.append(compacted)
+        self._batch_chars += len(compacted["response"]) + sum(
+            len(segment.get("text", "")) for segment in compacted.get("segments", ())
+        )
+
+        loop = asyncio.get_running_loop()
+        wait = self._last_flush + self.flush_interval - loop.time()
+        if wait <= 0 or self._batch_chars >= MAX_BATCH_CHARS:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(wait, self._flush_later)
+
+    async def flush(self) -> None:
+        """まとめている応答を送信する."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = self._batch
+        self._batch = []
+        self._batch_chars = 0
+        # 先に開始した送信が完了してから送信し、応答の順序を保つ
+        async with self._lock:
+            if batch:
+                self._last_flush = asyncio.get_running_loop().time()
+                await self._send_text(self._encode_list(batch).decode())
+        self._raise_error()
+
+    async def close(self) -> None:
+        """まとめている応答を送信し、実行中の送信の完了を待つ."""
+        await self.flush()
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    def _flush_later(self) -> None:
+        """間隔を待った応答を送信するタスクを開始する."""
+        self._timer = None
+        task = asyncio.create_task(self._flush_in_background())
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _flush_in_background(self) -> None:
+        """応答を送信し、失敗した場合は次の送信時に例外を送出する."""
+        try:
+            await self.flush()
+        except Exception as e:  # noqa: BLE001
+            logger.debug("まとめた応答の送信に失敗しました: %s", e)
+            self._error = e
+
+    def _raise_error(self) -> None:
+        """バックグラウンドでの送信に失敗していれば例外を送出する.
+
+        Raises:
+            BaseException: バックグラウンドでの送信で発生した例外
+
+        """
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
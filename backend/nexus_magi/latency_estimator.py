@@ -0,0 +1,156 @@
+"""LLM呼び出しの応答時間を推定するモジュール."""
+
+import threading
+from dataclasses import dataclass
+
+# 推定値を指数移動平均で更新する際の平滑化係数
+EWMA_ALPHA = 0.2
+
+# 計測値が無い場合の初期推定値
+DEFAULT_OVERHEAD_SECONDS = 1.0
+DEFAULT_SECONDS_PER_TOKEN = 0.05
+DEFAULT_COMPLETION_TOKENS = 400
+
+
+@dataclass
+class LatencyStats:
+    """1つのモデルの応答時間の統計."""
+
+    # 生成以外にかかる時間(リクエスト送信、プロンプト評価など)
+    overhead_seconds: float = DEFAULT_OVERHEAD_SECONDS
+    # 1トークンの生成にかかる時間
+    seconds_per_token: float = DEFAULT_SECONDS_PER_TOKEN
+    # 上限を指定しない場合に生成されるトークン数
+    completion_tokens: float = DEFAULT_COMPLETION_TOKENS
+    samples: int = 0
+
+
+class LatencyEstimator:
+    """モデルごとの応答時間を実測値から推定するクラス.
+
+    API呼び出しはスレッドプールから記録されるため、内部状態はロックで保護する。
+    """
+
+    def __init__(self, alpha: float = EWMA_ALPHA) -> None:
+        """推定器を初期化.
+
+        Args:
+            alpha: 指数移動平均の平滑化係数
+
+        """
+        self.alpha = alpha
+        self._stats: dict[str, LatencyStats] = {}
+        self._lock = threading.Lock()
+
+    def _smooth(self, current: float, observed: float, samples: int) -> float:
+        """指数移動平均で推定値を更新する.
+
+        最初の計測値は初期推定値を置き換える。
+        """
+        if samples == 0:
+            return observed
+        return (1 - self.alpha) * current + self.alpha * observed
+
+    def record(
+        self,
+        model: str,
+        elapsed_seconds: float,
+        completion_tokens: int | None = None,
+        generation_seconds: float | None = None,
+    ) -> None:
+        """API呼び出しの実測値を記録する.
+
+        Args:
+            model: モデル名
+            elapsed_seconds: API呼び出し全体にかかった時間
+            completion_tokens: 生成されたトークン数(不明な場合はNone)
+            generation_seconds: トークン生成にかかった時間(不明な場合はNone)
+
+        """
+        with self._lock:
+            stats = self._stats.setdefault(model, LatencyStats())
+            if not completion_tokens:
+                # トークン数が分からない場合は全体の時間だけを反映する
+                overhead = elapsed_seconds - stats.seconds_per_token * (
+                    stats.completion_tokens
+                )
+                stats.overhead_seconds = self._smooth(
+                    stats.overhead_seconds, max(overhead, 0.0), stats.samples
+                )
+                stats.samples += 1
+                return
+
+            if generation_seconds is None:
+                # 生成時間が分からない場合は既存のオーバーヘッド推定値から逆算する
+                generation_seconds = max(
+                    elapsed_seconds - stats.overhead_seconds,
+                    elapsed_seconds / 2,
+                )
+            overhead = max(elapsed_seconds - generation_seconds, 0.0)
+
+            stats.overhead_seconds = self._smooth(
+                stats.overhead_seconds, overhead, stats.samples
+            )
+            stats.seconds_per_token = self._smooth(
+                stats.seconds_per_token,
+                generation_seconds / completion_tokens,
+                stats.samples,
+            )
+            stats.completion_tokens = self._smooth(
+                stats.completion_tokens, completion_tokens, stats.samples
+            )
+            stats.samples += 1
+
+    def get_stats(self, model: str) -> LatencyStats:
+        """モデルの現在の推定値を取得する.
+
+        Args:
+            model: モデル名
+
+        Returns:
+            LatencyStats: 推定値のコピー
+
+        """
+        with self._lock:
+            stats = self._stats.get(model, LatencyStats())
+            return LatencyStats(
+                overhead_seconds=stats.overhead_seconds,
+                seconds_per_token=stats.seconds_per_token,
+                completion_tokens=stats.completion_tokens,
+                samples=stats.samples,
+            )
+
+    def estimate(self, model: str, max_tokens: int | None = None) -> float:
+        """1回のAPI呼び出しにかかる時間を推定する.
+
+        Args:
+            model: モデル名
+            max_tokens: 生成トークン数の上限(指定しない場合はNone)
+
+        Returns:
+            float: 推定される応答時間(秒)
+
+        """
+        stats = self.get_stats(model)
+        tokens = stats.completion_tokens
+        if max_tokens is not None:
+            tokens = min(tokens, max_tokens)
+        return stats.overhead_seconds + tokens * stats.seconds_per_token
+
+    def max_tokens_within(self, model: str, seconds: float) -> int:
+        """指定した時間内に生成できるトークン数を推定する.
+
+        Args:
+            model: モデル名
+            seconds: 1回のAPI呼び出しに使える時間
+
+        Returns:
+            int: 生成できるトークン数(0以上)
+
+        """
+        stats = self.get_stats(model)
+        return max(int((seconds - stats.overhead_seconds) / stats.seconds_per_token), 0)
+
+
+# プロセス全体で共有する推定器
+latency_estimator = LatencyEstimator()
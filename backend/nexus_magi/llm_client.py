@@ -0,0 +1,623 @@
+"""LLM APIの呼び出しを管理するモジュール."""
+
+import asyncio
+import contextlib
+import json
+import logging
+import threading
+import time
+from collections.abc import Awaitable, Callable, Hashable, Iterable, Mapping
+from dataclasses import dataclass
+from typing import Any
+
+from nexus_magi.concurrency_limiter import get_limiter
+from nexus_magi.latency_estimator import latency_estimator
+from nexus_magi.message_history import (
+    Message,
+    MessageHistory,
+    RequestBody,
+    as_history,
+)
+from nexus_magi.prompt_batcher import (
+    BatchUnsupportedError,
+    get_capabilities,
+    get_prompt_batcher,
+    get_prompt_format,
+    render_prompt,
+)
+from nexus_magi.usage_quota import charge_usage, check_quota
+
+logger = logging.getLogger(__name__)
+
+# HTTPステータスコード
+HTTP_OK = 200
+HTTP_TOO_MANY_REQUESTS = 429
+HTTP_SERVER_ERROR = 500
+
+# 複数のプロンプトをまとめたリクエストに対応していないことを表すHTTPステータスコード
+# (エンドポイントが無い、またはプロンプトのリストを受け付けない)
+BATCH_UNSUPPORTED_STATUS_CODES = (400, 404, 405, 422, 501)
+
+# 使用できるAPIの種類
+# - ollama: OllamaのAPIをHTTPで呼び出す
+# - litellm: LiteLLMプロキシのAPIをHTTPで呼び出す
+# - litellm_sdk: LiteLLMの非同期SDKをプロセス内で直接呼び出す
+API_TYPES = ("ollama", "litellm", "litellm_sdk")
+
+# JSONのリクエスト本文を送信する際のヘッダー
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# API呼び出しに失敗した場合の応答の接頭辞
+ERROR_RESPONSE_PREFIXES = ("エラーが発生しました", "応答の解析に失敗しました")
+
+
+def is_error_response(response: str) -> bool:
+    """API呼び出しの結果がエラーを表す応答かどうかを判定する.
+
+    Args:
+        response: API呼び出しの結果
+
+    Returns:
+        bool: エラーを表す応答であればTrue
+
+    """
+    return response.startswith(ERROR_RESPONSE_PREFIXES)
+
+
+@dataclass
+class LLMUsage:
+    """LLMのトークン使用量."""
+
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+@dataclass
+class BatchResult:
+    """まとめて送信したプロンプトのうち1つの結果."""
+
+    content: str
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+
+
+def split_tokens(total: int | None, weights: list[int]) -> list[int | None]:
+    """まとめたリクエストのトークン数を各プロンプトに配分する.
+
+    まとめたリクエストではトークン数が合計でのみ返されるため、
+    プロンプトや応答の文字数に比例して配分する。
+
+    Args:
+        total: 合計のトークン数(不明な場合はNone)
+        weights: 各プロンプトの配分の重み
+
+    Returns:
+        list[int | None]: 各プロンプトのトークン数(合計が不明な場合はNone)
+
+    """
+    if total is None:
+        return [None] * len(weights)
+    weight_sum = sum(weights)
+    if weight_sum == 0:
+        return [total // len(weights)] * len(weights)
+    shares = [total * weight // weight_sum for weight in weights]
+    # 切り捨てた端数は最も重みの大きいプロンプトに加算し、合計を一致させる
+    shares[weights.index(max(weights))] += total - sum(shares)
+    return shares
+
+
+class LLMClient:
+    """APIの種類に応じてLLMを呼び出すクラス."""
+
+    def __init__(
+        self,
+        api_base: str | None = "http://localhost:11434/api",
+        model: str = "phi4-mini",
+        api_type: str = "ollama",
+    ) -> None:
+        """LLMクライアントを初期化.
+
+        Args:
+            api_base: APIサーバーのベースURL(litellm_sdkでは省略可能)
+            model: 使用するモデル名
+            api_type: APIの種類("ollama"、"litellm"または"litellm_sdk")
+
+        """
+        self.api_base = api_base
+        self.model = model
+        self.api_type = api_type
+        # このクライアントで消費したトークン数の累計
+        self.usage = LLMUsage()
+        self._usage_lock = threading.Lock()
+        # 同じバックエンドを呼び出すクライアント間で同時呼び出し数を共有する
+        backend = f"{model}@{api_base or api_type}"
+        self.limiter = get_limiter(backend)
+        # 同じバックエンドを呼び出すクライアント間でプロンプトをまとめて送信する
+        self.capabilities = get_capabilities(backend, api_type)
+        self.batcher = (
+            get_prompt_batcher(backend, self._send_batch)
+            if self.capabilities.batch_prompts
+            else None
+        )
+
+    def _record_usage(
+        self, prompt_tokens: int | None, completion_tokens: int | None
+    ) -> None:
+        """トークン使用量を累計に加算する.
+
+        API呼び出しはスレッドプールから行われるため、ロックで保護する。
+        リクエストのクライアントの使用量の上限にも、実際のトークン数を記録する。
+        """
+        with self._usage_lock:
+            self.usage.prompt_tokens += prompt_tokens or 0
+            self.usage.completion_tokens += completion_tokens or 0
+        charge_usage(prompt_tokens, completion_tokens)
+
+    def _record_error_status(self, status_code: int) -> None:
+        """バックエンドの過負荷を表すエラーであれば同時呼び出し数を減らす.
+
+        Args:
+            status_code: HTTPステータスコード
+
+        """
+        if status_code == HTTP_TOO_MANY_REQUESTS or status_code >= HTTP_SERVER_ERROR:
+            self.limiter.record_failure()
+
+    def _call_ollama_api(
+        self,
+        messages: MessageHistory,
+        max_tokens: int | None = None,
+        *,
+        json_mode: bool = False,
+    ) -> str:
+        """OllamaのAPIを呼び出して応答を取得する.
+
+        Args:
+            messages: これまでの会話履歴
+            max_tokens: 生成トークン数の上限(指定しない場合はNone)
+            json_mode: JSONオブジェクトとして応答させるかどうか
+
+        Returns:
+            str: LLMからの応答
+
+        """
+        payload: dict[str, Any] = {"model": self.model, "stream": False}
+        if max_tokens is not None:
+            payload["options"] = {"num_predict": max_tokens}
+        if json_mode:
+            payload["format"] = "json"
+
+        # requestsは読み込みに時間がかかるため、最初のAPI呼び出し時に読み込む
+        import requests
+
+        # APIリクエストを送信する
+        start = time.monotonic()
+        try:
+            # 会話履歴はメッセージごとにキャッシュしたシリアライズ結果を使用する
+            response = requests.post(
+                f"{self.api_base}/chat",
+                data=RequestBody(payload, messages),
+                headers=JSON_HEADERS,
+                timeout=60,
+            )
+        except requests.Timeout:
+            self.limiter.record_failure()
+            raise
+        elapsed = time.monotonic() - start
+
+        if response.status_code != HTTP_OK:
+            self._record_error_status(response.status_code)
+            return f"エラーが発生しました: {response.status_code} - {response.text}"
+
+        try:
+            result = response.json()
+            # Ollamaの応答形式に合わせてパースする
+            # Ollamaの応答は {"message": {"content": "応答テキスト"}} 形式
+            content = result["message"]["content"]
+        except (KeyError, json.JSONDecodeError) as e:
+            return f"応答の解析に失敗しました: {e!s}"
+
+        # 応答時間の推定に使用するため、生成トークン数と生成時間を記録する
+        eval_duration = result.get("eval_duration")
+        latency_estimator.record(
+            self.model,
+            elapsed,
+            result.get("eval_count"),
+            eval_duration / 1e9 if eval_duration is not None else None,
+        )
+        self._record_usage(result.get("prompt_eval_count"), result.get("eval_count"))
+        self.limiter.record_latency(elapsed, result.get("eval_count"))
+        return content
+
+    def _call_litellm_api(
+        self,
+        messages: MessageHistory,
+        max_tokens: int | None = None,
+        *,
+        json_mode: bool = False,
+    ) -> str:
+        """LiteLLMのAPIを呼び出して応答を取得する.
+
+        Args:
+            messages: これまでの会話履歴
+            max_tokens: 生成トークン数の上限(指定しない場合はNone)
+            json_mode: JSONオブジェクトとして応答させるかどうか
+
+        Returns:
+            str: LLMからの応答
+
+        """
+        payload: dict[str, Any] = {"model": self.model, "stream": False}
+        if max_tokens is not None:
+            payload["max_tokens"] = max_tokens
+        if json_mode:
+            payload["response_format"] = {"type": "json_object"}
+
+        # requestsは読み込みに時間がかかるため、最初のAPI呼び出し時に読み込む
+        import requests
+
+        # APIリクエストを送信する
+        start = time.monotonic()
+        try:
+            # 会話履歴はメッセージごとにキャッシュしたシリアライズ結果を使用する
+            response = requests.post(
+                f"{self.api_base}/chat/completions",
+                data=RequestBody(payload, messages),
+                headers=JSON_HEADERS,
+                timeout=60,
+            )
+        except requests.Timeout:
+            self.limiter.record_failure()
+            raise
+        elapsed = time.monotonic() - start
+
+        if response.status_code != HTTP_OK:
+            self._record_error_status(response.status_code)
+            return f"エラーが発生しました: {response.status_code} - {response.text}"
+
+        try:
+            result = response.json()
+            content = result["choices"][0]["message"]["content"]
+        except (KeyError, json.JSONDecodeError) as e:
+            return f"応答の解析に失敗しました: {e!s}"
+
+        # 応答時間の推定に使用するため、生成トークン数を記録する
+        usage = result.get("usage") or {}
+        latency_estimator.record(self.model, elapsed, usage.get("completion_tokens"))
+        self._record_usage(usage.get("prompt_tokens"), usage.get("completion_tokens"))
+        self.limiter.record_latency(elapsed, usage.get("completion_tokens"))
+        return content
+
+    async def _call_litellm_sdk_api(
+        self,
+        messages: MessageHistory,
+        max_tokens: int | None = None,
+        on_delta: Callable[[str], Awaitable[None]] | None = None,
+        *,
+        json_mode: bool = False,
+    ) -> str:
+        """LiteLLMの非同期SDKをプロセス内で呼び出して応答を取得する.
+
+        LiteLLMプロキシを経由しないため、プロキシとの間のHTTP通信と
+        JSONのシリアライズ・パースが不要になる。
+
+        Args:
+            messages: これまでの会話履歴
+            max_tokens: 生成トークン数の上限(指定しない場合はNone)
+            on_delta: 新たに生成された部分を受け取るコールバック関数
+            json_mode: JSONオブジェクトとして応答させるかどうか
+
+        Returns:
+            str: LLMからの応答
+
+        """
+        # litellmは読み込みに時間がかかるため、最初のAPI呼び出し時に読み込む
+        import litellm
+        import openai
+
+        kwargs: dict[str, Any] = {
+            "model": self.model,
+            "messages": [message.to_dict() for message in messages],
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        }
+        if self.api_base:
+            kwargs["api_base"] = self.api_base
+        if max_tokens is not None:
+            kwargs["max_tokens"] = max_tokens
+        if json_mode:
+            kwargs["response_format"] = {"type": "json_object"}
+
+        start = time.monotonic()
+        chunks: list[str] = []
+        usage = None
+        try:
+            response = await litellm.acompletion(**kwargs)
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    delta = chunk.choices[0].delta.content
+                    chunks.append(delta)
+                    # 生成済みの応答全体は連結せず、新たに生成された部分だけを渡す
+                    if on_delta:
+                        await on_delta(delta)
+                # 使用量は最後のチャンクに含まれる
+                if getattr(chunk, "usage", None):
+                    usage = chunk.usage
+        except openai.APIStatusError as e:
+            self._record_error_status(e.status_code)
+            return f"エラーが発生しました: {e.status_code} - {e.message}"
+        except openai.APITimeoutError:
+            self.limiter.record_failure()
+            raise
+        elapsed = time.monotonic() - start
+
+        completion_tokens = usage.completion_tokens if usage else None
+        latency_estimator.record(self.model, elapsed, completion_tokens)
+        self._record_usage(usage.prompt_tokens if usage else None, completion_tokens)
+        self.limiter.record_latency(elapsed, completion_tokens)
+        return "".join(chunks)
+
+    def _call_completions_batch_api(
+        self, prompts: list[str], max_tokens: int | None
+    ) -> list[BatchResult]:
+        """OpenAI互換のcompletionsエンドポイントに複数のプロンプトをまとめて送信する.
+
+        Args:
+            prompts: チャットテンプレートに合わせたプロンプトのリスト
+            max_tokens: 生成トークン数の上限(指定しない場合はNone)
+
+        Returns:
+            list[BatchResult]: プロンプトと同じ順序の結果
+
+        Raises:
+            BatchUnsupportedError: バックエンドがまとめたリクエストに対応していない場合
+
+        """
+        # completionsでは省略すると16トークンで打ち切られるため、nullを明示して
+        # チャットと同じく上限なしとする
+        payload: dict[str, Any] = {
+            "model": self.model,
+            "prompt": prompts,
+            "max_tokens": max_tokens,
+            "stream": False,
+        }
+
+        # requestsは読み込みに時間がかかるため、最初のAPI呼び出し時に読み込む
+        import requests
+
+        start = time.monotonic()
+        try:
+            response = requests.post(
+                f"{self.api_base}/completions",
+                data=json.dumps(payload, ensure_ascii=False).encode(),
+                headers=JSON_HEADERS,
+                timeout=60,
+            )
+        except requests.Timeout:
+            self.limiter.record_failure()
+            raise
+        elapsed = time.monotonic() - start
+
+        if response.status_code in BATCH_UNSUPPORTED_STATUS_CODES:
+            msg = f"{response.status_code} - {response.text}"
+            raise BatchUnsupportedError(msg)
+        if response.status_code != HTTP_OK:
+            self._record_error_status(response.status_code)
+            error = f"エラーが発生しました: {response.status_code} - {response.text}"
+            return [BatchResult(error) for _ in prompts]
+
+        try:
+            result = response.json()
+            choices = sorted(result["choices"], key=lambda choice: choice["index"])
+            contents = [choice["text"] for choice in choices]
+        except (KeyError, TypeError, json.JSONDecodeError) as e:
+            return [BatchResult(f"応答の解析に失敗しました: {e!s}") for _ in prompts]
+        if len(contents) != len(prompts):
+            error = "応答の解析に失敗しました: プロンプトと応答の数が一致しません"
+            return [BatchResult(error) for _ in prompts]
+
+        usage = result.get("usage") or {}
+        prompt_tokens = split_tokens(
+            usage.get("prompt_tokens"), [len(prompt) for prompt in prompts]
+        )
+        completion_tokens = split_tokens(
+            usage.get("completion_tokens"), [len(content) for content in contents]
+        )
+        # まとめたリクエストの応答時間は最も長い応答の生成時間で決まる
+        longest = max((tokens or 0 for tokens in completion_tokens), default=0)
+        latency_estimator.record(self.model, elapsed, longest or None)
+        self.limiter.record_latency(elapsed, longest or None)
+        return [
+            BatchResult(content, prompt, completion)
+            for content, prompt, completion in zip(
+                contents, prompt_tokens, completion_tokens, strict=True
+            )
+        ]
+
+    async def _send_batch(self, key: Hashable, prompts: list[str]) -> list[BatchResult]:
+        """まとめたプロンプトをスレッドプールから送信する.
+
+        Args:
+            key: まとめたリクエストの生成トークン数の上限
+            prompts: チャットテンプレートに合わせたプロンプトのリスト
+
+        Returns:
+            list[BatchResult]: プロンプトと同じ順序の結果
+
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, lambda: self._call_completions_batch_api(prompts, key)
+        )
+
+    async def _call_batched(
+        self, messages: MessageHistory, max_tokens: int | None
+    ) -> str:
+        """他の呼び出しとまとめてプロンプトを送信して応答を取得する.
+
+        Args:
+            messages: 会話履歴
+            max_tokens: 生成トークン数の上限(指定しない場合はNone)
+
+        Returns:
+            str: LLMからの応答
+
+        Raises:
+            BatchUnsupportedError: バックエンドがまとめたリクエストに対応していない場合
+
+        """
+        if self.batcher is None:
+            raise BatchUnsupportedError
+        try:
+            result = await self.batcher.submit(
+                max_tokens, render_prompt(messages, get_prompt_format())
+            )
+        except BatchUnsupportedError as e:
+            if self.capabilities.batch_prompts:
+                logger.warning(
+                    "バックエンドが複数のプロンプトをまとめたリクエストに"
+                    "対応していないため、プロンプトごとに送信します: %s",
+                    e,
+                )
+                self.capabilities.batch_prompts = False
+            raise
+        self._record_usage(result.prompt_tokens, result.completion_tokens)
+        return result.content
+
+    def _call_sync_api(
+        self,
+        messages: MessageHistory,
+        max_tokens: int | None = None,
+        *,
+        json_mode: bool = False,
+    ) -> str:
+        """HTTPで呼び出すAPIの種類に応じて適切なAPI呼び出しを行う.
+
+        Args:
+            messages: 会話履歴
+            max_tokens: 生成トークン数の上限(指定しない場合はNone)
+            json_mode: JSONオブジェクトとして応答させるかどうか
+
+        Returns:
+            str: API呼び出しの結果
+
+        """
+        if self.api_type == "ollama":
+            return self._call_ollama_api(messages, max_tokens, json_mode=json_mode)
+        return self._call_litellm_api(messages, max_tokens, json_mode=json_mode)
+
+    def _call_embedding_api(self, text: str) -> list[float] | None:
+        """HTTPで埋め込みベクトルのAPIを呼び出す.
+
+        Args:
+            text: 埋め込みベクトルに変換するテキスト
+
+        Returns:
+            list[float] | None: 埋め込みベクトル(取得できない場合はNone)
+
+        """
+        # requestsは読み込みに時間がかかるため、最初のAPI呼び出し時に読み込む
+        import requests
+
+        if self.api_type == "ollama":
+            # Ollamaの応答は {"embeddings": [[...]]} 形式
+            response = requests.post(
+                f"{self.api_base}/embed",
+                json={"model": self.model, "input": text},
+                timeout=60,
+            )
+        else:
+            # LiteLLMの応答は {"data": [{"embedding": [...]}]} 形式
+            response = requests.post(
+                f"{self.api_base}/embeddings",
+                json={"model": self.model, "input": [text]},
+                timeout=60,
+            )
+
+        if response.status_code != HTTP_OK:
+            return None
+
+        try:
+            result = response.json()
+            if self.api_type == "ollama":
+                return result["embeddings"][0]
+            return result["data"][0]["embedding"]
+        except (KeyError, IndexError, json.JSONDecodeError):
+            return None
+
+    async def embed(self, text: str) -> list[float] | None:
+        """テキストの埋め込みベクトルを取得する.
+
+        Args:
+            text: 埋め込みベクトルに変換するテキスト
+
+        Returns:
+            list[float] | None: 埋め込みベクトル(取得できない場合はNone)
+
+        """
+        if self.api_type == "litellm_sdk":
+            import litellm
+            import openai
+
+            kwargs: dict[str, Any] = {"model": self.model, "input": [text]}
+            if self.api_base:
+                kwargs["api_base"] = self.api_base
+            try:
+                response = await litellm.aembedding(**kwargs)
+            except openai.APIStatusError:
+                return None
+            return response.data[0]["embedding"]
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: self._call_embedding_api(text))
+
+    async def call(
+        self,
+        messages: Iterable[Message | Mapping[str, str]],
+        max_tokens: int | None = None,
+        on_delta: Callable[[str], Awaitable[None]] | None = None,
+        *,
+        json_mode: bool = False,
+        speculative: bool = False,
+    ) -> str:
+        """APIタイプに応じて適切なAPI呼び出しを非同期で行う.
+
+        Args:
+            messages: メッセージリストまたは会話履歴
+            max_tokens: 生成トークン数の上限(指定しない場合はNone)
+            on_delta: 新たに生成された部分を受け取るコールバック関数(litellm_sdkのみ)
+            json_mode: JSONオブジェクトとして応答させるかどうか
+            speculative: 投機的な呼び出しかどうか(枠に空きがある場合のみ実行する)
+
+        Returns:
+            str: API呼び出しの結果
+
+        Raises:
+            QuotaExceededError: リクエストのクライアントの使用量が上限に達している場合
+
+        """
+        messages = as_history(messages)
+        check_quota()
+
+        # バックエンドが過負荷にならないよう、同時呼び出し数を制限する
+        async with self.limiter.acquire(speculative=speculative):
+            if self.api_type == "litellm_sdk":
+                return await self._call_litellm_sdk_api(
+                    messages, max_tokens, on_delta, json_mode=json_mode
+                )
+
+            # 対応しているバックエンドでは、他の呼び出しとまとめて送信する
+            # JSONの応答形式はcompletionsで指定できないため、まとめずに送信する
+            if (
+                self.batcher is not None
+                and self.capabilities.batch_prompts
+                and not json_mode
+            ):
+                with contextlib.suppress(BatchUnsupportedError):
+                    return await self._call_batched(messages, max_tokens)
+
+            # 同期的なHTTP呼び出しはThreadPoolExecutorで実行する
+            # 使用量を記録するクライアントを引き継ぐため、asyncio.to_threadを使用する
+            return await asyncio.to_thread(
+                self._call_sync_api, messages, max_tokens, json_mode=json_mode
+            )
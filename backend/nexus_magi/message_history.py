@@ -0,0 +1,251 @@
+"""会話履歴を複製せずに共有するモジュール.
+
+討論では同じ会話履歴を全ペルソナ・全フェーズで使用するため、履歴は変更できない
+メッセージとして1つだけ保持し、ペルソナごとのシステムプロンプトは履歴を複製せずに
+差し替えた見え方として扱う。各メッセージのJSONへのシリアライズ結果もメッセージに
+キャッシュし、API呼び出しのたびに長い履歴をシリアライズし直さないようにする。
+"""
+
+import json
+from collections.abc import Iterable, Iterator, Mapping, Sequence
+from dataclasses import dataclass, field
+from typing import overload
+
+
+@dataclass(frozen=True, slots=True)
+class Message:
+    """変更できない1つのメッセージ."""
+
+    role: str
+    content: str
+    # JSONにシリアライズした結果のキャッシュ
+    _encoded: bytes | None = field(default=None, init=False, repr=False, compare=False)
+
+    def __getitem__(self, key: str) -> str:
+        """辞書形式のメッセージと同じように値を取得する.
+
+        Args:
+            key: "role"または"content"
+
+        Returns:
+            str: 値
+
+        Raises:
+            KeyError: 存在しないキーを指定した場合
+
+        """
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.content
+        raise KeyError(key)
+
+    @property
+    def encoded(self) -> bytes:
+        """APIのリクエスト本文に埋め込むJSONのバイト列."""
+        if self._encoded is None:
+            encoded = json.dumps(
+                {"role": self.role, "content": self.content}, ensure_ascii=False
+            ).encode()
+            object.__setattr__(self, "_encoded", encoded)
+            return encoded
+        return self._encoded
+
+    def to_dict(self) -> dict[str, str]:
+        """辞書形式のメッセージに変換する.
+
+        Returns:
+            dict[str, str]: roleとcontentを持つ辞書
+
+        """
+        return {"role": self.role, "content": self.content}
+
+
+class MessageHistory(Sequence[Message]):
+    """変更できない会話履歴.
+
+    システムプロンプトの差し替えは元の履歴を共有した新しい見え方として作成する。
+    """
+
+    __slots__ = ("_messages", "_system", "_system_index")
+
+    def __init__(
+        self,
+        messages: Iterable[Message | Mapping[str, str]] = (),
+        *,
+        system: str | None = None,
+    ) -> None:
+        """会話履歴を初期化.
+
+        Args:
+            messages: メッセージ(辞書形式のメッセージはMessageに変換する)。
+                会話履歴を渡した場合は、システムプロンプトを差し替える前の
+                メッセージを複製せずに共有する
+            system: 最初のシステムメッセージと差し替える、または先頭に追加する
+                システムプロンプト
+
+        """
+        if isinstance(messages, MessageHistory):
+            self._messages = messages.base_messages
+        else:
+            self._messages = tuple(
+                message
+                if isinstance(message, Message)
+                else Message(role=message["role"], content=message["content"])
+                for message in messages
+            )
+        # 差し替えたシステムメッセージと、その位置(Noneの場合は先頭に挿入)
+        self._system: Message | None = None
+        self._system_index: int | None = None
+        if system is not None:
+            self._system = Message(role="system", content=system)
+            self._system_index = next(
+                (
+                    index
+                    for index, message in enumerate(self._messages)
+                    if message.role == "system"
+                ),
+                None,
+            )
+
+    @property
+    def base_messages(self) -> tuple[Message, ...]:
+        """システムプロンプトを差し替える前のメッセージ."""
+        return self._messages
+
+    def __len__(self) -> int:
+        """メッセージ数."""
+        return len(self._messages) + (
+            1 if self._system is not None and self._system_index is None else 0
+        )
+
+    @overload
+    def __getitem__(self, index: int) -> Message: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[Message]: ...
+
+    def __getitem__(self, index: int | slice) -> Message | list[Message]:
+        """メッセージを取得する.
+
+        Args:
+            index: 位置またはスライス
+
+        Returns:
+            Message | list[Message]: メッセージ(スライスの場合はリスト)
+
+        """
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            msg = f"メッセージの位置が範囲外です: {index}"
+            raise IndexError(msg)
+        if self._system is None:
+            return self._messages[index]
+        if self._system_index is None:
+            return self._system if index == 0 else self._messages[index - 1]
+        if index == self._system_index:
+            return self._system
+        return self._messages[index]
+
+    def __iter__(self) -> Iterator[Message]:
+        """メッセージを順に返す."""
+        if self._system is None:
+            yield from self._messages
+            return
+        if self._system_index is None:
+            yield self._system
+            yield from self._messages
+            return
+        for index, message in enumerate(self._messages):
+            yield self._system if index == self._system_index else message
+
+    def __eq__(self, other: object) -> bool:
+        """同じメッセージを同じ順に持つかどうか."""
+        if not isinstance(other, MessageHistory | list | tuple):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            a == b for a, b in zip(self, other, strict=True)
+        )
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        """デバッグ用の表現."""
+        return f"MessageHistory({list(self)!r})"
+
+    def with_system(self, content: str) -> "MessageHistory":
+        """システムプロンプトを差し替えた会話履歴を作成する.
+
+        最初のシステムメッセージがあれば差し替え、なければ先頭に追加する。
+        元の履歴のメッセージは複製せずに共有する。
+
+        Args:
+            content: システムプロンプト
+
+        Returns:
+            MessageHistory: システムプロンプトを差し替えた会話履歴
+
+        """
+        return MessageHistory(self, system=content)
+
+
+def as_history(messages: Iterable[Message | Mapping[str, str]]) -> MessageHistory:
+    """メッセージの列を会話履歴に変換する.
+
+    Args:
+        messages: メッセージの列
+
+    Returns:
+        MessageHistory: 会話履歴(既に会話履歴の場合はそのまま返す)
+
+    """
+    if isinstance(messages, MessageHistory):
+        return messages
+    return MessageHistory(messages)
+
+
+class RequestBody:
+    """会話履歴を埋め込んだJSONのリクエスト本文.
+
+    各メッセージのシリアライズ結果を連結せずに順に送信するため、
+    リクエストごとに履歴全体の大きさのバイト列を作成しない。
+    長さが分かるため、requestsはContent-Lengthを付けて送信する。
+    """
+
+    __slots__ = ("_chunks", "_length")
+
+    def __init__(self, payload: Mapping[str, object], messages: MessageHistory) -> None:
+        """リクエスト本文を作成.
+
+        Args:
+            payload: messages以外のリクエストのパラメータ
+            messages: 会話履歴
+
+        """
+        head = json.dumps({**payload, "messages": []}, ensure_ascii=False)
+        # 空の配列の位置に各メッセージを埋め込む
+        prefix, suffix = head.rsplit("[]", 1)
+        chunks = [f"{prefix}[".encode()]
+        for index, message in enumerate(messages):
+            if index > 0:
+                chunks.append(b",")
+            chunks.append(message.encoded)
+        chunks.append(f"]{suffix}".encode())
+        self._chunks = chunks
+        self._length = sum(len(chunk) for chunk in chunks)
+
+    def __len__(self) -> int:
+        """リクエスト本文のバイト数."""
+        return self._length
+
+    def __iter__(self) -> Iterator[bytes]:
+        """リクエスト本文を分割して返す."""
+        return iter(self._chunks)
+
+    def __bytes__(self) -> bytes:
+        """リクエスト本文を1つのバイト列として返す."""
+        return b"".join(self._chunks)
@@ -0,0 +1,194 @@
+"""討論に参加するペルソナの定義を管理するモジュール."""
+
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TypeVar
+
+T = TypeVar("T")
+
+# 合議で一度にまとめる見解の数の既定値
+DEFAULT_CONSENSUS_GROUP_SIZE = 3
+
+# 合議で一度にまとめる見解の数の最小値
+MIN_CONSENSUS_GROUP_SIZE = 2
+
+# ペルソナのIDとして使用できない、合議結果を表すシステム名
+RESERVED_SYSTEM_IDS = ("consensus",)
+
+
+def split_into_groups(items: Sequence[T], size: int) -> list[tuple[T, ...]]:
+    """要素を大きさの差が1以下のグループに分ける.
+
+    グループ数は大きさがsize以下になる最小の数とする。ただし、1つしか
+    要素の無いグループができる場合はグループ数を減らし、sizeを超えても
+    2つ以上の要素を持つグループにする。
+
+    Args:
+        items: 分ける要素
+        size: グループの大きさの上限
+
+    Returns:
+        list[tuple[T, ...]]: 元の順序を保ったグループのリスト
+
+    """
+    count = len(items)
+    group_count = max(min(-(-count // size), count // 2), 1)
+    base, extra = divmod(count, group_count)
+    groups = []
+    start = 0
+    for index in range(group_count):
+        # 余りの要素は先頭のグループから1つずつ割り当てる
+        end = start + base + (index < extra)
+        groups.append(tuple(items[start:end]))
+        start = end
+    return groups
+
+
+@dataclass(frozen=True)
+class Persona:
+    """討論に参加するペルソナ."""
+
+    # WebSocketの応答でシステムを識別するID
+    id: str
+    # 表示名
+    name: str
+    # 役割
+    role: str
+    # 考え方の特徴
+    description: str
+
+    @property
+    def label(self) -> str:
+        """プロンプトや合議結果で使用する表示名."""
+        return f"{self.name}({self.role})"
+
+    @property
+    def system_prompt(self) -> str:
+        """ペルソナとして回答させるシステムプロンプト."""
+        return (
+            f"あなたはMAGIシステムの{self.id}です。"
+            f"{self.role}: {self.description}として回答してください。"
+        )
+
+
+# 設定ファイルを指定しない場合のMAGIの3システム
+DEFAULT_PERSONAS = (
+    Persona(
+        id="melchior",
+        name="MELCHIOR",
+        role="科学者",
+        description="論理的・分析的に考えるシステム",
+    ),
+    Persona(
+        id="balthasar",
+        name="BALTHASAR",
+        role="母親",
+        description="共感的・感情的に考えるシステム",
+    ),
+    Persona(
+        id="casper",
+        name="CASPER",
+        role="女性",
+        description="直感的・創造的に考えるシステム",
+    ),
+)
+
+
+@dataclass(frozen=True)
+class PersonaConfig:
+    """討論のペルソナ構成."""
+
+    personas: tuple[Persona, ...] = DEFAULT_PERSONAS
+    # 合議で一度にまとめる見解の数。ペルソナ数がこれを超える場合は
+    # グループごとに合議した結果をさらに合議する
+    consensus_group_size: int = DEFAULT_CONSENSUS_GROUP_SIZE
+    # IDからペルソナを引くための辞書
+    by_id: dict[str, Persona] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        """ペルソナ構成を検証する.
+
+        Raises:
+            ValueError: ペルソナが無い、IDが重複している、予約されたIDを使用している、
+                またはグループの大きさが小さすぎる場合
+
+        """
+        if not self.personas:
+            msg = "ペルソナが1つも定義されていません"
+            raise ValueError(msg)
+        by_id: dict[str, Persona] = {}
+        for persona in self.personas:
+            if persona.id in RESERVED_SYSTEM_IDS:
+                msg = f"ペルソナのIDに{persona.id}は使用できません"
+                raise ValueError(msg)
+            if persona.id in by_id:
+                msg = f"ペルソナのIDが重複しています: {persona.id}"
+                raise ValueError(msg)
+            by_id[persona.id] = persona
+        if self.consensus_group_size < MIN_CONSENSUS_GROUP_SIZE:
+            msg = (
+                f"consensus_group_sizeは{MIN_CONSENSUS_GROUP_SIZE}以上を"
+                "指定してください"
+            )
+            raise ValueError(msg)
+        object.__setattr__(self, "by_id", by_id)
+
+    def groups(self) -> list[tuple[Persona, ...]]:
+        """討論と合議を行うペルソナのグループを取得する.
+
+        Returns:
+            list[tuple[Persona, ...]]: 大きさがほぼ等しいグループ
+
+        """
+        return split_into_groups(self.personas, self.consensus_group_size)
+
+    def group_of(self, persona: Persona) -> tuple[Persona, ...]:
+        """ペルソナが属するグループを取得する.
+
+        Args:
+            persona: ペルソナ
+
+        Returns:
+            tuple[Persona, ...]: ペルソナを含むグループ
+
+        """
+        return next(group for group in self.groups() if persona in group)
+
+
+def load_persona_config(path: Path) -> PersonaConfig:
+    """YAMLファイルからペルソナ構成を読み込む.
+
+    Args:
+        path: 設定ファイルのパス
+
+    Returns:
+        PersonaConfig: ペルソナ構成
+
+    Raises:
+        ValueError: 設定ファイルの形式が正しくない場合
+
+    """
+    # 設定ファイルを使用する場合のみ読み込む
+    import yaml
+
+    data = yaml.safe_load(path.read_text(encoding="utf-8")) or {}
+    try:
+        personas = tuple(
+            Persona(
+                id=str(item["id"]),
+                name=str(item.get("name", str(item["id"]).upper())),
+                role=str(item["role"]),
+                description=str(item["description"]),
+            )
+            for item in data["personas"]
+        )
+    except (KeyError, TypeError) as e:
+        msg = f"ペルソナの設定ファイルの形式が正しくありません: {path}"
+        raise ValueError(msg) from e
+    return PersonaConfig(
+        personas=personas,
+        consensus_group_size=int(
+            data.get("consensus_group_size", DEFAULT_CONSENSUS_GROUP_SIZE)
+        ),
+    )
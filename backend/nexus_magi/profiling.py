@@ -0,0 +1,396 @@
+"""討論リクエストの処理時間を調べるためのプロファイリングモジュール.
+
+プロファイルを有効にしたリクエストについて、サンプリングプロファイラで
+サーバー内の処理(バリデーション、JSON、プロンプト作成、スレッドの受け渡しなど)の
+スタックを採取し、各システムのフェーズごとの所要時間をタイムラインとして記録する。
+結果はspeedscope(https://www.speedscope.app)で開けるJSONと、
+flamegraph.plなどで使用できるcollapsed stacks形式のファイルとして保存する。
+
+プロファイルを有効にしないリクエストでは採取用のスレッドを起動せず、
+コールバックも差し替えないため、処理には影響しない。
+"""
+
+import asyncio
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from collections.abc import AsyncGenerator, Awaitable, Callable
+from dataclasses import dataclass
+from pathlib import Path
+from types import CodeType
+
+# スタックを採取する既定の間隔(5ミリ秒)
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# run_in_executorで使用されるスレッドプールのスレッド名の接頭辞
+EXECUTOR_THREAD_PREFIX = "asyncio_"
+
+# speedscopeのファイル形式のスキーマ
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+
+@dataclass
+class PhaseSpan:
+    """1つのシステムの1つのフェーズの所要時間."""
+
+    # 応答を生成したシステム
+    system: str
+    # フェーズ名
+    phase: str
+    # 討論の開始からの経過秒数
+    start: float
+    end: float
+
+
+class SamplingProfiler:
+    """別スレッドから一定間隔でスタックを採取するプロファイラ.
+
+    イベントループのスレッドと、同期的なAPI呼び出しを実行するスレッドプールの
+    スレッドを対象とする。イベントループは他のリクエストと共有しているため、
+    同時に処理された他のリクエストの処理も含まれる。
+    """
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL) -> None:
+        """プロファイラを初期化.
+
+        Args:
+            interval: スタックを採取する間隔(秒)
+
+        """
+        self.interval = interval
+        # スレッド名から始まるスタック(呼び出し元が先)ごとの採取回数
+        self.samples: Counter[tuple[str, ...]] = Counter()
+        self._loop_thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._labels: dict[CodeType, str] = {}
+
+    def start(self) -> None:
+        """採取を開始する(イベントループのスレッドから呼び出す)."""
+        self._loop_thread_id = threading.get_ident()
+        self._thread = threading.Thread(
+            target=self._run, name="nexus-magi-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """採取を終了する."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        """終了するまで一定間隔でスタックを採取する."""
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self) -> None:
+        """対象のスレッドのスタックを1回採取する."""
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        # プロファイル用に各スレッドの実行中のフレームを取得する
+        frames = sys._current_frames()  # noqa: SLF001
+        for thread_id, frame in frames.items():
+            name = names.get(thread_id, str(thread_id))
+            if thread_id == self._loop_thread_id:
+                name = "event loop"
+            elif not name.startswith(EXECUTOR_THREAD_PREFIX):
+                continue
+            elif frame.f_code.co_name == "_worker":
+                # 処理を待っているスレッドプールのスレッドは除く
+                continue
+
+            stack: list[str] = []
+            current = frame
+            while current is not None:
+                stack.append(self._label(current.f_code))
+                current = current.f_back
+            stack.append(name)
+            stack.reverse()
+            self.samples[tuple(stack)] += 1
+
+    def _label(self, code: CodeType) -> str:
+        """関数単位で集計するためのフレームの表示名を作成する.
+
+        Args:
+            code: フレームのコードオブジェクト
+
+        Returns:
+            str: 関数名とファイル名、定義行を含む表示名
+
+        """
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_qualname} ({code.co_filename}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+
+class PhaseTimeline:
+    """各システムのフェーズごとの所要時間を記録するクラス.
+
+    フェーズの開始時刻は、ラウンドごとに全システムを待ち合わせる討論では
+    前のフェーズが全て完了した時刻、待ち合わせない討論ではそのシステムの
+    前のフェーズが完了した時刻とする。合議は全システムの完了後に開始する。
+    """
+
+    def __init__(self, *, barrier: bool = True) -> None:
+        """タイムラインを初期化.
+
+        Args:
+            barrier: フェーズごとに全システムを待ち合わせる討論かどうか
+
+        """
+        self.barrier = barrier
+        self.spans: list[PhaseSpan] = []
+        self._start = time.perf_counter()
+        self._phase_end: dict[str, float] = {}
+        self._system_end: dict[str, float] = {}
+        self._phases: list[str] = []
+
+    def elapsed(self) -> float:
+        """記録開始からの経過時間(秒)."""
+        return time.perf_counter() - self._start
+
+    def record(self, system: str, phase: str) -> None:
+        """システムの応答が完了したことを記録する.
+
+        Args:
+            system: 応答を生成したシステム
+            phase: 応答のフェーズ
+
+        """
+        end = self.elapsed()
+        if phase not in self._phases:
+            self._phases.append(phase)
+        if system == "consensus":
+            start = max(
+                (t for name, t in self._system_end.items() if name != "consensus"),
+                default=0.0,
+            )
+        elif self.barrier:
+            # 直前のフェーズが全て完了してから開始する
+            index = self._phases.index(phase)
+            start = self._phase_end.get(self._phases[index - 1], 0.0) if index else 0.0
+        else:
+            start = self._system_end.get(system, 0.0)
+        self.spans.append(PhaseSpan(system=system, phase=phase, start=start, end=end))
+        self._phase_end[phase] = end
+        self._system_end[system] = end
+
+
+class DebateProfile:
+    """1回の討論のプロファイル."""
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        barrier: bool = True,
+        interval: float = DEFAULT_SAMPLE_INTERVAL,
+    ) -> None:
+        """プロファイルを初期化.
+
+        Args:
+            name: 出力するファイル名に使用するプロファイル名
+            barrier: フェーズごとに全システムを待ち合わせる討論かどうか
+            interval: スタックを採取する間隔(秒)
+
+        """
+        self.name = name
+        self.profiler = SamplingProfiler(interval)
+        self.timeline = PhaseTimeline(barrier=barrier)
+        self.duration = 0.0
+
+    def start(self) -> None:
+        """採取を開始する."""
+        self.profiler.start()
+
+    def stop(self) -> None:
+        """採取を終了する."""
+        self.duration = self.timeline.elapsed()
+        self.profiler.stop()
+
+    def to_collapsed(self) -> str:
+        """採取したスタックをcollapsed stacks形式に変換する.
+
+        Returns:
+            str: 1行に1つのスタックと採取回数を記載した文字列
+
+        """
+        return "".join(
+            f"{';'.join(frame.replace(';', ':') for frame in stack)} {count}\n"
+            for stack, count in sorted(self.profiler.samples.items())
+        )
+
+    def to_speedscope(self) -> dict:
+        """採取したスタックとタイムラインをspeedscopeの形式に変換する.
+
+        スタックはスレッドごとのサンプリングプロファイル、タイムラインは
+        システムごとのイベント形式のプロファイルとして出力する。
+
+        Returns:
+            dict: speedscopeのファイル形式のJSONオブジェクト
+
+        """
+        frames: list[dict[str, str]] = []
+        frame_index: dict[str, int] = {}
+
+        def index_of(name: str) -> int:
+            if name not in frame_index:
+                frame_index[name] = len(frames)
+                frames.append({"name": name})
+            return frame_index[name]
+
+        duration_ms = self.duration * 1000
+        interval_ms = self.profiler.interval * 1000
+        profiles: list[dict] = []
+
+        by_thread: dict[str, list[tuple[tuple[str, ...], int]]] = {}
+        for stack, count in sorted(self.profiler.samples.items()):
+            by_thread.setdefault(stack[0], []).append((stack[1:], count))
+        for thread, stacks in by_thread.items():
+            profiles.append(
+                {
+                    "type": "sampled",
+                    "name": f"samples: {thread}",
+                    "unit": "milliseconds",
+                    "startValue": 0,
+                    "endValue": duration_ms,
+                    "samples": [
+                        [index_of(frame) for frame in stack] for stack, _ in stacks
+                    ],
+                    "weights": [count * interval_ms for _, count in stacks],
+                }
+            )
+
+        systems = list(dict.fromkeys(span.system for span in self.timeline.spans))
+        for system in systems:
+            events = []
+            for span in self.timeline.spans:
+                if span.system != system:
+                    continue
+                frame = index_of(f"{system}: {span.phase}")
+                events.append({"type": "O", "frame": frame, "at": span.start * 1000})
+                events.append({"type": "C", "frame": frame, "at": span.end * 1000})
+            profiles.append(
+                {
+                    "type": "evented",
+                    "name": f"timeline: {system}",
+                    "unit": "milliseconds",
+                    "startValue": 0,
+                    "endValue": duration_ms,
+                    "events": events,
+                }
+            )
+
+        return {
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": self.name,
+            "exporter": "nexus-magi",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+    def write(self, directory: Path) -> Path:
+        """プロファイルをファイルに保存する.
+
+        Args:
+            directory: 保存先のディレクトリ
+
+        Returns:
+            Path: 保存したspeedscope形式のファイルのパス
+
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{self.name}.speedscope.json"
+        path.write_text(
+            json.dumps(self.to_speedscope(), ensure_ascii=False), encoding="utf-8"
+        )
+        (directory / f"{self.name}.collapsed").write_text(
+            self.to_collapsed(), encoding="utf-8"
+        )
+        return path
+
+
+def should_profile(
+    profile_token: str | None,
+    admin_token: str | None,
+    sample_rate: float,
+) -> bool:
+    """リクエストをプロファイルするかどうかを決定する.
+
+    Args:
+        profile_token: リクエストで指定された管理者用トークン
+        admin_token: サーバーに設定された管理者用トークン(Noneの場合は指定不可)
+        sample_rate: 全てのリクエストのうちプロファイルする割合
+
+    Returns:
+        bool: プロファイルする場合はTrue
+
+    """
+    if admin_token is not None and profile_token == admin_token:
+        return True
+    # 乱数はプロファイル対象の抽出にのみ使用する
+    return sample_rate > 0 and random.random() < sample_rate  # noqa: S311
+
+
+def create_profile_name() -> str:
+    """出力するファイル名に使用するプロファイル名を作成する.
+
+    Returns:
+        str: 日時と識別子からなる名前
+
+    """
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+async def profile_debate(
+    updates: AsyncGenerator[dict[str, str], None],
+    profile: DebateProfile,
+    directory: Path,
+) -> AsyncGenerator[dict[str, str], None]:
+    """討論を実行する間のプロファイルを採取し、終了時に保存する.
+
+    Args:
+        updates: 討論を実行するジェネレータ
+        profile: 採取するプロファイル
+        directory: 保存先のディレクトリ
+
+    Yields:
+        dict: 討論の応答状態の更新
+
+    """
+    profile.start()
+    try:
+        async for update in updates:
+            yield update
+    finally:
+        profile.stop()
+        # ファイルの書き込みでイベントループを止めないよう、別スレッドで保存する
+        await asyncio.to_thread(profile.write, directory)
+
+
+def record_phases(
+    callback: Callable[..., Awaitable[None]], timeline: PhaseTimeline
+) -> Callable[..., Awaitable[None]]:
+    """応答を受け取るコールバックに、タイムラインへの記録を追加する.
+
+    Args:
+        callback: 各システムの応答を受け取るコールバック関数
+        timeline: 記録先のタイムライン
+
+    Returns:
+        Callable: 記録してから元のコールバックを呼び出す関数
+
+    """
+
+    async def record(system: str, response: str, phase: str, *args: str) -> None:
+        timeline.record(system, phase)
+        await callback(system, response, phase, *args)
+
+    return record
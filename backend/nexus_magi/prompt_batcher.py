@@ -0,0 +1,241 @@
+"""同じバックエンドへのプロンプトをまとめて1回のリクエストで送信するモジュール.
+
+vLLMやllama.cppのサーバーは、OpenAI互換のcompletionsエンドポイントで
+複数のプロンプトを1回のリクエストとして受け付け、まとめて生成できる。
+討論の各フェーズでは全ペルソナのプロンプトを同時に送信し、同時に実行している
+別の討論も同じフェーズのプロンプトを送信するため、短い間隔内に送信された
+プロンプトをまとめて1回のリクエストにし、結果をそれぞれの呼び出しに振り分ける。
+
+複数のプロンプトを受け付けないバックエンドでは、これまでどおり
+プロンプトごとにリクエストを同時に送信する。
+"""
+
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable, Sequence
+from dataclasses import dataclass
+from typing import Generic, TypeVar
+
+from nexus_magi.message_history import Message
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# 1回のリクエストにまとめるプロンプト数の上限
+DEFAULT_MAX_BATCH_SIZE = 32
+
+# completionsエンドポイントに送信するプロンプトの形式
+# 各メッセージの形式と、応答の生成を促す末尾の文字列の組
+PROMPT_FORMATS = {
+    "chatml": ("<|im_start|>{role}\n{content}<|im_end|>\n", "<|im_start|>assistant\n"),
+    "phi": ("<|{role}|>{content}<|end|>", "<|assistant|>"),
+    "llama3": (
+        "<|start_header_id|>{role}<|end_header_id|>\n\n{content}<|eot_id|>",
+        "<|start_header_id|>assistant<|end_header_id|>\n\n",
+    ),
+}
+
+
+class BatchUnsupportedError(Exception):
+    """バックエンドが複数のプロンプトをまとめたリクエストに対応していないことを表す例外."""
+
+
+@dataclass
+class BackendCapabilities:
+    """バックエンドが対応している呼び出し方法."""
+
+    # 複数のプロンプトを1回のリクエストで受け付けるかどうか
+    batch_prompts: bool = False
+
+
+def render_prompt(messages: Sequence[Message], prompt_format: str) -> str:
+    """会話履歴をcompletionsエンドポイントに送信するプロンプトに変換する.
+
+    Args:
+        messages: 会話履歴
+        prompt_format: プロンプトの形式(PROMPT_FORMATSのキー)
+
+    Returns:
+        str: モデルのチャットテンプレートに合わせたプロンプト
+
+    """
+    message_format, generation_prompt = PROMPT_FORMATS[prompt_format]
+    rendered = "".join(
+        message_format.format(role=message.role, content=message.content)
+        for message in messages
+    )
+    return rendered + generation_prompt
+
+
+class PromptBatcher(Generic[T, R]):
+    """短い間隔内に送信されたプロンプトをまとめてバックエンドへ送信するクラス.
+
+    生成トークン数の上限などリクエストの設定が異なるプロンプトはまとめられないため、
+    設定ごとのキーでまとめる。
+    """
+
+    def __init__(
+        self,
+        send_batch: Callable[[Hashable, list[T]], Awaitable[list[R]]],
+        window: float,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+    ) -> None:
+        """まとめる処理を初期化.
+
+        Args:
+            send_batch: キーとプロンプトのリストを受け取り、同じ順序で結果を返す関数
+            window: 最初のプロンプトから送信までに待つ秒数
+            max_batch_size: 1回のリクエストにまとめるプロンプト数の上限
+
+        """
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._send_batch = send_batch
+        self._batches: dict[Hashable, list[tuple[T, asyncio.Future[R]]]] = {}
+        self._timers: dict[Hashable, asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    async def submit(self, key: Hashable, prompt: T) -> R:
+        """プロンプトを送信し、結果を取得する.
+
+        Args:
+            key: リクエストの設定を表すキー(同じキーのプロンプトをまとめる)
+            prompt: 送信するプロンプト
+
+        Returns:
+            R: このプロンプトの結果
+
+        """
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[R] = loop.create_future()
+        batch = self._batches.setdefault(key, [])
+        batch.append((prompt, future))
+        if len(batch) >= self.max_batch_size:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    def _flush(self, key: Hashable) -> None:
+        """まとめたプロンプトを送信するタスクを開始する.
+
+        Args:
+            key: 送信するプロンプトのキー
+
+        """
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._batches.pop(key, [])
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._send(key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(
+        self, key: Hashable, batch: list[tuple[T, asyncio.Future[R]]]
+    ) -> None:
+        """プロンプトをまとめて送信し、結果をそれぞれの呼び出しに振り分ける.
+
+        Args:
+            key: 送信するプロンプトのキー
+            batch: プロンプトと結果を受け取るFutureのリスト
+
+        """
+        # 送信前に取り消された呼び出しのプロンプトは送信しない
+        batch = [(prompt, future) for prompt, future in batch if not future.done()]
+        if not batch:
+            return
+        try:
+            results = await self._send_batch(key, [prompt for prompt, _ in batch])
+        except Exception as e:  # noqa: BLE001
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results, strict=True):
+            if not future.done():
+                future.set_result(result)
+
+
+# プロンプトをまとめて送信する間隔とプロンプトの形式
+# 間隔がNoneの場合はまとめない
+_batch_window: float | None = None
+_prompt_format = "chatml"
+
+# バックエンドごとに共有する呼び出し方法とまとめる処理
+_capabilities: dict[str, BackendCapabilities] = {}
+_batchers: dict[str, PromptBatcher] = {}
+
+
+def configure_batching(window: float | None, prompt_format: str = "chatml") -> None:
+    """プロンプトをまとめて送信する設定を変更する.
+
+    Args:
+        window: 最初のプロンプトから送信までに待つ秒数(Noneの場合はまとめない)
+        prompt_format: completionsエンドポイントに送信するプロンプトの形式
+
+    Raises:
+        ValueError: 未対応のプロンプトの形式を指定した場合
+
+    """
+    global _batch_window, _prompt_format  # noqa: PLW0603
+    if prompt_format not in PROMPT_FORMATS:
+        msg = f"未対応のプロンプトの形式です: {prompt_format}"
+        raise ValueError(msg)
+    _batch_window = window
+    _prompt_format = prompt_format
+    _batchers.clear()
+
+
+def get_prompt_format() -> str:
+    """Completionsエンドポイントに送信するプロンプトの形式を取得する.
+
+    Returns:
+        str: プロンプトの形式(PROMPT_FORMATSのキー)
+
+    """
+    return _prompt_format
+
+
+def get_capabilities(backend: str, api_type: str) -> BackendCapabilities:
+    """バックエンドが対応している呼び出し方法を取得する.
+
+    OpenAI互換のHTTP APIは複数のプロンプトを受け付けるものとして扱い、
+    対応していないことが分かった時点で無効にする。OllamaのAPIと、
+    プロンプトごとに応答をストリーミングするLiteLLM SDKではまとめない。
+
+    Args:
+        backend: バックエンドを識別する名前
+        api_type: APIの種類
+
+    Returns:
+        BackendCapabilities: 同じバックエンドで共有する呼び出し方法
+
+    """
+    if backend not in _capabilities:
+        _capabilities[backend] = BackendCapabilities(
+            batch_prompts=api_type == "litellm"
+        )
+    return _capabilities[backend]
+
+
+def get_prompt_batcher(
+    backend: str,
+    send_batch: Callable[[Hashable, list[T]], Awaitable[list[R]]],
+) -> PromptBatcher[T, R] | None:
+    """バックエンドのプロンプトをまとめる処理を取得する.
+
+    Args:
+        backend: バックエンドを識別する名前
+        send_batch: まとめる処理がまだ無い場合に使用する、まとめて送信する関数
+
+    Returns:
+        PromptBatcher | None: 同じバックエンドで共有する処理(まとめない場合はNone)
+
+    """
+    if _batch_window is None:
+        return None
+    if backend not in _batchers:
+        _batchers[backend] = PromptBatcher(send_batch, _batch_window)
+    return _batchers[backend]
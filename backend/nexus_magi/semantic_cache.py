@@ -0,0 +1,524 @@
+"""言い換えられた質問にも応答を再利用するセマンティックキャッシュのモジュール.
+
+質問を正規化して埋め込みベクトルに変換し、NumPyで保持したインデックスから
+コサイン類似度が閾値以上の過去の質問を探して、その応答を返す。
+
+インデックスは件数が少ない間は全件を一括で比較し、件数が増えると
+k-meansで作成したクラスタごとの転置リストを使って近傍のクラスタだけを比較する。
+クラスタの作成はイベントループを止めないよう別スレッドで行い、
+完了するまでは以前のクラスタで検索する。
+"""
+
+import asyncio
+import logging
+import unicodedata
+from collections import OrderedDict
+from collections.abc import Sequence
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from nexus_magi.message_history import Message
+
+if TYPE_CHECKING:
+    from nexus_magi.llm_client import LLMClient
+
+# 応答を再利用する類似度の既定値
+DEFAULT_SIMILARITY_THRESHOLD = 0.92
+
+# キャッシュする質問数の既定値
+DEFAULT_CAPACITY = 10000
+
+# 転置リストを使った検索に切り替える件数
+IVF_MIN_SIZE = 8192
+
+# クラスタ数(件数の平方根に対する倍率)と、検索時に比較するクラスタ数
+# 10万件・768次元で1回の検索が1ミリ秒未満に収まるように設定している
+IVF_LISTS_PER_SQRT = 4
+IVF_NPROBE = 8
+
+# k-meansの反復回数とクラスタあたりの学習サンプル数
+KMEANS_ITERATIONS = 8
+KMEANS_SAMPLES_PER_LIST = 32
+
+# クラスタへの割り当てを一度に計算する件数
+ASSIGN_BATCH_SIZE = 4096
+
+# クラスタの作成中に登録・削除されたベクトルを、別スレッドで反映する最大回数
+TRAINING_CATCH_UP_ROUNDS = 4
+
+# 検索から登録までの間、埋め込みベクトルを保持しておく質問数
+PENDING_VECTORS_SIZE = 256
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(question: str) -> str:
+    """キャッシュのキーとして使うために質問を正規化する.
+
+    Args:
+        question: ユーザーの質問
+
+    Returns:
+        str: 全角・半角、大文字・小文字、空白の違いを除いた質問
+
+    """
+    return " ".join(unicodedata.normalize("NFKC", question).lower().split())
+
+
+def get_cacheable_question(messages: Sequence[Message]) -> str | None:
+    """キャッシュの対象となる質問を取得する.
+
+    会話の文脈に依存する追加の質問で別の会話の応答を返さないよう、
+    最初の質問だけをキャッシュの対象とする。
+
+    Args:
+        messages: これまでの会話履歴
+
+    Returns:
+        str | None: キャッシュの対象となる質問(対象外の場合はNone)
+
+    """
+    if not messages or messages[-1]["role"] != "user":
+        return None
+    if sum(1 for msg in messages if msg["role"] == "user") != 1:
+        return None
+    return messages[-1]["content"]
+
+
+class _InvertedList:
+    """1つのクラスタに属するベクトルを連続した領域に保持する転置リスト."""
+
+    def __init__(self, dim: int) -> None:
+        """空の転置リストを作成."""
+        self.slots = np.empty(16, dtype=np.int64)
+        self.vectors = np.empty((16, dim), dtype=np.float32)
+        self.size = 0
+
+    def append(self, slot: int, vector: np.ndarray) -> int:
+        """ベクトルを追加し、リスト内の位置を返す."""
+        if self.size == len(self.slots):
+            self.slots = np.resize(self.slots, self.size * 2)
+            vectors = np.empty((self.size * 2, self.vectors.shape[1]), np.float32)
+            vectors[: self.size] = self.vectors
+            self.vectors = vectors
+        self.slots[self.size] = slot
+        self.vectors[self.size] = vector
+        self.size += 1
+        return self.size - 1
+
+    def pop(self, position: int) -> int | None:
+        """指定位置のベクトルを末尾の要素と入れ替えて削除する.
+
+        Returns:
+            int | None: 移動した要素のスロット(移動が無い場合はNone)
+
+        """
+        self.size -= 1
+        if position == self.size:
+            return None
+        self.slots[position] = self.slots[self.size]
+        self.vectors[position] = self.vectors[self.size]
+        return int(self.slots[position])
+
+
+class _Clusters:
+    """k-meansで作成したクラスタと、各クラスタの転置リスト."""
+
+    def __init__(self, centroids: np.ndarray, capacity: int) -> None:
+        """空の転置リストを作成.
+
+        Args:
+            centroids: 正規化済みのクラスタの中心
+            capacity: 保持できるベクトルの最大数
+
+        """
+        self.centroids = centroids
+        self.lists = [_InvertedList(centroids.shape[1]) for _ in centroids]
+        # スロットごとの所属する転置リストの番号とリスト内の位置
+        # 転置リストに無いスロットの番号は-1とする
+        self.list_of = np.full(capacity, -1, dtype=np.int64)
+        self.position = np.zeros(capacity, dtype=np.int64)
+
+    def assign(self, slots: np.ndarray, vectors: np.ndarray) -> None:
+        """ベクトルを最も近いクラスタの転置リストに追加する.
+
+        Args:
+            slots: 追加するスロット
+            vectors: スロットの番号で参照するベクトルの配列
+
+        """
+        for start in range(0, len(slots), ASSIGN_BATCH_SIZE):
+            batch = slots[start : start + ASSIGN_BATCH_SIZE]
+            batch_vectors = vectors[batch]
+            for slot, list_id, vector in zip(
+                batch,
+                np.argmax(batch_vectors @ self.centroids.T, axis=1),
+                batch_vectors,
+                strict=True,
+            ):
+                self.list_of[slot] = list_id
+                self.position[slot] = self.lists[list_id].append(slot, vector)
+
+    def unassign(self, slot: int) -> None:
+        """スロットのベクトルを転置リストから削除する.
+
+        Args:
+            slot: 削除するスロット
+
+        """
+        list_id = self.list_of[slot]
+        if list_id >= 0:
+            moved = self.lists[list_id].pop(int(self.position[slot]))
+            if moved is not None:
+                self.position[moved] = self.position[slot]
+            self.list_of[slot] = -1
+
+
+class VectorIndex:
+    """正規化したベクトルをNumPy配列に保持し、コサイン類似度で検索するインデックス.
+
+    ベクトルの登録・削除・検索はイベントループから行う。クラスタの作成は
+    別スレッドで行い、作成中は以前のクラスタで検索する。
+    """
+
+    def __init__(self, dim: int, capacity: int) -> None:
+        """インデックスを初期化.
+
+        Args:
+            dim: ベクトルの次元数
+            capacity: 保持できるベクトルの最大数
+
+        """
+        self.dim = dim
+        self.capacity = capacity
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._valid = np.zeros(capacity, dtype=bool)
+        # 空きスロットは小さい番号から使う
+        self._free = list(range(capacity - 1, -1, -1))
+        self._high = 0
+        self._size = 0
+
+        # 転置リストは件数がIVF_MIN_SIZE以上になった時点で作成する
+        self._clusters: _Clusters | None = None
+        self._trained_size = 0
+        # クラスタの作成中に登録・削除したスロット。作成中でなければNoneとする
+        self._touched: set[int] | None = None
+
+    def __len__(self) -> int:
+        """登録されているベクトル数を返す."""
+        return self._size
+
+    def add(self, vector: np.ndarray) -> int:
+        """ベクトルを登録する.
+
+        Args:
+            vector: 正規化済みのベクトル
+
+        Returns:
+            int: 登録したスロット
+
+        """
+        slot = self._free.pop()
+        self._vectors[slot] = vector
+        self._valid[slot] = True
+        self._high = max(self._high, slot + 1)
+        self._size += 1
+
+        if self._clusters is not None:
+            self._clusters.assign(np.array([slot]), self._vectors)
+        if self._touched is not None:
+            self._touched.add(slot)
+        return slot
+
+    def remove(self, slot: int) -> None:
+        """スロットのベクトルを削除する.
+
+        Args:
+            slot: 削除するスロット
+
+        """
+        if not self._valid[slot]:
+            return
+        self._valid[slot] = False
+        self._free.append(slot)
+        self._size -= 1
+        if self._clusters is not None:
+            self._clusters.unassign(slot)
+        if self._touched is not None:
+            self._touched.add(slot)
+
+    def needs_training(self) -> bool:
+        """クラスタを作り直す必要があるかどうかを判定する.
+
+        Returns:
+            bool: 件数がクラスタの作成時から倍になり、作成中でなければTrue
+
+        """
+        return (
+            self._touched is None
+            and self._size >= IVF_MIN_SIZE
+            and self._size >= 2 * self._trained_size
+        )
+
+    def search(self, query: np.ndarray) -> tuple[int, float]:
+        """最も類似度が高いベクトルを検索する.
+
+        Args:
+            query: 正規化済みの検索ベクトル
+
+        Returns:
+            tuple[int, float]: スロットと類似度(登録が無い場合は(-1, -inf))
+
+        """
+        if self._size == 0:
+            return -1, float("-inf")
+        if self._clusters is None:
+            scores = self._vectors[: self._high] @ query
+            scores[~self._valid[: self._high]] = -np.inf
+            slot = int(np.argmax(scores))
+            return slot, float(scores[slot])
+
+        lists = self._clusters.lists
+        centroid_scores = self._clusters.centroids @ query
+        nprobe = min(IVF_NPROBE, len(lists))
+        probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        best_slot, best_score = -1, float("-inf")
+        for list_id in probes:
+            inverted = lists[list_id]
+            if inverted.size == 0:
+                continue
+            scores = inverted.vectors[: inverted.size] @ query
+            position = int(np.argmax(scores))
+            if scores[position] > best_score:
+                best_slot = int(inverted.slots[position])
+                best_score = float(scores[position])
+        return best_slot, best_score
+
+    def start_training(self) -> np.ndarray:
+        """クラスタの作成を開始し、作成に使う登録済みのスロットを返す.
+
+        作成中に登録・削除されたスロットを記録するため、trainより前に
+        イベントループから呼び出す。
+
+        Returns:
+            np.ndarray: 作成開始時点で登録されているスロット
+
+        """
+        self._touched = set()
+        return np.flatnonzero(self._valid)
+
+    async def train(self, slots: np.ndarray) -> None:
+        """クラスタを別スレッドで作成し、完了後に切り替える.
+
+        作成中に登録・削除されたスロットも別スレッドで反映し、
+        イベントループでは最後に残ったスロットのみを反映する。
+
+        Args:
+            slots: start_trainingが返したスロット
+
+        """
+        try:
+            clusters = await asyncio.to_thread(self._build_clusters, slots)
+            for _ in range(TRAINING_CATCH_UP_ROUNDS):
+                if len(self._touched) <= ASSIGN_BATCH_SIZE:
+                    break
+                await asyncio.to_thread(
+                    self._update_clusters, clusters, self._take_touched()
+                )
+            self._update_clusters(clusters, self._take_touched())
+        finally:
+            self._touched = None
+        self._clusters = clusters
+        self._trained_size = self._size
+
+    def _take_touched(self) -> np.ndarray:
+        """クラスタの作成中に登録・削除されたスロットを取り出す."""
+        touched = self._touched
+        self._touched = set()
+        return np.array(sorted(touched), dtype=np.int64)
+
+    def _build_clusters(self, slots: np.ndarray) -> _Clusters:
+        """登録済みのベクトルからk-meansでクラスタを作成し、転置リストを作成する.
+
+        インデックスの状態は変更しないため、別スレッドで実行できる。
+
+        Args:
+            slots: 作成開始時点で登録されているスロット
+
+        Returns:
+            _Clusters: 作成したクラスタと転置リスト
+
+        """
+        nlist = max(int(IVF_LISTS_PER_SQRT * np.sqrt(len(slots))), 1)
+        rng = np.random.default_rng(0)
+        sample_size = min(len(slots), nlist * KMEANS_SAMPLES_PER_LIST)
+        sample = self._vectors[rng.choice(slots, sample_size, replace=False)]
+
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # 空のクラスタは前回の中心を使う
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        clusters = _Clusters(centroids.astype(np.float32), self.capacity)
+        clusters.assign(slots, self._vectors)
+        return clusters
+
+    def _update_clusters(self, clusters: _Clusters, slots: np.ndarray) -> None:
+        """登録・削除されたスロットを作成中のクラスタに反映する.
+
+        書き換えられたベクトルは、現在のベクトルで登録し直す。反映中に
+        さらに書き換えられたスロットは、次に取り出した際に反映し直す。
+
+        Args:
+            clusters: 作成中のクラスタと転置リスト
+            slots: 登録・削除されたスロット
+
+        """
+        for slot in slots:
+            clusters.unassign(slot)
+        clusters.assign(slots[self._valid[slots]], self._vectors)
+
+
+class SemanticCache:
+    """質問の埋め込みベクトルの類似度で応答を再利用するキャッシュ.
+
+    質問数が上限を超えると、最も長く使われていない質問から削除する。
+    """
+
+    def __init__(
+        self,
+        client: "LLMClient",
+        threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+        capacity: int = DEFAULT_CAPACITY,
+    ) -> None:
+        """キャッシュを初期化.
+
+        Args:
+            client: 埋め込みベクトルの取得に使うLLMクライアント
+            threshold: 応答を再利用するコサイン類似度の閾値
+            capacity: キャッシュする質問数の上限
+
+        """
+        self.client = client
+        self.threshold = threshold
+        self.capacity = capacity
+        self._index: VectorIndex | None = None
+        self._answers: dict[int, str] = {}
+        self._keys: dict[int, str] = {}
+        self._exact: dict[str, int] = {}
+        self._lru: OrderedDict[int, None] = OrderedDict()
+        self._pending_vectors: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._training: asyncio.Task[None] | None = None
+
+    async def _embed(self, key: str) -> np.ndarray | None:
+        """正規化した質問の埋め込みベクトルを取得する.
+
+        Args:
+            key: 正規化した質問
+
+        Returns:
+            np.ndarray | None: 正規化したベクトル(取得できない場合はNone)
+
+        """
+        vector = self._pending_vectors.pop(key, None)
+        if vector is not None:
+            return vector
+
+        embedding = await self.client.embed(key)
+        if not embedding:
+            return None
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        return vector / norm
+
+    async def lookup(self, question: str) -> str | None:
+        """類似した質問の応答を取得する.
+
+        Args:
+            question: ユーザーの質問
+
+        Returns:
+            str | None: キャッシュされた応答(見つからない場合はNone)
+
+        """
+        key = normalize_question(question)
+        slot = self._exact.get(key)
+        if slot is None:
+            vector = await self._embed(key)
+            if vector is None or self._index is None or len(vector) != self._index.dim:
+                return None
+            slot, score = self._index.search(vector)
+            if slot < 0 or score < self.threshold:
+                # 登録時に再計算しないよう、ベクトルを保持しておく
+                self._pending_vectors[key] = vector
+                while len(self._pending_vectors) > PENDING_VECTORS_SIZE:
+                    self._pending_vectors.popitem(last=False)
+                return None
+
+        self._lru.move_to_end(slot)
+        return self._answers[slot]
+
+    async def store(self, question: str, answer: str) -> None:
+        """質問と応答をキャッシュに登録する.
+
+        Args:
+            question: ユーザーの質問
+            answer: 応答
+
+        """
+        key = normalize_question(question)
+        slot = self._exact.get(key)
+        if slot is not None:
+            self._answers[slot] = answer
+            self._lru.move_to_end(slot)
+            return
+
+        vector = await self._embed(key)
+        if vector is None:
+            return
+        if self._index is None:
+            self._index = VectorIndex(len(vector), self.capacity)
+        elif len(vector) != self._index.dim:
+            return
+
+        if len(self._index) >= self.capacity:
+            self._evict()
+        slot = self._index.add(vector)
+        self._answers[slot] = answer
+        self._keys[slot] = key
+        self._exact[key] = slot
+        self._lru[slot] = None
+
+        if self._index.needs_training():
+            # 件数が倍になるたびに、別スレッドでクラスタを作り直す
+            slots = self._index.start_training()
+            self._training = asyncio.create_task(self._train_index(self._index, slots))
+
+    async def _train_index(self, index: VectorIndex, slots: np.ndarray) -> None:
+        """インデックスのクラスタを作り直す.
+
+        Args:
+            index: クラスタを作成するインデックス
+            slots: 作成開始時点で登録されているスロット
+
+        """
+        try:
+            await index.train(slots)
+        except Exception:
+            logger.exception("セマンティックキャッシュのクラスタの作成に失敗しました")
+        finally:
+            self._training = None
+
+    def _evict(self) -> None:
+        """最も長く使われていない質問を削除する."""
+        slot, _ = self._lru.popitem(last=False)
+        self._index.remove(slot)
+        del self._answers[slot]
+        del self._exact[self._keys.pop(slot)]
@@ -1,14 +1,13 @@
 """シンプルな対話を管理するモジュール."""
 
-import asyncio
-import json
-from collections.abc import AsyncGenerator, Callable
-from typing import Any
+from collections.abc import AsyncGenerator, Awaitable, Callable, Sequence
+from typing import TYPE_CHECKING
 
-import requests
+from nexus_magi.llm_client import LLMClient, is_error_response
+from nexus_magi.message_history import Message
 
-# HTTPステータスコード
-HTTP_OK = 200
+if TYPE_CHECKING:
+    from nexus_magi.semantic_cache import SemanticCache
 
 
 class SimpleChatModel:
@@ -16,139 +15,84 @@ class SimpleChatModel:
 
     def __init__(
         self,
-        api_base: str = "http://localhost:11434/api",
+        api_base: str | None = "http://localhost:11434/api",
         model: str = "phi4-mini",
         api_type: str = "ollama",
+        semantic_cache: "SemanticCache | None" = None,
     ) -> None:
         """チャットモデルを初期化.
 
         Args:
             api_base: APIサーバーのベースURL
             model: 使用するモデル名
-            api_type: APIの種類("ollama" または "litellm")
+            api_type: APIの種類("ollama"、"litellm" または "litellm_sdk")
+            semantic_cache: 応答を再利用するセマンティックキャッシュ
 
         """
         self.api_base = api_base
         self.model = model
         self.api_type = api_type
+        self.client = LLMClient(api_base=api_base, model=model, api_type=api_type)
+        self.semantic_cache = semantic_cache
 
-    def _call_ollama_api(self, messages: list[dict[str, str]]) -> str:
-        """OllamaのAPIを呼び出して応答を取得する.
-
-        Args:
-            messages: これまでの会話履歴
-
-        Returns:
-            str: LLMからの応答
-
-        """
-        # Ollamaの場合、会話履歴を整形する
-        formatted_messages = [
-            {"role": msg["role"], "content": msg["content"]} for msg in messages
-        ]
-
-        # APIリクエストを送信する
-        response = requests.post(
-            f"{self.api_base}/chat",
-            json={
-                "model": self.model,
-                "messages": formatted_messages,
-                "stream": False,
-            },
-            timeout=60,
-        )
-
-        if response.status_code != HTTP_OK:
-            return f"エラーが発生しました: {response.status_code} - {response.text}"
-
-        try:
-            result = response.json()
-            # Ollamaの応答形式に合わせてパースする
-            # Ollamaの応答は {"message": {"content": "応答テキスト"}} 形式
-            return result["message"]["content"]
-        except (KeyError, json.JSONDecodeError) as e:
-            return f"応答の解析に失敗しました: {e!s}"
-
-    def _call_litellm_api(self, messages: list[dict[str, str]]) -> str:
-        """LiteLLMのAPIを呼び出して応答を取得する.
+    async def get_response(
+        self,
+        messages: Sequence[Message],
+        on_delta: Callable[[str], Awaitable[None]] | None = None,
+    ) -> str:
+        """会話履歴を元に次の応答を生成する.
 
         Args:
             messages: これまでの会話履歴
+            on_delta: 新たに生成された部分を受け取るコールバック関数
 
         Returns:
-            str: LLMからの応答
-
-        """
-        # LiteLLMの場合、会話履歴を整形する
-        formatted_messages = [
-            {"role": msg["role"], "content": msg["content"]} for msg in messages
-        ]
-
-        # APIリクエストを送信する
-        response = requests.post(
-            f"{self.api_base}/chat/completions",
-            json={
-                "model": self.model,
-                "messages": formatted_messages,
-                "stream": False,
-            },
-            timeout=60,
-        )
-
-        if response.status_code != HTTP_OK:
-            return f"エラーが発生しました: {response.status_code} - {response.text}"
-
-        try:
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
-        except (KeyError, json.JSONDecodeError) as e:
-            return f"応答の解析に失敗しました: {e!s}"
-
-    def _call_api(self, messages: list[dict[str, Any]]) -> str:
-        """APIタイプに応じて適切なAPI呼び出しを行う.
-
-        Args:
-            messages: メッセージリスト
-
-        Returns:
-            str: API呼び出しの結果
+            str: LLMからの単一の応答
 
         """
-        if self.api_type == "ollama":
-            return self._call_ollama_api(messages)
-        return self._call_litellm_api(messages)
+        question = None
+        if self.semantic_cache is not None:
+            from nexus_magi.semantic_cache import get_cacheable_question
 
-    async def get_response(self, messages: list[dict[str, str]]) -> str:
-        """会話履歴を元に次の応答を生成する.
+            question = get_cacheable_question(messages)
 
-        Args:
-            messages: これまでの会話履歴
+        if question is not None:
+            cached = await self.semantic_cache.lookup(question)
+            if cached is not None:
+                return cached
 
-        Returns:
-            str: LLMからの単一の応答
+        response = await self.client.call(messages, on_delta=on_delta)
 
-        """
-        # 非同期で実行するために、ThreadPoolExecutorを使用
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, lambda: self._call_api(messages))
+        if question is not None and not is_error_response(response):
+            await self.semantic_cache.store(question, response)
+        return response
 
     async def get_response_streaming(
         self,
-        messages: list[dict[str, str]],
+        messages: Sequence[Message],
         callback: Callable[[str, str], None] | None = None,
+        delta_callback: Callable[[str, str], Awaitable[None]] | None = None,
     ) -> AsyncGenerator[dict[str, str], None]:
         """会話履歴を元に次の応答を生成し、結果をストリーミングで返す.
 
         Args:
             messages: これまでの会話履歴
             callback: 応答を受け取るコールバック関数
+            delta_callback: 生成途中の応答の、新たに生成された部分を受け取る
+                コールバック関数
 
         Yields:
             dict: チャットモデルの応答状態の更新
 
         """
+
+        # ストリーミングに対応したAPIでは、生成された部分を逐次送信する
+        async def send_delta(delta: str) -> None:
+            if delta_callback:
+                await delta_callback("melchior", delta)
+
         # 単一の応答を取得
-        response = await self.get_response(messages)
+        response = await self.get_response(messages, on_delta=send_delta)
 
         # コールバックを実行
         if callback:
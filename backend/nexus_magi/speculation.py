@@ -0,0 +1,97 @@
+"""入力途中の質問から初期応答を先行して生成するモジュール.
+
+ユーザーが送信する前の入力(下書き)を受け取った時点で、各ペルソナの初期応答の
+生成を投機的に開始する。送信された質問が下書きと一致するか、下書きをわずかに
+書き足しただけの場合は先行して生成した応答を初期応答として使用し、
+そうでない場合は生成を取り消す。
+"""
+
+import asyncio
+import unicodedata
+from collections.abc import Coroutine, Sequence
+from typing import Any
+
+from nexus_magi.message_history import Message
+
+# 下書きを書き足した質問に応答を再利用する、質問に対する下書きの長さの割合の下限
+SPECULATION_PREFIX_RATIO = 0.9
+
+
+def _normalize_question(question: str) -> str:
+    """比較のために質問の表記揺れを取り除く.
+
+    Args:
+        question: 質問
+
+    Returns:
+        str: 全角・半角の違いと前後の空白を除いた質問
+
+    """
+    return unicodedata.normalize("NFKC", question).strip()
+
+
+class Speculation:
+    """下書きから先行して生成している各ペルソナの初期応答."""
+
+    def __init__(self, messages: Sequence[Message]) -> None:
+        """先行生成を初期化.
+
+        Args:
+            messages: 最後のメッセージを下書きとした会話履歴
+
+        """
+        self.messages = messages
+        self._tasks: dict[str, asyncio.Task[str]] = {}
+
+    def start(self, persona_id: str, generate: Coroutine[Any, Any, str]) -> None:
+        """ペルソナの初期応答の生成を開始する.
+
+        Args:
+            persona_id: ペルソナのID
+            generate: 初期応答を生成するコルーチン
+
+        """
+        self._tasks[persona_id] = asyncio.create_task(generate)
+
+    def matches(self, messages: Sequence[Message]) -> bool:
+        """会話履歴に対して先行生成した応答を再利用できるかどうかを判定する.
+
+        それまでの会話履歴が同じで、最後の質問が下書きと一致するか、
+        下書きに短い語句を書き足しただけの場合に再利用できる。
+
+        Args:
+            messages: 送信された会話履歴
+
+        Returns:
+            bool: 再利用できる場合はTrue
+
+        """
+        if not messages or messages[:-1] != self.messages[:-1]:
+            return False
+        if messages[-1]["role"] != self.messages[-1]["role"]:
+            return False
+        draft = _normalize_question(self.messages[-1]["content"])
+        question = _normalize_question(messages[-1]["content"])
+        if not draft or not question.startswith(draft):
+            return False
+        return len(draft) >= len(question) * SPECULATION_PREFIX_RATIO
+
+    def take(self, persona_id: str) -> asyncio.Task[str] | None:
+        """ペルソナの初期応答の生成を引き取る.
+
+        引き取った生成は取り消しの対象から外れる。
+
+        Args:
+            persona_id: ペルソナのID
+
+        Returns:
+            asyncio.Task[str] | None: 初期応答を生成するタスク(無い場合はNone)
+
+        """
+        return self._tasks.pop(persona_id, None)
+
+    def cancel(self) -> None:
+        """引き取られていない生成を全て取り消す."""
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
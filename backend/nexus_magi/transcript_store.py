@@ -0,0 +1,552 @@
+"""会話履歴と討論の記録をSQLiteに保存するモジュール.
+
+会話IDごとに、ユーザーのメッセージと各システムの応答(初期応答、討論の各ラウンド、
+合議結果)を記録する。会話には所有者を表す値(会話の開始時にクライアントへ返した
+トークンのハッシュ値)を記録し、所有者の確認に使用する。記録はキューに追加するだけで返り、バックグラウンドのタスクが
+短い間隔内に追加された記録をまとめて1回のトランザクションで書き込むため、
+応答をクライアントへ送信する処理を待たせない。
+
+データベースはWALモードで使用し、接続は専用の1つのスレッドからのみ操作する。
+保持期間を過ぎた会話の削除と、古い会話の途中経過の削除は定期的に行う。
+"""
+
+import asyncio
+import logging
+import sqlite3
+import time
+from collections.abc import Awaitable, Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TypeVar
+
+from nexus_magi.message_history import Message
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# まとめて書き込む記録の数の上限
+DEFAULT_BATCH_SIZE = 256
+
+# 記録をまとめるために待つ秒数
+DEFAULT_FLUSH_INTERVAL = 0.05
+
+# 会話を保持する日数
+DEFAULT_RETENTION_DAYS = 30.0
+
+# 途中経過(合議結果以外の応答)を保持する日数
+DEFAULT_COMPACT_AFTER_DAYS = 1.0
+
+# 保持期間を過ぎた記録の削除を行う間隔の秒数
+MAINTENANCE_INTERVAL = 3600.0
+
+# 1ページで返す記録の数の上限
+MAX_PAGE_SIZE = 500
+
+SECONDS_PER_DAY = 86400.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL,
+    owner TEXT
+);
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    role TEXT NOT NULL,
+    phase TEXT,
+    route TEXT,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_conversation ON entries (conversation_id, id);
+CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at);
+"""
+
+# 記録の種類
+MESSAGE_KIND = "message"
+FRAME_KIND = "frame"
+
+# 次の質問の会話履歴に含める合議結果の応答
+FINAL_SYSTEM = "consensus"
+FINAL_PHASE = "final"
+
+
+@dataclass
+class TranscriptEntry:
+    """保存された1つの記録."""
+
+    id: int
+    # "message"(会話履歴のメッセージ)または"frame"(システムの応答)
+    kind: str
+    # メッセージの役割、または応答を生成したシステム
+    role: str
+    phase: str | None
+    route: str | None
+    content: str
+    created_at: float
+
+
+@dataclass
+class TranscriptPage:
+    """会話の記録の1ページ."""
+
+    # 古い順に並べた記録
+    entries: list[TranscriptEntry]
+    # さらに古い記録を取得する場合にbeforeに指定する値、無い場合はNone
+    next_before: int | None
+
+
+# キューに追加する記録(会話ID、種類、役割、フェーズ、経路、内容、時刻)
+_Row = tuple[str, str, str, str | None, str | None, str, float]
+
+
+class TranscriptStore:
+    """会話の記録を保存するクラス."""
+
+    def __init__(
+        self,
+        path: Path,
+        *,
+        retention_days: float = DEFAULT_RETENTION_DAYS,
+        compact_after_days: float = DEFAULT_COMPACT_AFTER_DAYS,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+    ) -> None:
+        """記録の保存先を初期化.
+
+        Args:
+            path: SQLiteのデータベースファイル
+            retention_days: 最後の記録から会話を保持する日数
+            compact_after_days: 合議結果以外の応答を保持する日数
+            batch_size: まとめて書き込む記録の数の上限
+            flush_interval: 記録をまとめるために待つ秒数
+
+        """
+        self.path = path
+        self.retention_days = retention_days
+        self.compact_after_days = compact_after_days
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue[_Row | asyncio.Future[None]] = asyncio.Queue()
+        # SQLiteの接続はこのスレッドでのみ使用する
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="transcript-store"
+        )
+        self._connection: sqlite3.Connection | None = None
+        self._tasks: list[asyncio.Task[None]] = []
+
+    async def start(self) -> None:
+        """データベースを開き、書き込みと定期的な削除のタスクを開始する."""
+        await self._run(self._open)
+        self._tasks = [
+            asyncio.create_task(self._write_loop()),
+            asyncio.create_task(self._maintenance_loop()),
+        ]
+
+    async def close(self) -> None:
+        """未書き込みの記録を書き込み、データベースを閉じる."""
+        if self._tasks:
+            await self.flush()
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks = []
+        await self._run(self._close)
+        self._executor.shutdown()
+
+    def append_messages(
+        self, conversation_id: str, messages: Iterable[Message]
+    ) -> None:
+        """会話履歴のメッセージを記録する.
+
+        Args:
+            conversation_id: 会話ID
+            messages: 記録するメッセージ
+
+        """
+        now = time.time()
+        for message in messages:
+            self._queue.put_nowait(
+                (
+                    conversation_id,
+                    MESSAGE_KIND,
+                    message.role,
+                    None,
+                    None,
+                    message.content,
+                    now,
+                )
+            )
+
+    def append_frame(
+        self,
+        conversation_id: str,
+        system: str,
+        response: str,
+        phase: str,
+        route: str | None = None,
+    ) -> None:
+        """システムの応答を記録する.
+
+        キューに追加するだけで、書き込みの完了は待たない。
+
+        Args:
+            conversation_id: 会話ID
+            system: 応答を生成したシステム
+            response: 応答の内容
+            phase: 応答のフェーズ
+            route: カスケードモードで選択された経路
+
+        """
+        self._queue.put_nowait(
+            (conversation_id, FRAME_KIND, system, phase, route, response, time.time())
+        )
+
+    def record_frames(
+        self, conversation_id: str, callback: Callable[..., Awaitable[None]]
+    ) -> Callable[..., Awaitable[None]]:
+        """応答を受け取るコールバックに、応答の記録を追加する.
+
+        Args:
+            conversation_id: 会話ID
+            callback: 各システムの応答を受け取るコールバック関数
+
+        Returns:
+            Callable: 応答を記録してから元のコールバックを呼び出す関数
+
+        """
+
+        async def record(
+            system: str, response: str, phase: str, route: str | None = None
+        ) -> None:
+            self.append_frame(conversation_id, system, response, phase, route)
+            await callback(system, response, phase, route)
+
+        return record
+
+    async def claim(self, conversation_id: str, owner: str) -> bool:
+        """会話の所有者が、指定した値と一致するかを確認する.
+
+        所有者のいない会話には、指定した値を所有者として記録する。
+
+        Args:
+            conversation_id: 会話ID
+            owner: 所有者を表す値
+
+        Returns:
+            bool: 会話の所有者と一致する場合はTrue
+
+        """
+        return await self._run(self._claim, conversation_id, owner, time.time())
+
+    async def get_owner(self, conversation_id: str) -> str | None:
+        """会話の所有者を取得する.
+
+        Args:
+            conversation_id: 会話ID
+
+        Returns:
+            str | None: 所有者を表す値(会話または所有者が無い場合はNone)
+
+        """
+        return await self._run(self._select_owner, conversation_id)
+
+    async def flush(self) -> None:
+        """キューに追加済みの記録の書き込みを待つ."""
+        if not self._tasks:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(waiter)
+        await waiter
+
+    async def load_messages(self, conversation_id: str) -> list[Message]:
+        """会話履歴として使用するメッセージを読み込む.
+
+        記録したメッセージと合議結果を古い順に並べ、合議結果は
+        アシスタントのメッセージとして扱う。
+
+        Args:
+            conversation_id: 会話ID
+
+        Returns:
+            list[Message]: 会話履歴
+
+        """
+        await self.flush()
+        rows = await self._run(self._select_messages, conversation_id)
+        return [Message(role=role, content=content) for role, content in rows]
+
+    async def load_page(
+        self, conversation_id: str, before: int | None = None, limit: int = 50
+    ) -> TranscriptPage:
+        """会話の記録を新しい方から1ページ分読み込む.
+
+        Args:
+            conversation_id: 会話ID
+            before: この値より前の記録を読み込む(Noneの場合は最新から)
+            limit: 1ページの記録の数
+
+        Returns:
+            TranscriptPage: 古い順に並べた記録と、次のページの位置
+
+        """
+        await self.flush()
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        rows = await self._run(self._select_page, conversation_id, before, limit + 1)
+        has_more = len(rows) > limit
+        entries = [TranscriptEntry(*row) for row in reversed(rows[:limit])]
+        next_before = entries[0].id if has_more and entries else None
+        return TranscriptPage(entries=entries, next_before=next_before)
+
+    async def compact(self) -> None:
+        """保持期間を過ぎた記録を削除し、データベースファイルを縮小する."""
+        await self._run(self._compact, time.time())
+
+    async def _run(self, function: Callable[..., T], *args: object) -> T:
+        """データベース用のスレッドで関数を実行する.
+
+        Args:
+            function: 実行する関数
+            *args: 関数の引数
+
+        Returns:
+            T: 関数の戻り値
+
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    async def _write_loop(self) -> None:
+        """キューの記録をまとめて書き込み続ける."""
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(items) < self.batch_size and not isinstance(
+                items[-1], asyncio.Future
+            ):
+                try:
+                    items.append(
+                        await asyncio.wait_for(
+                            self._queue.get(), max(deadline - loop.time(), 0)
+                        )
+                    )
+                except TimeoutError:
+                    break
+
+            rows = [item for item in items if not isinstance(item, asyncio.Future)]
+            try:
+                if rows:
+                    await self._run(self._insert, rows)
+            except Exception:
+                # 書き込みに失敗しても、後続の記録の書き込みは続ける
+                logger.exception("会話の記録の書き込みに失敗しました")
+            finally:
+                # 書き込みを待っている処理は、成否に関わらず再開させる
+                for item in items:
+                    if isinstance(item, asyncio.Future) and not item.done():
+                        item.set_result(None)
+
+    async def _maintenance_loop(self) -> None:
+        """保持期間を過ぎた記録を定期的に削除する."""
+        while True:
+            try:
+                await self.compact()
+            except Exception:
+                # 削除に失敗しても、次の間隔で再び削除する
+                logger.exception("会話の記録の削除に失敗しました")
+            await asyncio.sleep(MAINTENANCE_INTERVAL)
+
+    def _open(self) -> None:
+        """データベースを開き、テーブルを作成する."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.path, isolation_level=None)
+        # 削除した領域をcompactで解放できるように、テーブルの作成前に設定する
+        connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.execute("PRAGMA journal_mode = WAL")
+        # WALモードではNORMALでもデータベースの破損は起きない
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.executescript(SCHEMA)
+        columns = {
+            row[1] for row in connection.execute("PRAGMA table_info(conversations)")
+        }
+        if "owner" not in columns:
+            # 所有者を記録する前に作成したデータベースに列を追加する
+            connection.execute("ALTER TABLE conversations ADD COLUMN owner TEXT")
+        self._connection = connection
+
+    def _close(self) -> None:
+        """データベースを閉じる."""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _insert(self, rows: list[_Row]) -> None:
+        """記録を1回のトランザクションで書き込む.
+
+        Args:
+            rows: 書き込む記録
+
+        """
+        updated: dict[str, float] = {}
+        for row in rows:
+            updated[row[0]] = max(updated.get(row[0], 0.0), row[-1])
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT INTO entries "
+                "(conversation_id, kind, role, phase, route, content, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            connection.executemany(
+                "INSERT INTO conversations (id, updated_at) VALUES (?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET updated_at = excluded.updated_at",
+                updated.items(),
+            )
+
+    def _claim(self, conversation_id: str, owner: str, now: float) -> bool:
+        """所有者のいない会話に所有者を記録し、所有者と一致するかを返す.
+
+        Args:
+            conversation_id: 会話ID
+            owner: 所有者を表す値
+            now: 現在の時刻
+
+        Returns:
+            bool: 会話の所有者と一致する場合はTrue
+
+        """
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT INTO conversations (id, updated_at, owner) VALUES (?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET owner = excluded.owner "
+                "WHERE owner IS NULL",
+                (conversation_id, now, owner),
+            )
+        return self._select_owner(conversation_id) == owner
+
+    def _select_owner(self, conversation_id: str) -> str | None:
+        """会話の所有者を読み込む.
+
+        Args:
+            conversation_id: 会話ID
+
+        Returns:
+            str | None: 所有者を表す値(会話または所有者が無い場合はNone)
+
+        """
+        row = (
+            self._get_connection()
+            .execute("SELECT owner FROM conversations WHERE id = ?", (conversation_id,))
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def _select_messages(self, conversation_id: str) -> list[tuple[str, str]]:
+        """会話履歴として使用する記録を読み込む.
+
+        Args:
+            conversation_id: 会話ID
+
+        Returns:
+            list[tuple[str, str]]: 役割と内容の組のリスト
+
+        """
+        return (
+            self._get_connection()
+            .execute(
+                "SELECT CASE kind WHEN ? THEN role ELSE 'assistant' END, content "
+                "FROM entries WHERE conversation_id = ? "
+                "AND (kind = ? OR (role = ? AND phase = ?)) ORDER BY id",
+                (
+                    MESSAGE_KIND,
+                    conversation_id,
+                    MESSAGE_KIND,
+                    FINAL_SYSTEM,
+                    FINAL_PHASE,
+                ),
+            )
+            .fetchall()
+        )
+
+    def _select_page(
+        self, conversation_id: str, before: int | None, limit: int
+    ) -> list[tuple]:
+        """会話の記録を新しい順に読み込む.
+
+        Args:
+            conversation_id: 会話ID
+            before: この値より前の記録を読み込む(Noneの場合は最新から)
+            limit: 読み込む記録の数
+
+        Returns:
+            list[tuple]: 新しい順に並べた記録
+
+        """
+        return (
+            self._get_connection()
+            .execute(
+                "SELECT id, kind, role, phase, route, content, created_at FROM entries "
+                "WHERE conversation_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (conversation_id, before if before is not None else 2**63 - 1, limit),
+            )
+            .fetchall()
+        )
+
+    def _compact(self, now: float) -> None:
+        """保持期間を過ぎた会話と、古い途中経過を削除する.
+
+        Args:
+            now: 現在の時刻
+
+        """
+        expired = now - self.retention_days * SECONDS_PER_DAY
+        compacted = now - self.compact_after_days * SECONDS_PER_DAY
+        with self._transaction() as connection:
+            connection.execute(
+                "DELETE FROM entries WHERE conversation_id IN "
+                "(SELECT id FROM conversations WHERE updated_at < ?)",
+                (expired,),
+            )
+            connection.execute(
+                "DELETE FROM conversations WHERE updated_at < ?", (expired,)
+            )
+            # 会話履歴に必要なメッセージと合議結果は残す
+            connection.execute(
+                "DELETE FROM entries WHERE kind = ? AND created_at < ? "
+                "AND NOT (role = ? AND phase = ?)",
+                (FRAME_KIND, compacted, FINAL_SYSTEM, FINAL_PHASE),
+            )
+        connection = self._get_connection()
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.execute("PRAGMA incremental_vacuum")
+
+    def _transaction(self) -> sqlite3.Connection:
+        """トランザクションを開始した接続を取得する.
+
+        Returns:
+            sqlite3.Connection: withで使用するとコミットまたはロールバックする接続
+
+        """
+        connection = self._get_connection()
+        connection.execute("BEGIN")
+        return connection
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """データベースの接続を取得する.
+
+        Returns:
+            sqlite3.Connection: 接続
+
+        Raises:
+            RuntimeError: データベースを開いていない場合
+
+        """
+        if self._connection is None:
+            msg = "会話の記録のデータベースが開かれていません"
+            raise RuntimeError(msg)
+        return self._connection
@@ -0,0 +1,434 @@
+"""クライアントごとのLLMのトークン使用量を制限するモジュール.
+
+プロンプトと生成のトークン数の合計を、1分や1日などの期間ごとにクライアント単位で
+集計する。期間は一定の間隔の区間に分けて集計し、古い区間から順に期間外として
+捨てることで、期間の境目でまとめて使われることのない移動する期間の使用量とする。
+
+トークン数はバックエンドが返した実際の値を記録する。討論は開始前に全フェーズの
+トークン数を見積もって確保し、途中で上限に達して打ち切られる討論を開始しない。
+確保した量は実際の使用量の記録に合わせて減らす。
+
+API呼び出しの処理はリクエストの処理中に設定したスコープからクライアントを特定する。
+"""
+
+import contextvars
+import json
+import math
+import threading
+import time
+from collections import deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+# 1つの期間を分けて集計する区間の数
+WINDOW_BUCKETS = 60
+
+# 文字数からトークン数を見積もる際の1トークンあたりの文字数
+# 日本語は1文字、英語は4文字程度で1トークンとなるため、その間の値とする
+ESTIMATED_CHARS_PER_TOKEN = 2
+
+
+class QuotaExceededError(Exception):
+    """クライアントのトークン使用量が上限に達したことを表す例外."""
+
+    def __init__(self, message: str, retry_after: float) -> None:
+        """例外を初期化.
+
+        Args:
+            message: クライアントに表示するメッセージ
+            retry_after: 再び利用できるようになるまでの秒数
+
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class QuotaLimit:
+    """期間あたりのトークン数の上限."""
+
+    window_seconds: float
+    max_tokens: int
+
+
+def estimate_tokens(text: str) -> int:
+    """文字列のトークン数を見積もる.
+
+    Args:
+        text: 文字列
+
+    Returns:
+        int: 見積もったトークン数
+
+    """
+    return math.ceil(len(text) / ESTIMATED_CHARS_PER_TOKEN)
+
+
+class SlidingWindowCounter:
+    """期間内のトークン数を区間ごとに集計するクラス."""
+
+    def __init__(self, window_seconds: float, buckets: int = WINDOW_BUCKETS) -> None:
+        """集計を初期化.
+
+        Args:
+            window_seconds: 集計する期間の秒数
+            buckets: 期間を分ける区間の数
+
+        """
+        self.window_seconds = window_seconds
+        self.bucket_seconds = window_seconds / buckets
+        # 古い順に並べた、区間の開始時刻とトークン数の組
+        self._buckets: deque[list[float]] = deque()
+        self._total = 0
+
+    def add(self, now: float, tokens: int) -> None:
+        """トークン数を現在の区間に加算する.
+
+        Args:
+            now: 現在時刻(UNIX時間)
+            tokens: 加算するトークン数
+
+        """
+        start = now - now % self.bucket_seconds
+        if self._buckets and self._buckets[-1][0] == start:
+            self._buckets[-1][1] += tokens
+        else:
+            self._buckets.append([start, tokens])
+        self._total += tokens
+
+    def total(self, now: float) -> int:
+        """期間内のトークン数を取得する.
+
+        Args:
+            now: 現在時刻(UNIX時間)
+
+        Returns:
+            int: 期間内のトークン数
+
+        """
+        while self._buckets and self._buckets[0][0] + self.window_seconds <= now:
+            self._total -= int(self._buckets.popleft()[1])
+        return self._total
+
+    def retry_after(self, now: float, excess: int) -> float:
+        """期間内のトークン数が指定した量だけ減るまでの秒数を求める.
+
+        Args:
+            now: 現在時刻(UNIX時間)
+            excess: 減る必要のあるトークン数
+
+        Returns:
+            float: 秒数(期間内の使用量では足りない場合は期間の長さ)
+
+        """
+        freed = 0
+        for start, tokens in self._buckets:
+            freed += int(tokens)
+            if freed >= excess:
+                return max(start + self.window_seconds - now, 0.0)
+        return self.window_seconds
+
+    def to_list(self) -> list[list[float]]:
+        """保存用に区間ごとのトークン数を取得する.
+
+        Returns:
+            list: 区間の開始時刻とトークン数の組のリスト
+
+        """
+        return [list(bucket) for bucket in self._buckets]
+
+    def load(self, buckets: list[list[float]], now: float) -> None:
+        """保存した区間ごとのトークン数を読み込む.
+
+        Args:
+            buckets: 区間の開始時刻とトークン数の組のリスト
+            now: 現在時刻(UNIX時間)
+
+        """
+        for start, tokens in buckets:
+            if start + self.window_seconds > now:
+                self._buckets.append([start, tokens])
+                self._total += int(tokens)
+
+
+class ClientUsage:
+    """1つのクライアントの使用量."""
+
+    def __init__(self, limits: list[QuotaLimit]) -> None:
+        """使用量を初期化.
+
+        Args:
+            limits: 期間ごとの上限
+
+        """
+        self.counters = [SlidingWindowCounter(limit.window_seconds) for limit in limits]
+        # 実行中の討論のために確保したトークン数
+        self.reserved = 0
+
+
+@dataclass
+class QuotaScope:
+    """リクエストの処理中にトークン使用量を記録するクライアント."""
+
+    quota: "UsageQuota"
+    client_id: str
+    # このリクエストで確保したうち、まだ使用していないトークン数
+    reserved: int = 0
+
+
+class UsageQuota:
+    """クライアントごとのトークン使用量を期間ごとの上限と比較するクラス.
+
+    使用量の記録はスレッドプールから行われるため、内部状態はロックで保護する。
+    """
+
+    def __init__(self, limits: list[QuotaLimit], path: Path | None = None) -> None:
+        """制限を初期化.
+
+        Args:
+            limits: 期間ごとの上限
+            path: 使用量を保存するJSONファイル(Noneの場合は保存しない)
+
+        """
+        self.limits = limits
+        self.path = path
+        self._clients: dict[str, ClientUsage] = {}
+        self._lock = threading.Lock()
+
+    def _get_client(self, client_id: str) -> ClientUsage:
+        """クライアントの使用量を取得する(ロックを取得した状態で呼び出す).
+
+        Args:
+            client_id: クライアントの識別子
+
+        Returns:
+            ClientUsage: クライアントの使用量
+
+        """
+        if client_id not in self._clients:
+            self._clients[client_id] = ClientUsage(self.limits)
+        return self._clients[client_id]
+
+    def check(self, client_id: str, tokens: int = 0) -> None:
+        """指定したトークン数を使用できるかを確認する.
+
+        Args:
+            client_id: クライアントの識別子
+            tokens: これから使用するトークン数の見積もり
+
+        Raises:
+            QuotaExceededError: いずれかの期間の上限を超える場合
+
+        """
+        with self._lock:
+            self._check(self._get_client(client_id), tokens, time.time())
+
+    def _check(self, usage: ClientUsage, tokens: int, now: float) -> None:
+        """使用量と確保した量に見積もりを加えて上限と比較する.
+
+        Args:
+            usage: クライアントの使用量
+            tokens: これから使用するトークン数の見積もり
+            now: 現在時刻(UNIX時間)
+
+        Raises:
+            QuotaExceededError: いずれかの期間の上限を超える場合
+
+        """
+        for limit, counter in zip(self.limits, usage.counters, strict=True):
+            used = counter.total(now)
+            required = used + usage.reserved + tokens
+            if used < limit.max_tokens and required <= limit.max_tokens:
+                continue
+            if usage.reserved + tokens > limit.max_tokens:
+                # 使用量が減っても実行できないため、すぐに再試行しても失敗する
+                msg = (
+                    f"必要なトークン数の見積もり({usage.reserved + tokens})が"
+                    f"上限({limit.window_seconds:g}秒あたり{limit.max_tokens}"
+                    "トークン)を超えています。討論ラウンド数を減らすか、"
+                    "実行中の討論の完了後に再度お試しください"
+                )
+                raise QuotaExceededError(msg, limit.window_seconds)
+            retry_after = counter.retry_after(now, required - limit.max_tokens)
+            msg = (
+                f"トークンの使用量が上限({limit.window_seconds:g}秒あたり"
+                f"{limit.max_tokens}トークン)に達しました(使用量: {used})。"
+                f"{math.ceil(retry_after)}秒後に再度お試しください"
+            )
+            raise QuotaExceededError(msg, retry_after)
+
+    def reserve(self, scope: QuotaScope, tokens: int) -> None:
+        """討論で使用するトークン数を確保する.
+
+        Args:
+            scope: 処理中のリクエストのクライアント
+            tokens: 確保するトークン数
+
+        Raises:
+            QuotaExceededError: 確保するといずれかの期間の上限を超える場合
+
+        """
+        with self._lock:
+            usage = self._get_client(scope.client_id)
+            self._check(usage, tokens, time.time())
+            usage.reserved += tokens
+            scope.reserved += tokens
+
+    def release(self, scope: QuotaScope) -> None:
+        """リクエストで確保したトークン数のうち使用されなかった分を解放する.
+
+        Args:
+            scope: 処理中のリクエストのクライアント
+
+        """
+        with self._lock:
+            usage = self._get_client(scope.client_id)
+            usage.reserved = max(usage.reserved - scope.reserved, 0)
+            scope.reserved = 0
+
+    def record(self, scope: QuotaScope, tokens: int) -> None:
+        """実際に使用したトークン数を記録し、確保したトークン数をその分だけ減らす.
+
+        Args:
+            scope: 処理中のリクエストのクライアント
+            tokens: プロンプトと生成のトークン数の合計
+
+        """
+        with self._lock:
+            usage = self._get_client(scope.client_id)
+            now = time.time()
+            for counter in usage.counters:
+                counter.add(now, tokens)
+            used_reservation = min(tokens, scope.reserved)
+            usage.reserved = max(usage.reserved - used_reservation, 0)
+            scope.reserved -= used_reservation
+
+    def get_usage(self, client_id: str) -> list[int]:
+        """クライアントの期間ごとの使用量を取得する.
+
+        Args:
+            client_id: クライアントの識別子
+
+        Returns:
+            list[int]: 期間ごとの使用トークン数(limitsと同じ順序)
+
+        """
+        with self._lock:
+            usage = self._get_client(client_id)
+            now = time.time()
+            return [counter.total(now) for counter in usage.counters]
+
+    def load(self) -> None:
+        """保存した使用量を読み込む."""
+        if self.path is None or not self.path.exists():
+            return
+        data = json.loads(self.path.read_text())
+        now = time.time()
+        with self._lock:
+            for client_id, windows in data.get("clients", {}).items():
+                usage = self._get_client(client_id)
+                for counter in usage.counters:
+                    counter.load(windows.get(f"{counter.window_seconds:g}", []), now)
+
+    def save(self) -> None:
+        """使用量をファイルに保存する.
+
+        期間内の使用量が無いクライアントは保存せず、メモリからも削除する。
+        """
+        now = time.time()
+        with self._lock:
+            for client_id, usage in list(self._clients.items()):
+                if not usage.reserved and not any(
+                    counter.total(now) for counter in usage.counters
+                ):
+                    del self._clients[client_id]
+            data = {
+                "clients": {
+                    client_id: {
+                        f"{counter.window_seconds:g}": counter.to_list()
+                        for counter in usage.counters
+                    }
+                    for client_id, usage in self._clients.items()
+                }
+            }
+        if self.path is None:
+            return
+        # 書き込み途中で終了しても以前の内容が残るよう、置き換えで保存する
+        temporary = self.path.with_suffix(f"{self.path.suffix}.tmp")
+        temporary.write_text(json.dumps(data))
+        temporary.replace(self.path)
+
+
+# 処理中のリクエストのクライアント
+# タスクやasyncio.to_threadで実行する処理にも引き継がれる
+_current_scope: contextvars.ContextVar[QuotaScope | None] = contextvars.ContextVar(
+    "quota_scope", default=None
+)
+
+
+@contextmanager
+def quota_scope(quota: UsageQuota | None, client_id: str) -> Iterator[None]:
+    """処理中のリクエストのクライアントを設定する.
+
+    終了時には、確保したトークン数のうち使用されなかった分を解放する。
+
+    Args:
+        quota: 使用量の制限(Noneの場合は制限しない)
+        client_id: クライアントの識別子
+
+    Yields:
+        None: クライアントを設定した状態
+
+    """
+    if quota is None:
+        yield
+        return
+    scope = QuotaScope(quota, client_id)
+    token = _current_scope.set(scope)
+    try:
+        yield
+    finally:
+        _current_scope.reset(token)
+        quota.release(scope)
+
+
+def check_quota() -> None:
+    """処理中のリクエストのクライアントが上限に達していないかを確認する.
+
+    Raises:
+        QuotaExceededError: いずれかの期間の上限に達している場合
+
+    """
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.quota.check(scope.client_id)
+
+
+def reserve_tokens(tokens: int) -> None:
+    """処理中のリクエストのクライアントのトークン数を確保する.
+
+    Args:
+        tokens: 確保するトークン数
+
+    Raises:
+        QuotaExceededError: 確保するといずれかの期間の上限を超える場合
+
+    """
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.quota.reserve(scope, tokens)
+
+
+def charge_usage(prompt_tokens: int | None, completion_tokens: int | None) -> None:
+    """処理中のリクエストのクライアントの使用量を記録する.
+
+    Args:
+        prompt_tokens: プロンプトのトークン数
+        completion_tokens: 生成されたトークン数
+
+    """
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.quota.record(scope, (prompt_tokens or 0) + (completion_tokens or 0))
@@ -0,0 +1,137 @@
+"""各MAGIシステムの構造化された判定と多数決を扱うモジュール."""
+
+import json
+import unicodedata
+from collections import Counter
+from dataclasses import dataclass
+
+# 判定をJSONで返すように求める指示
+VERDICT_INSTRUCTION = (
+    "回答は次の形式のJSONオブジェクトのみで出力してください。"
+    '{"verdict": "結論を短い語句で", "confidence": 0から1の数値, '
+    '"rationale": "判断の理由を2文以内で"}'
+)
+
+
+@dataclass
+class Verdict:
+    """1つのMAGIシステムの判定."""
+
+    # 結論を表す短い語句
+    verdict: str
+    # 結論への確信度(0から1)
+    confidence: float
+    # 判断の理由
+    rationale: str
+
+
+@dataclass
+class VoteResult:
+    """多数決の結果."""
+
+    # 最多得票の結論、同数で決まらない場合はNone
+    verdict: str | None
+    # 最多得票の結論に投票したシステム
+    supporters: list[str]
+    # 有効な判定を返したシステム数
+    valid_votes: int
+
+
+def normalize_verdict(verdict: str) -> str:
+    """比較のために結論の表記揺れを取り除く.
+
+    Args:
+        verdict: 結論を表す語句
+
+    Returns:
+        str: 全角・半角、大文字・小文字、空白と句読点の違いを除いた語句
+
+    """
+    normalized = unicodedata.normalize("NFKC", verdict).lower()
+    return "".join(
+        char
+        for char in normalized
+        if not unicodedata.category(char).startswith(("P", "Z"))
+    )
+
+
+def parse_verdict(response: str) -> Verdict | None:
+    """JSONモードで生成された応答から判定を取り出す.
+
+    Args:
+        response: LLMからの応答
+
+    Returns:
+        Verdict | None: 判定(形式が正しくない場合はNone)
+
+    """
+    # JSONの前後に説明が付いた場合も読み取れるように、最初と最後の括弧で切り出す
+    start = response.find("{")
+    end = response.rfind("}")
+    if start < 0 or end < start:
+        return None
+    try:
+        data = json.loads(response[start : end + 1])
+        verdict = str(data["verdict"]).strip()
+        confidence = min(max(float(data.get("confidence", 0.0)), 0.0), 1.0)
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+        return None
+    if not verdict:
+        return None
+    return Verdict(
+        verdict=verdict,
+        confidence=confidence,
+        rationale=str(data.get("rationale", "")).strip(),
+    )
+
+
+def format_verdict(verdict: Verdict) -> str:
+    """判定を表示用の文字列に変換する.
+
+    Args:
+        verdict: 判定
+
+    Returns:
+        str: 表示用の文字列
+
+    """
+    return (
+        f"【判定】{verdict.verdict} (確信度: {verdict.confidence:.0%})\n"
+        f"{verdict.rationale}"
+    )
+
+
+def tally_verdicts(verdicts: dict[str, Verdict | None]) -> VoteResult:
+    """各システムの判定から多数決で結論を決める.
+
+    表記揺れを除いた結論ごとに得票数を数え、最多得票の結論が1つに決まれば
+    それを採用する。最多得票が同数の場合や有効な判定が無い場合は決定しない。
+
+    Args:
+        verdicts: システムごとの判定(形式が正しくない判定はNone)
+
+    Returns:
+        VoteResult: 多数決の結果
+
+    """
+    votes = {
+        system: normalize_verdict(verdict.verdict)
+        for system, verdict in verdicts.items()
+        if verdict is not None
+    }
+    counts = Counter(votes.values()).most_common()
+    if not counts or (len(counts) > 1 and counts[0][1] == counts[1][1]):
+        return VoteResult(verdict=None, supporters=[], valid_votes=len(votes))
+
+    winner = counts[0][0]
+    supporters = [system for system, vote in votes.items() if vote == winner]
+    # 表示には最も確信度の高い支持者の表記を使う
+    representative = max(
+        (verdicts[system] for system in supporters),
+        key=lambda verdict: verdict.confidence,
+    )
+    return VoteResult(
+        verdict=representative.verdict,
+        supporters=supporters,
+        valid_votes=len(votes),
+    )
@@ -0,0 +1 @@
+"""テスト."""
@@ -0,0 +1,238 @@
+"""APIサーバーのエンドポイントのテスト."""
+
+import asyncio
+import json
+from collections.abc import AsyncGenerator
+from functools import partial
+from pathlib import Path
+
+import pytest
+from fastapi import status
+from fastapi.requests import HTTPConnection
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+from nexus_magi import app as app_module
+from nexus_magi.api_gen.models import ChatRequest
+from nexus_magi.cascade_chat_model import DIRECT_MAX_TOKENS
+from nexus_magi.frame_encoder import FrameEncoder
+from nexus_magi.message_history import Message
+from nexus_magi.usage_quota import QuotaExceededError
+
+
+@pytest.fixture(autouse=True)
+def api_keys(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """接続を許可するAPIキーを設定する.
+
+    Args:
+        tmp_path: 一時ディレクトリ
+        monkeypatch: 設定を差し替えるフィクスチャ
+
+    """
+    api_keys_path = tmp_path / "api_keys.txt"
+    api_keys_path.write_text("valid-key\n")
+    monkeypatch.setattr(app_module.api_config, "api_keys_path", api_keys_path)
+    monkeypatch.setattr(app_module, "_api_keys", None)
+
+
+def create_connection(
+    headers: dict[str, str] | None = None, query: str = ""
+) -> HTTPConnection:
+    """接続元のアドレスが192.0.2.1の接続を作成する.
+
+    Args:
+        headers: リクエストヘッダー
+        query: クエリ文字列
+
+    Returns:
+        HTTPConnection: 接続
+
+    """
+    scope = {
+        "type": "http",
+        "headers": [
+            (name.encode(), value.encode()) for name, value in (headers or {}).items()
+        ],
+        "query_string": query.encode(),
+        "client": ("192.0.2.1", 50000),
+    }
+    return HTTPConnection(scope)
+
+
+def test_client_id_from_header_api_key() -> None:
+    """X-API-Keyヘッダーで送信されたAPIキーで識別し、許可されていない場合は拒否する."""
+    client_id = app_module.get_client_id(create_connection({"x-api-key": "valid-key"}))
+    assert client_id is not None
+    assert client_id.startswith("key:")
+    assert app_module.get_client_id(create_connection({"x-api-key": "wrong"})) is None
+
+
+def test_keyless_client_is_rejected_by_default() -> None:
+    """APIキーを設定した場合、APIキーの無い接続は拒否する."""
+    assert app_module.get_client_id(create_connection()) is None
+    # URLのAPIキーは受け付けない
+    connection = create_connection(query="api_key=valid-key")
+    assert app_module.get_client_id(connection) is None
+
+    client = TestClient(app_module.app)
+    with (
+        pytest.raises(WebSocketDisconnect),
+        client.websocket_connect("/api/debate/ws") as websocket,
+    ):
+        websocket.receive_text()
+    response = client.get("/api/conversations/c1")
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_keyless_client_with_allow_anonymous(monkeypatch: pytest.MonkeyPatch) -> None:
+    """匿名の接続を許可した場合、APIキーの無い接続は接続元のアドレスで識別する."""
+    monkeypatch.setattr(app_module.api_config, "allow_anonymous", True)
+    assert app_module.get_client_id(create_connection()) == "addr:192.0.2.1"
+    # 許可されていないAPIキーは、匿名の接続を許可しても拒否する
+    assert app_module.get_client_id(create_connection({"x-api-key": "wrong"})) is None
+
+
+def test_conversation_rejects_unknown_api_key() -> None:
+    """会話の記録の取得でも、許可されていないAPIキーは拒否する."""
+    client = TestClient(app_module.app)
+    response = client.get("/api/conversations/c1", headers={"x-api-key": "wrong"})
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+    # 許可されたAPIキーは受け付ける。記録を保存していないため見つからない
+    response = client.get("/api/conversations/c1", headers={"x-api-key": "valid-key"})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_chat_rejects_conversation_id() -> None:
+    """通常チャットは会話を記録しないため、会話IDを指定したリクエストを断る."""
+    client = TestClient(app_module.app)
+    with client.websocket_connect(
+        "/api/chat/ws", headers={"x-api-key": "valid-key"}
+    ) as websocket:
+        websocket.send_json(
+            {
+                "messages": [{"role": "user", "content": "こんにちは"}],
+                "conversation_id": "c1",
+            }
+        )
+        frame = websocket.receive_json()
+    assert frame["phase"] == "rejected"
+
+
+def test_conversation_requires_token(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """会話は開始時に返したトークンでのみ続けたり取得したりできる."""
+    monkeypatch.setattr(app_module.api_config, "store_path", tmp_path / "t.db")
+    headers = {"x-api-key": "valid-key"}
+    with TestClient(app_module.app, headers=headers) as client:
+
+        def open_conversation(
+            token: str | None = None, *, draft: bool = False
+        ) -> str | None:
+            request = ChatRequest(
+                messages=[], conversation_id="c1", conversation_token=token
+            )
+            return client.portal.call(
+                partial(app_module.open_conversation, request, create=not draft)
+            )
+
+        # 下書きでは会話を開始しない
+        assert open_conversation(draft=True) is None
+        token = open_conversation()
+        assert token is not None
+        assert open_conversation(token) is None
+        # 同じ会話IDでも、トークンが無いか一致しないクライアントは使用できない
+        for other in (None, "guessed"):
+            with pytest.raises(app_module.ConversationAccessError):
+                open_conversation(other)
+
+        response = client.get(
+            "/api/conversations/c1", headers={"x-conversation-token": token}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        for other_headers in ({}, {"x-conversation-token": "guessed"}):
+            response = client.get("/api/conversations/c1", headers=other_headers)
+            assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_session_failure_is_sent_to_subscribers(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """共有する討論が途中で上限に達した場合も、購読者へ断った応答を送信する."""
+
+    async def exceed_quota(*_args: object, **_kwargs: object) -> AsyncGenerator:
+        msg = "トークンの使用量が上限に達しました"
+        raise QuotaExceededError(msg, 1.5)
+        yield
+
+    monkeypatch.setattr(app_module, "reserve_debate_tokens", lambda *_args: None)
+    monkeypatch.setattr(app_module, "create_debate_responses", exceed_quota)
+    request = ChatRequest(messages=[], session_id="quota-room")
+    messages = [Message(role="user", content="質問")]
+
+    async def run() -> list[str]:
+        sent: list[str] = []
+
+        async def send_text(text: str) -> None:
+            sent.append(text)
+
+        encoder = FrameEncoder(send_text, 0)
+        await asyncio.wait_for(
+            app_module.stream_debate_session(encoder, request, messages), 5
+        )
+        await encoder.close()
+        return sent
+
+    frames = [json.loads(text) for text in asyncio.run(run())]
+    assert frames == [
+        {
+            "system": "quota",
+            "response": "トークンの使用量が上限に達しました",
+            "phase": "rejected",
+            "retry_after_ms": 1500,
+        }
+    ]
+
+
+def test_debate_modes_use_separate_caches(monkeypatch: pytest.MonkeyPatch) -> None:
+    """討論の方式やラウンド数が異なるリクエストは、別のセマンティックキャッシュを使う."""
+    monkeypatch.setattr(app_module.api_config, "semantic_cache_threshold", 0.9)
+    monkeypatch.setattr(app_module, "_semantic_caches", {})
+    messages = [{"role": "user", "content": "質問"}]
+    requests = [
+        ChatRequest(messages=messages, debate=True),
+        ChatRequest(messages=messages, debate=True, debate_rounds=2),
+        ChatRequest(messages=messages, debate=True, structured_verdicts=True),
+        ChatRequest(messages=messages, debate=True, async_debate=True),
+        ChatRequest(messages=messages, debate=True, cascade=True),
+    ]
+
+    caches = [
+        app_module.get_semantic_cache(app_module.get_debate_cache_name(request))
+        for request in requests
+    ]
+    assert len({id(cache) for cache in caches}) == len(requests)
+    same = ChatRequest(messages=messages, debate=True, debate_rounds=1)
+    assert (
+        app_module.get_semantic_cache(app_module.get_debate_cache_name(same))
+        is caches[0]
+    )
+
+
+def test_cascade_reservation_includes_direct_answer(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """カスケードモードでは、小さなモデルの回答の分も討論の前に確保する."""
+    reserved: list[int] = []
+    monkeypatch.setattr(app_module, "get_usage_quota", object)
+    monkeypatch.setattr(app_module, "reserve_tokens", reserved.append)
+    messages = [Message(role="user", content="質問")]
+    chat_messages = [{"role": "user", "content": "質問"}]
+
+    app_module.reserve_debate_tokens(
+        ChatRequest(messages=chat_messages, debate=True), messages
+    )
+    app_module.reserve_debate_tokens(
+        ChatRequest(messages=chat_messages, debate=True, cascade=True), messages
+    )
+    assert reserved[1] - reserved[0] > DIRECT_MAX_TOKENS
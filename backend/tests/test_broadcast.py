@@ -0,0 +1,90 @@
+"""討論セッションの配信のテスト."""
+
+import asyncio
+
+from nexus_magi.broadcast import DebateSession, SessionRegistry
+
+
+def create_frame(system: str, phase: str) -> dict[str, str]:
+    """配信する応答を作成する.
+
+    Args:
+        system: 応答を生成したシステム
+        phase: 応答のフェーズ
+
+    Returns:
+        dict[str, str]: 応答
+
+    """
+    return {"system": system, "response": f"{system}の{phase}", "phase": phase}
+
+
+async def collect(session: DebateSession) -> list[dict[str, str]]:
+    """セッションの終了まで配信された応答を集める.
+
+    Args:
+        session: 討論セッション
+
+    Returns:
+        list[dict[str, str]]: 配信された応答
+
+    """
+    return [frame async for frame in session.subscribe()]
+
+
+def test_frames_are_sent_to_every_subscriber() -> None:
+    """討論は1回だけ実行し、途中から購読したクライアントにも全ての応答を配信する."""
+    frames = [create_frame("melchior", "initial"), create_frame("consensus", "final")]
+    runs = 0
+
+    async def run() -> list[list[dict[str, str]]]:
+        registry = SessionRegistry()
+        session = registry.get_or_create("room")
+        release = asyncio.Event()
+
+        async def debate() -> None:
+            nonlocal runs
+            runs += 1
+            session.publish(frames[0])
+            await release.wait()
+            session.publish(frames[1])
+
+        early = asyncio.create_task(collect(session))
+        await asyncio.sleep(0)
+        session.start(debate)
+        await asyncio.sleep(0)
+        late = asyncio.create_task(collect(registry.get_or_create("room")))
+        await asyncio.sleep(0)
+        release.set()
+        received = list(await asyncio.gather(early, late))
+        # 終了後に購読したクライアントには、記録した応答を再送する
+        received.append(await collect(session))
+        return received
+
+    received = asyncio.run(run())
+    assert runs == 1
+    assert received == [frames, frames, frames]
+
+
+def test_failed_debate_sends_error_frame() -> None:
+    """討論が失敗した場合は、失敗を伝える応答を配信してセッションを終了する."""
+    initial = create_frame("melchior", "initial")
+
+    def error_frame(error: Exception) -> dict[str, str]:
+        return {"system": "consensus", "response": str(error), "phase": "final"}
+
+    async def run() -> list[dict[str, str]]:
+        session = DebateSession("room")
+
+        async def debate() -> None:
+            session.publish(initial)
+            msg = "討論の失敗"
+            raise RuntimeError(msg)
+
+        subscriber = asyncio.create_task(collect(session))
+        await asyncio.sleep(0)
+        session.start(debate, error_frame)
+        return await asyncio.wait_for(subscriber, 5)
+
+    received = asyncio.run(run())
+    assert received == [initial, error_frame(RuntimeError("討論の失敗"))]
@@ -0,0 +1,119 @@
+"""カスケードモードのチャットモデルのテスト."""
+
+import asyncio
+from collections.abc import AsyncGenerator, Sequence
+
+import pytest
+
+from nexus_magi.cascade_chat_model import (
+    DIRECT_MAX_TOKENS,
+    CascadeChatModel,
+    parse_confidence,
+)
+from nexus_magi.message_history import Message
+
+
+def create_chat_model(
+    monkeypatch: pytest.MonkeyPatch, direct_response: str
+) -> tuple[CascadeChatModel, list[int | None]]:
+    """小さなモデルの回答と討論を差し替えたチャットモデルを作成する.
+
+    Args:
+        monkeypatch: pytestのmonkeypatch
+        direct_response: 小さなモデルの回答
+
+    Returns:
+        tuple[CascadeChatModel, list[int | None]]: チャットモデルと、
+            小さなモデルの呼び出しごとの生成トークン数の上限
+
+    """
+    chat_model = CascadeChatModel()
+    max_tokens: list[int | None] = []
+
+    async def call(
+        _messages: Sequence[Message], limit: int | None = None, **_kwargs: object
+    ) -> str:
+        max_tokens.append(limit)
+        return direct_response
+
+    async def debate(
+        _messages: Sequence[Message], callback: object = None, **_kwargs: object
+    ) -> AsyncGenerator[dict[str, str], None]:
+        if callback:
+            await callback("consensus", "討論の結論", "final")
+        yield {"system": "consensus", "response": "討論の結論", "phase": "final"}
+
+    monkeypatch.setattr(chat_model.client, "call", call)
+    monkeypatch.setattr(chat_model.debate_model, "get_response_with_debate", debate)
+    return chat_model, max_tokens
+
+
+def run_cascade(chat_model: CascadeChatModel) -> list[dict[str, str]]:
+    """カスケードモードで応答を生成し、返された応答を集める.
+
+    Args:
+        chat_model: カスケードモードのチャットモデル
+
+    Returns:
+        list[dict[str, str]]: 返された応答
+
+    """
+
+    async def collect() -> list[dict[str, str]]:
+        return [
+            update
+            async for update in chat_model.get_response_with_cascade(
+                [Message(role="user", content="質問")]
+            )
+        ]
+
+    return asyncio.run(collect())
+
+
+def test_confident_answer_is_returned_directly(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """確信度が閾値以上の回答は、討論せずにそのまま返す."""
+    chat_model, max_tokens = create_chat_model(monkeypatch, "回答\n確信度: 90")
+
+    updates = run_cascade(chat_model)
+    assert updates == [
+        {"system": "consensus", "response": "回答", "phase": "final", "route": "direct"}
+    ]
+    assert max_tokens == [DIRECT_MAX_TOKENS]
+
+
+@pytest.mark.parametrize(
+    "direct_response",
+    ["回答\n確信度: 50", "確信度の無い回答", "エラーが発生しました: 503 - overloaded"],
+)
+def test_uncertain_answer_is_debated(
+    monkeypatch: pytest.MonkeyPatch, direct_response: str
+) -> None:
+    """確信度が閾値未満、記載が無い、または呼び出しが失敗した場合は討論する."""
+    chat_model, _ = create_chat_model(monkeypatch, direct_response)
+
+    updates = run_cascade(chat_model)
+    assert updates == [
+        {
+            "system": "consensus",
+            "response": "討論の結論",
+            "phase": "final",
+            "route": "debate",
+        }
+    ]
+
+
+def test_parse_confidence_reads_last_line() -> None:
+    """全角のコロンや強調の記号が付いた確信度も読み取り、回答から除く."""
+    assert parse_confidence("回答\n**確信度**：85%") == ("回答", 0.85)  # noqa: RUF001
+    assert parse_confidence("回答") == ("回答", None)
+
+
+def test_estimate_includes_direct_answer() -> None:
+    """使用量の見積もりには、討論に加えて小さなモデルの回答の上限を含める."""
+    chat_model = CascadeChatModel()
+    messages = [Message(role="user", content="質問")]
+
+    debate_tokens = chat_model.debate_model.estimate_tokens(messages, 1)
+    assert chat_model.estimate_tokens(messages, 1) > debate_tokens + DIRECT_MAX_TOKENS
@@ -0,0 +1,106 @@
+"""LLM APIの同時呼び出し数の制御のテスト."""
+
+import asyncio
+
+from nexus_magi.concurrency_limiter import AdaptiveConcurrencyLimiter
+
+
+async def hold(
+    limiter: AdaptiveConcurrencyLimiter,
+    acquired: asyncio.Event,
+    release: asyncio.Event,
+) -> None:
+    """枠を取得し、解放を指示されるまで保持する.
+
+    Args:
+        limiter: 同時呼び出し数の制御
+        acquired: 枠を取得したことを通知するイベント
+        release: 枠を解放するまで待つイベント
+
+    """
+    async with limiter.acquire():
+        acquired.set()
+        await release.wait()
+
+
+def test_growing_limit_wakes_waiter() -> None:
+    """上限が増えた場合は、枠の解放を待たずに待機中の呼び出しを再開する."""
+
+    async def run() -> tuple[int, int]:
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1)
+        release = asyncio.Event()
+        first, second = asyncio.Event(), asyncio.Event()
+        tasks = [
+            asyncio.create_task(hold(limiter, first, release)),
+            asyncio.create_task(hold(limiter, second, release)),
+        ]
+        await first.wait()
+        await asyncio.sleep(0)
+        assert not second.is_set()
+
+        # 計測値の記録はスレッドプールから行われる
+        await asyncio.to_thread(limiter.record_latency, 1.0, 100)
+        await asyncio.wait_for(second.wait(), 5)
+        stats = limiter.get_stats()
+        release.set()
+        await asyncio.gather(*tasks)
+        return stats.limit, stats.inflight
+
+    assert asyncio.run(run()) == (2, 2)
+
+
+def test_shrinking_limit_delays_waiter_until_release() -> None:
+    """上限が減った場合は、使用中の枠が上限を下回るまで待機中の呼び出しを再開しない."""
+
+    async def run() -> list[int]:
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=4)
+        holders = [(asyncio.Event(), asyncio.Event()) for _ in range(3)]
+        tasks = [
+            asyncio.create_task(hold(limiter, acquired, release))
+            for acquired, release in holders
+        ]
+        await asyncio.gather(*(acquired.wait() for acquired, _ in holders[:3]))
+
+        limiter.record_failure()
+        waiter_acquired, waiter_release = asyncio.Event(), asyncio.Event()
+        tasks.append(
+            asyncio.create_task(hold(limiter, waiter_acquired, waiter_release))
+        )
+        await asyncio.sleep(0)
+        waiting = [limiter.get_stats().waiting]
+
+        # 使用中の枠が上限の2を下回るのは、2つの枠を解放した後
+        holders[0][1].set()
+        await asyncio.sleep(0.01)
+        waiting.append(limiter.get_stats().waiting)
+        holders[1][1].set()
+        await asyncio.wait_for(waiter_acquired.wait(), 5)
+        waiting.append(limiter.get_stats().waiting)
+
+        holders[2][1].set()
+        waiter_release.set()
+        await asyncio.gather(*tasks)
+        return [limiter.limit, *waiting, limiter.get_stats().inflight]
+
+    assert asyncio.run(run()) == [2, 1, 1, 0, 0]
+
+
+def test_cancelled_waiter_does_not_keep_slot() -> None:
+    """取り消された待機中の呼び出しは、枠を保持し続けない."""
+
+    async def run() -> int:
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1)
+        acquired, release = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(hold(limiter, acquired, release))
+        await acquired.wait()
+        waiter = asyncio.create_task(hold(limiter, asyncio.Event(), asyncio.Event()))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        release.set()
+        await holder
+        await asyncio.gather(waiter, return_exceptions=True)
+
+        async with limiter.acquire():
+            return limiter.get_stats().inflight
+
+    assert asyncio.run(run()) == 1
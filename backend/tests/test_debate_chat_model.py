@@ -0,0 +1,256 @@
+"""討論モードのチャットモデルのテスト."""
+
+import asyncio
+from collections import Counter
+from collections.abc import Sequence
+
+import pytest
+
+from nexus_magi.debate_chat_model import DebateChatModel
+from nexus_magi.llm_client import is_error_response
+from nexus_magi.message_history import Message
+from nexus_magi.personas import Persona, PersonaConfig
+
+# 合議システムのシステムプロンプトの書き出し
+CONSENSUS_PROMPT_PREFIX = "あなたはMAGI合議システムです"
+
+
+class FakeBackend:
+    """呼び出し回数を数え、指定した回数だけ呼び出しを失敗させるLLM API."""
+
+    def __init__(self, consensus_failures: int = 0, persona_failures: int = 0) -> None:
+        """呼び出し回数を初期化.
+
+        Args:
+            consensus_failures: 失敗させる合議の呼び出し回数
+            persona_failures: 失敗させるペルソナの呼び出し回数
+
+        """
+        self.calls: Counter[str] = Counter()
+        self.consensus_failures = consensus_failures
+        self.persona_failures = persona_failures
+
+    async def call(
+        self,
+        messages: Sequence[Message],
+        _max_tokens: int | None = None,
+        *,
+        json_mode: bool = False,  # noqa: ARG002
+        speculative: bool = False,  # noqa: ARG002
+    ) -> str:
+        """システムプロンプトごとに呼び出し回数を数えて応答を返す.
+
+        Args:
+            messages: 送信するメッセージ
+            json_mode: 判定をJSONオブジェクトとして求めるかどうか
+            speculative: 先行生成の呼び出しかどうか
+
+        Returns:
+            str: 応答(失敗させる場合はエラーを表す応答)
+
+        """
+        # 同時に実行する討論の呼び出しが交互に進むようにする
+        await asyncio.sleep(0)
+        system_prompt = messages[0].content
+        if system_prompt.startswith(CONSENSUS_PROMPT_PREFIX):
+            self.calls["consensus"] += 1
+            if self.consensus_failures > 0:
+                self.consensus_failures -= 1
+                return "エラーが発生しました: 503 - overloaded"
+            return "合議の結論"
+        self.calls[system_prompt] += 1
+        if self.persona_failures > 0:
+            self.persona_failures -= 1
+            return "エラーが発生しました: 503 - overloaded"
+        return "見解"
+
+
+def run_debate(chat_model: DebateChatModel, question: str) -> list[dict[str, str]]:
+    """討論を実行し、返された応答を集める.
+
+    Args:
+        chat_model: 討論モードのチャットモデル
+        question: ユーザーの質問
+
+    Returns:
+        list[dict[str, str]]: 返された応答
+
+    """
+
+    async def collect() -> list[dict[str, str]]:
+        return [
+            update
+            async for update in chat_model.get_response_with_debate(
+                [Message(role="user", content=question)], debate_rounds=1
+            )
+        ]
+
+    return asyncio.run(collect())
+
+
+def run_async_debate(
+    chat_model: DebateChatModel, question: str
+) -> list[dict[str, str]]:
+    """非同期討論を実行し、返された応答を集める.
+
+    Args:
+        chat_model: 討論モードのチャットモデル
+        question: ユーザーの質問
+
+    Returns:
+        list[dict[str, str]]: 返された応答
+
+    """
+
+    async def collect() -> list[dict[str, str]]:
+        return [
+            update
+            async for update in chat_model.get_response_with_async_debate(
+                [Message(role="user", content=question)]
+            )
+        ]
+
+    return asyncio.run(collect())
+
+
+def create_chat_model(
+    monkeypatch: pytest.MonkeyPatch, backend: FakeBackend, owner: str | None = None
+) -> DebateChatModel:
+    """LLM APIの呼び出しを差し替えたチャットモデルを作成する.
+
+    Args:
+        monkeypatch: pytestのmonkeypatch
+        backend: 差し替えるLLM API
+        owner: 失敗した討論を再開できるクライアントの識別子
+
+    Returns:
+        DebateChatModel: 討論モードのチャットモデル
+
+    """
+    chat_model = DebateChatModel(checkpoint_owner=owner)
+    monkeypatch.setattr(chat_model.client, "call", backend.call)
+    return chat_model
+
+
+def test_failed_phase_is_retried(monkeypatch: pytest.MonkeyPatch) -> None:
+    """失敗したフェーズは保存されず、再試行時にそのフェーズから再開する."""
+    backend = FakeBackend(consensus_failures=1)
+    question = "失敗した合議を再試行できますか"
+
+    updates = run_debate(create_chat_model(monkeypatch, backend), question)
+    assert updates[-1]["system"] == "consensus"
+    assert is_error_response(updates[-1]["response"])
+    assert backend.calls["consensus"] == 1
+    persona_calls = backend.calls.copy()
+
+    updates = run_debate(create_chat_model(monkeypatch, backend), question)
+    assert "合議の結論" in updates[-1]["response"]
+    # 失敗した合議のみ再度呼び出し、完了済みの初期応答と討論は呼び出さない
+    assert backend.calls["consensus"] == 2  # noqa: PLR2004
+    del persona_calls["consensus"]
+    assert all(backend.calls[key] == count for key, count in persona_calls.items())
+    # 完了済みの応答も再送する
+    assert {update["phase"] for update in updates} == {"initial", "debate_1", "final"}
+
+
+def test_finished_debate_is_not_replayed(monkeypatch: pytest.MonkeyPatch) -> None:
+    """完了した討論のチェックポイントは破棄し、同じリクエストでも討論し直す."""
+    backend = FakeBackend()
+    question = "完了した討論は再利用されますか"
+
+    run_debate(create_chat_model(monkeypatch, backend), question)
+    first_calls = sum(backend.calls.values())
+    run_debate(create_chat_model(monkeypatch, backend), question)
+    assert sum(backend.calls.values()) == first_calls * 2
+
+
+def test_failed_debate_is_not_resumed_by_other_client(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """失敗した討論は、同じ質問をした他のクライアントには再開されない."""
+    backend = FakeBackend(consensus_failures=1)
+    question = "他のクライアントの討論は再開されますか"
+
+    run_debate(create_chat_model(monkeypatch, backend, "client-a"), question)
+    first_calls = sum(backend.calls.values())
+    updates = run_debate(create_chat_model(monkeypatch, backend, "client-b"), question)
+    assert "合議の結論" in updates[-1]["response"]
+    assert sum(backend.calls.values()) == first_calls * 2
+
+
+def test_concurrent_debates_do_not_share_thread(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """同時に実行する同じ討論は、互いのチェックポイントを読み書きしない."""
+    backend = FakeBackend()
+    question = "同時に同じ質問をするとどうなりますか"
+    run_debate(create_chat_model(monkeypatch, backend, "client-a"), question)
+    single_calls = sum(backend.calls.values())
+    backend.calls.clear()
+
+    async def collect() -> list[list[dict[str, str]]]:
+        async def debate() -> list[dict[str, str]]:
+            chat_model = create_chat_model(monkeypatch, backend, "client-a")
+            return [
+                update
+                async for update in chat_model.get_response_with_debate(
+                    [Message(role="user", content=question)], debate_rounds=1
+                )
+            ]
+
+        return await asyncio.gather(*(debate() for _ in range(4)))
+
+    results = asyncio.run(collect())
+    assert sum(backend.calls.values()) == single_calls * 4
+    for updates in results:
+        assert [update["phase"] for update in updates].count("final") == 1
+        assert "合議の結論" in updates[-1]["response"]
+
+
+def test_uneven_personas_consensus_tree(monkeypatch: pytest.MonkeyPatch) -> None:
+    """割り切れないペルソナ数でも、各グループの合議を見積もりどおりに呼び出す."""
+    personas = tuple(
+        Persona(id=f"p{index}", name=f"P{index}", role="役割", description="特徴")
+        for index in range(7)
+    )
+    backend = FakeBackend()
+    chat_model = DebateChatModel(
+        persona_config=PersonaConfig(personas=personas, consensus_group_size=3)
+    )
+    monkeypatch.setattr(chat_model.client, "call", backend.call)
+
+    updates = run_debate(chat_model, "7つのペルソナで合議できますか")
+    assert "合議の結論" in updates[-1]["response"]
+    # 3つのグループの合議と、その結果の合議
+    assert backend.calls["consensus"] == chat_model._count_consensus_calls() == 4  # noqa: PLR2004, SLF001
+
+
+def test_async_debate_stops_on_failed_persona(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """非同期討論でペルソナの呼び出しが失敗した場合は、合議せずに失敗を返す."""
+    backend = FakeBackend(persona_failures=1)
+
+    updates = run_async_debate(
+        create_chat_model(monkeypatch, backend), "失敗した見解は合議されますか"
+    )
+    assert [update["phase"] for update in updates].count("final") == 1
+    assert updates[-1]["system"] == "consensus"
+    assert is_error_response(updates[-1]["response"])
+    # 失敗した応答は見解として送信しない
+    assert not any(is_error_response(update["response"]) for update in updates[:-1])
+    assert backend.calls["consensus"] == 0
+
+
+def test_async_debate_reports_failed_consensus(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """非同期討論で合議の呼び出しが失敗した場合は、失敗を最終判断として返す."""
+    backend = FakeBackend(consensus_failures=1)
+
+    updates = run_async_debate(
+        create_chat_model(monkeypatch, backend), "失敗した合議は返されますか"
+    )
+    assert updates[-1]["system"] == "consensus"
+    assert updates[-1]["phase"] == "final"
+    assert is_error_response(updates[-1]["response"])
@@ -0,0 +1,91 @@
+"""WebSocketで送信する応答の送信処理のテスト."""
+
+import asyncio
+import json
+
+from nexus_magi.frame_encoder import MIN_REFERENCE_CHARS, FrameEncoder
+
+# 参照に置き換えられる長さの、最初に生成される部分
+FIRST_DELTA = "生成" * MIN_REFERENCE_CHARS
+
+
+def restore_responses(messages: list[str]) -> list[dict[str, str]]:
+    """フロントエンドと同じ方法で、送信された応答を復元する.
+
+    Args:
+        messages: 送信されたテキストメッセージ
+
+    Returns:
+        list[dict[str, str]]: 参照を復元した応答
+
+    """
+    latest: dict[str, str] = {}
+    restored = []
+    for message in messages:
+        data = json.loads(message)
+        for frame in data if isinstance(data, list) else [data]:
+            response = frame["response"]
+            if "segments" in frame:
+                response = "".join(
+                    segment.get("text") or latest.get(segment.get("ref", ""), "")
+                    for segment in frame["segments"]
+                )
+            latest[frame["system"]] = response
+            restored.append({**frame, "response": response})
+    return restored
+
+
+def stream(*, compact: bool) -> list[str]:
+    """生成途中の応答と完了した応答を送信し、送信されたメッセージを返す.
+
+    Args:
+        compact: 圧縮形式で送信するかどうか
+
+    Returns:
+        list[str]: 送信されたテキストメッセージ
+
+    """
+    messages: list[str] = []
+
+    async def send_text(text: str) -> None:
+        messages.append(text)
+
+    async def run() -> None:
+        encoder = FrameEncoder(send_text, flush_interval=0, compact=compact)
+        for delta in (FIRST_DELTA, "途中の", "応答"):
+            await encoder.send_delta("melchior", delta, "initial")
+        await encoder.send(
+            {
+                "system": "melchior",
+                "response": FIRST_DELTA + "途中の応答",
+                "phase": "initial",
+            }
+        )
+        await encoder.close()
+
+    asyncio.run(run())
+    return messages
+
+
+def test_compact_deltas_send_only_new_text() -> None:
+    """圧縮形式では、生成途中の応答を参照と新たに生成された部分として送信する."""
+    messages = stream(compact=True)
+    assert [frame["response"] for frame in restore_responses(messages)] == [
+        FIRST_DELTA,
+        FIRST_DELTA + "途中の",
+        FIRST_DELTA + "途中の応答",
+        FIRST_DELTA + "途中の応答",
+    ]
+    # 2回目以降の送信と完了した応答には、それまでに生成された部分を含めない
+    assert all(FIRST_DELTA not in message for message in messages[1:])
+
+
+def test_plain_deltas_send_whole_response() -> None:
+    """圧縮形式でない場合は、生成済みの応答全体を送信する."""
+    messages = stream(compact=False)
+    assert [json.loads(message)["response"] for message in messages] == [
+        FIRST_DELTA,
+        FIRST_DELTA + "途中の",
+        FIRST_DELTA + "途中の応答",
+        FIRST_DELTA + "途中の応答",
+    ]
@@ -0,0 +1,57 @@
+"""ペルソナ構成のテスト."""
+
+from pathlib import Path
+
+import pytest
+
+from nexus_magi.personas import (
+    Persona,
+    PersonaConfig,
+    load_persona_config,
+    split_into_groups,
+)
+
+# 設定例のファイル
+EXAMPLE_CONFIG_PATH = Path(__file__).parent.parent / "personas.example.yaml"
+
+
+@pytest.mark.parametrize(
+    ("count", "size", "expected"),
+    [
+        (3, 3, [3]),
+        (4, 3, [2, 2]),
+        (7, 3, [3, 2, 2]),
+        (10, 3, [3, 3, 2, 2]),
+        (3, 2, [3]),
+        (5, 2, [3, 2]),
+        (1, 3, [1]),
+    ],
+)
+def test_split_into_groups_balances_sizes(
+    count: int, size: int, expected: list[int]
+) -> None:
+    """割り切れない要素数でも、1つだけのグループを作らずに均等に分ける."""
+    groups = split_into_groups(list(range(count)), size)
+    assert [len(group) for group in groups] == expected
+    assert [item for group in groups for item in group] == list(range(count))
+
+
+def test_example_config_has_no_single_persona_group() -> None:
+    """設定例の7ペルソナは、全員が他のペルソナと同じグループで討論する."""
+    config = load_persona_config(EXAMPLE_CONFIG_PATH)
+    assert len(config.personas) == 7  # noqa: PLR2004
+    for persona in config.personas:
+        assert len(config.group_of(persona)) >= 2  # noqa: PLR2004
+
+
+def test_groups_keep_persona_order() -> None:
+    """グループはペルソナの定義順に作る."""
+    personas = tuple(
+        Persona(id=f"p{index}", name=f"P{index}", role="役割", description="特徴")
+        for index in range(5)
+    )
+    config = PersonaConfig(personas=personas, consensus_group_size=2)
+    assert [[persona.id for persona in group] for group in config.groups()] == [
+        ["p0", "p1", "p2"],
+        ["p3", "p4"],
+    ]
@@ -0,0 +1,133 @@
+"""プロンプトをまとめて送信する処理のテスト."""
+
+import asyncio
+from collections.abc import Hashable
+
+import pytest
+
+from nexus_magi import prompt_batcher
+from nexus_magi.llm_client import LLMClient
+from nexus_magi.message_history import Message
+from nexus_magi.prompt_batcher import BatchUnsupportedError, PromptBatcher
+
+
+class FakeSender:
+    """まとめて送信されたプロンプトを記録し、プロンプトに応じた結果を返す送信処理."""
+
+    def __init__(self, error: Exception | None = None) -> None:
+        """送信の記録を初期化.
+
+        Args:
+            error: 送信時に送出する例外(Noneの場合は結果を返す)
+
+        """
+        self.batches: list[tuple[Hashable, list[str]]] = []
+        self.error = error
+
+    async def send(self, key: Hashable, prompts: list[str]) -> list[str]:
+        """プロンプトのリストを送信する.
+
+        Args:
+            key: リクエストの設定を表すキー
+            prompts: 送信するプロンプト
+
+        Returns:
+            list[str]: プロンプトと同じ順序の結果
+
+        """
+        self.batches.append((key, prompts))
+        if self.error is not None:
+            raise self.error
+        return [f"{prompt}への応答" for prompt in prompts]
+
+
+def test_prompts_are_batched_by_key() -> None:
+    """同じキーのプロンプトは1回で送信し、結果をそれぞれの呼び出しに振り分ける."""
+    sender = FakeSender()
+
+    async def run() -> list[str]:
+        batcher = PromptBatcher(sender.send, window=0.01)
+        return list(
+            await asyncio.gather(
+                batcher.submit(100, "a"),
+                batcher.submit(100, "b"),
+                batcher.submit(None, "c"),
+            )
+        )
+
+    assert asyncio.run(run()) == ["aへの応答", "bへの応答", "cへの応答"]
+    assert sorted(sender.batches, key=str) == [(100, ["a", "b"]), (None, ["c"])]
+
+
+def test_full_batch_is_sent_without_waiting() -> None:
+    """上限の数のプロンプトが集まった場合は、間隔を待たずに送信する."""
+    sender = FakeSender()
+
+    async def run() -> list[str]:
+        batcher = PromptBatcher(sender.send, window=60, max_batch_size=2)
+        return list(
+            await asyncio.wait_for(
+                asyncio.gather(batcher.submit(None, "a"), batcher.submit(None, "b")),
+                5,
+            )
+        )
+
+    assert asyncio.run(run()) == ["aへの応答", "bへの応答"]
+
+
+def test_failed_batch_raises_in_every_call() -> None:
+    """まとめた送信が失敗した場合は、全ての呼び出しに例外を伝える."""
+    sender = FakeSender(BatchUnsupportedError("404 - not found"))
+
+    async def run() -> list[BaseException | str]:
+        batcher = PromptBatcher(sender.send, window=0.01)
+        return list(
+            await asyncio.gather(
+                batcher.submit(None, "a"),
+                batcher.submit(None, "b"),
+                return_exceptions=True,
+            )
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, BatchUnsupportedError) for result in results)
+    assert len(sender.batches) == 1
+
+
+def test_unsupported_backend_falls_back_to_single_requests(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """まとめたリクエストに対応していないバックエンドには、プロンプトごとに送信する."""
+    monkeypatch.setattr(prompt_batcher, "_batch_window", 0.01)
+    monkeypatch.setattr(prompt_batcher, "_batchers", {})
+    monkeypatch.setattr(prompt_batcher, "_capabilities", {})
+    client = LLMClient(
+        api_base="http://127.0.0.1:9/v1", model="batch-test", api_type="litellm"
+    )
+    batch_calls: list[list[str]] = []
+    single_calls: list[int | None] = []
+
+    def call_batch(prompts: list[str], _max_tokens: int | None) -> list:
+        batch_calls.append(prompts)
+        msg = "404 - not found"
+        raise BatchUnsupportedError(msg)
+
+    def call_single(
+        _messages: list[Message], max_tokens: int | None = None, **_kwargs: object
+    ) -> str:
+        single_calls.append(max_tokens)
+        return "個別の応答"
+
+    monkeypatch.setattr(client, "_call_completions_batch_api", call_batch)
+    monkeypatch.setattr(client, "_call_sync_api", call_single)
+
+    async def run() -> list[str]:
+        messages = [Message(role="user", content="質問")]
+        first = await client.call(messages, 100)
+        return [first, await client.call(messages, 100)]
+
+    assert asyncio.run(run()) == ["個別の応答", "個別の応答"]
+    # 対応していないことが分かった後は、まとめずに送信する
+    assert len(batch_calls) == 1
+    assert single_calls == [100, 100]
+    assert not client.capabilities.batch_prompts
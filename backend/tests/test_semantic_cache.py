@@ -0,0 +1,83 @@
+"""セマンティックキャッシュのテスト."""
+
+import asyncio
+
+from nexus_magi.semantic_cache import SemanticCache
+
+
+class FakeEmbedder:
+    """質問ごとに決めた埋め込みベクトルを返し、呼び出し回数を数えるLLMクライアント."""
+
+    def __init__(self, vectors: dict[str, list[float]]) -> None:
+        """埋め込みベクトルを初期化.
+
+        Args:
+            vectors: 正規化した質問ごとの埋め込みベクトル
+
+        """
+        self.vectors = vectors
+        self.calls = 0
+
+    async def embed(self, text: str) -> list[float]:
+        """質問の埋め込みベクトルを返す.
+
+        Args:
+            text: 正規化した質問
+
+        Returns:
+            list[float]: 埋め込みベクトル(未知の質問の場合は空のリスト)
+
+        """
+        self.calls += 1
+        return self.vectors.get(text, [])
+
+
+def test_similar_question_hits_and_other_question_misses() -> None:
+    """類似度が閾値以上の質問は応答を再利用し、閾値未満の質問は再利用しない."""
+    client = FakeEmbedder(
+        {
+            "magiとは何ですか": [1.0, 0.0],
+            "magiとはなんですか": [0.99, 0.1],
+            "天気はどうですか": [0.0, 1.0],
+        }
+    )
+    cache = SemanticCache(client, threshold=0.9)
+
+    async def run() -> list[str | None]:
+        await cache.store("MAGIとは何ですか", "合議の結論")
+        return [
+            await cache.lookup("MAGIとはなんですか"),
+            await cache.lookup("天気はどうですか"),
+        ]
+
+    assert asyncio.run(run()) == ["合議の結論", None]
+
+
+def test_normalized_question_hits_without_embedding() -> None:
+    """全角・大文字・空白だけが異なる質問は、埋め込みベクトルを取得せずに再利用する."""
+    client = FakeEmbedder({"magi とは": [1.0, 0.0]})
+    cache = SemanticCache(client)
+
+    async def run() -> str | None:
+        await cache.store("MAGI とは", "合議の結論")
+        return await cache.lookup("ＭＡＧＩ　　とは")  # noqa: RUF001
+
+    assert asyncio.run(run()) == "合議の結論"
+    assert client.calls == 1
+
+
+def test_least_recently_used_question_is_evicted() -> None:
+    """上限を超えた場合は、最も長く使われていない質問の応答を削除する."""
+    client = FakeEmbedder(
+        {"a": [1.0, 0.0, 0.0], "b": [0.0, 1.0, 0.0], "c": [0.0, 0.0, 1.0]}
+    )
+    cache = SemanticCache(client, capacity=2)
+
+    async def run() -> list[str | None]:
+        await cache.store("a", "Aの応答")
+        await cache.store("b", "Bの応答")
+        await cache.lookup("a")
+        await cache.store("c", "Cの応答")
+        return [await cache.lookup(question) for question in ("a", "b", "c")]
+
+    assert asyncio.run(run()) == ["Aの応答", None, "Cの応答"]
@@ -0,0 +1,82 @@
+"""入力途中の質問からの先行生成のテスト."""
+
+import asyncio
+
+import pytest
+
+from nexus_magi.message_history import Message
+from nexus_magi.speculation import Speculation
+
+
+def create_history(question: str) -> list[Message]:
+    """質問を最後のメッセージとした会話履歴を作成する.
+
+    Args:
+        question: 最後の質問
+
+    Returns:
+        list[Message]: 会話履歴
+
+    """
+    return [
+        Message(role="user", content="最初の質問"),
+        Message(role="assistant", content="最初の回答"),
+        Message(role="user", content=question),
+    ]
+
+
+@pytest.mark.parametrize(
+    ("question", "expected"),
+    [
+        ("MAGIシステムは何台のコンピュータで構成されていますか", True),
+        # 全角・半角の違いと前後の空白は無視する
+        ("ＭＡＧＩシステムは何台のコンピュータで構成されていますか ", True),
+        ("MAGIシステムは何台のコンピュータで構成されていますか?", True),
+        ("MAGIシステムは何台のコンピュータで構成されていますか、理由も教えて", False),
+        ("MAGIシステムの設計者は誰ですか", False),
+    ],
+)
+def test_matches_draft_with_short_addition(question: str, *, expected: bool) -> None:
+    """下書きと一致するか、短い語句を書き足しただけの質問にのみ再利用する."""
+    speculation = Speculation(
+        create_history("MAGIシステムは何台のコンピュータで構成されていますか")
+    )
+    assert speculation.matches(create_history(question)) is expected
+
+
+def test_different_history_does_not_match() -> None:
+    """それまでの会話履歴が異なる場合は、同じ質問でも再利用しない."""
+    speculation = Speculation(create_history("質問"))
+    messages = [Message(role="user", content="別の質問"), *create_history("質問")[1:]]
+    assert not speculation.matches(messages)
+
+
+def test_cancel_stops_untaken_generations() -> None:
+    """取り消した場合は、引き取られていない生成のみを取り消す."""
+
+    async def run() -> tuple[bool, bool, str, asyncio.Task[str] | None]:
+        release = asyncio.Event()
+
+        async def generate(response: str) -> str:
+            await release.wait()
+            return response
+
+        speculation = Speculation(create_history("質問"))
+        speculation.start("melchior", generate("先行した応答"))
+        speculation.start("balthasar", generate("使われない応答"))
+        taken = speculation.take("melchior")
+        assert taken is not None
+        pending = speculation._tasks["balthasar"]  # noqa: SLF001
+
+        speculation.cancel()
+        release.set()
+        response = await taken
+        await asyncio.gather(pending, return_exceptions=True)
+        return (
+            taken.cancelled(),
+            pending.cancelled(),
+            response,
+            speculation.take("balthasar"),
+        )
+
+    assert asyncio.run(run()) == (False, True, "先行した応答", None)
@@ -0,0 +1,119 @@
+"""会話の記録の保存処理のテスト."""
+
+import asyncio
+import sqlite3
+import time
+from pathlib import Path
+
+import pytest
+
+from nexus_magi import transcript_store
+from nexus_magi.message_history import Message
+from nexus_magi.transcript_store import TranscriptStore
+
+
+def test_failed_write_does_not_stop_writer(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """書き込みが失敗しても待っている処理は再開し、後続の記録は書き込まれる."""
+    store = TranscriptStore(tmp_path / "transcripts.db", flush_interval=0)
+    insert = store._insert  # noqa: SLF001
+    failures = [ValueError("書き込みの失敗")]
+
+    def fail_once(rows: list) -> None:
+        if failures:
+            raise failures.pop()
+        insert(rows)
+
+    monkeypatch.setattr(store, "_insert", fail_once)
+
+    async def run() -> list[Message]:
+        await store.start()
+        try:
+            store.append_messages("c1", [Message(role="user", content="失われる")])
+            await asyncio.wait_for(store.flush(), 5)
+            store.append_messages("c1", [Message(role="user", content="保存される")])
+            return await asyncio.wait_for(store.load_messages("c1"), 5)
+        finally:
+            await store.close()
+
+    messages = asyncio.run(run())
+    assert [message.content for message in messages] == ["保存される"]
+
+
+def test_failed_maintenance_does_not_stop_loop(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """記録の削除が失敗しても、定期的な削除は続ける."""
+    monkeypatch.setattr(transcript_store, "MAINTENANCE_INTERVAL", 0)
+    store = TranscriptStore(tmp_path / "transcripts.db")
+    compact = store._compact  # noqa: SLF001
+    calls: list[float] = []
+
+    def fail_once(now: float) -> None:
+        calls.append(now)
+        if len(calls) == 1:
+            msg = "削除の失敗"
+            raise ValueError(msg)
+        compact(now)
+
+    monkeypatch.setattr(store, "_compact", fail_once)
+
+    async def run() -> None:
+        await store.start()
+        try:
+            for _ in range(100):
+                if len(calls) >= 3:  # noqa: PLR2004
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await store.close()
+
+    asyncio.run(run())
+    assert len(calls) >= 3  # noqa: PLR2004
+
+
+def test_conversation_is_bound_to_first_owner(tmp_path: Path) -> None:
+    """会話は最初に記録した所有者に結び付き、他の所有者とは一致しない."""
+    store = TranscriptStore(tmp_path / "transcripts.db")
+
+    async def run() -> tuple[list[bool], str | None, str | None]:
+        await store.start()
+        try:
+            claims = [
+                await store.claim("c1", "owner-a"),
+                await store.claim("c1", "owner-b"),
+                await store.claim("c1", "owner-a"),
+            ]
+            return claims, await store.get_owner("c1"), await store.get_owner("c2")
+        finally:
+            await store.close()
+
+    claims, owner, missing = asyncio.run(run())
+    assert claims == [True, False, True]
+    assert owner == "owner-a"
+    assert missing is None
+
+
+def test_owner_column_is_added_to_old_database(tmp_path: Path) -> None:
+    """所有者の列が無いデータベースでは、既存の会話に最初に記録した所有者が所有する."""
+    path = tmp_path / "transcripts.db"
+    with sqlite3.connect(path) as connection:
+        connection.execute(
+            "CREATE TABLE conversations (id TEXT PRIMARY KEY, updated_at REAL NOT NULL)"
+        )
+        connection.execute("INSERT INTO conversations VALUES ('c1', ?)", (time.time(),))
+    connection.close()
+    store = TranscriptStore(path)
+
+    async def run() -> list[bool]:
+        await store.start()
+        try:
+            return [
+                await store.claim("c1", "owner-a"),
+                await store.claim("c1", "owner-b"),
+            ]
+        finally:
+            await store.close()
+
+    assert asyncio.run(run()) == [True, False]
@@ -0,0 +1,112 @@
+"""トークン使用量の制限のテスト."""
+
+import pytest
+
+from nexus_magi import usage_quota
+from nexus_magi.usage_quota import (
+    QuotaExceededError,
+    QuotaLimit,
+    QuotaScope,
+    SlidingWindowCounter,
+    UsageQuota,
+)
+
+
+class FakeClock:
+    """テストから進める現在時刻."""
+
+    def __init__(self, now: float = 0.0) -> None:
+        """現在時刻を初期化.
+
+        Args:
+            now: 現在時刻(UNIX時間)
+
+        """
+        self.now = now
+
+    def time(self) -> float:
+        """現在時刻を返す.
+
+        Returns:
+            float: 現在時刻(UNIX時間)
+
+        """
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    """使用量の制限が参照する現在時刻を差し替える.
+
+    Args:
+        monkeypatch: pytestのmonkeypatch
+
+    Returns:
+        FakeClock: 現在時刻
+
+    """
+    fake = FakeClock()
+    monkeypatch.setattr(usage_quota.time, "time", fake.time)
+    return fake
+
+
+def test_window_drops_old_buckets() -> None:
+    """期間を過ぎた区間の使用量は、区間ごとに順に集計から外れる."""
+    counter = SlidingWindowCounter(60, buckets=60)
+    counter.add(0.5, 10)
+    counter.add(30.2, 5)
+    assert counter.total(59.9) == 15  # noqa: PLR2004
+    assert counter.total(60.0) == 5  # noqa: PLR2004
+    assert counter.total(90.5) == 0
+
+
+def test_retry_after_waits_for_enough_tokens(clock: FakeClock) -> None:
+    """上限に達した場合は、必要な使用量が期間外になるまでの秒数を返す."""
+    quota = UsageQuota([QuotaLimit(60, 100)])
+    scope = QuotaScope(quota, "client")
+    quota.record(scope, 80)
+    clock.now = 10.0
+    quota.record(scope, 20)
+
+    clock.now = 20.0
+    with pytest.raises(QuotaExceededError) as error:
+        quota.check("client", 30)
+    # 最初の80トークンが期間外になれば30トークンを使用できる
+    assert error.value.retry_after == pytest.approx(40.0)
+
+    clock.now = 60.0
+    quota.check("client", 30)
+
+
+def test_reservation_is_released_after_request(clock: FakeClock) -> None:
+    """確保したトークン数は、使用した分を除いてリクエストの終了時に解放する."""
+    quota = UsageQuota([QuotaLimit(60, 100)])
+    with usage_quota.quota_scope(quota, "client"):
+        usage_quota.reserve_tokens(70)
+        with pytest.raises(QuotaExceededError):
+            quota.check("client", 40)
+        usage_quota.charge_usage(10, 20)
+
+    clock.now = 1.0
+    assert quota.get_usage("client") == [30]
+    # 使用されなかった40トークンは解放されている
+    quota.check("client", 70)
+
+
+def test_reservation_over_limit_is_rejected(clock: FakeClock) -> None:
+    """上限を超える見積もりは、使用量が減っても実行できないため期間の長さを返す."""
+    quota = UsageQuota([QuotaLimit(60, 100)])
+    clock.now = 5.0
+    with pytest.raises(QuotaExceededError) as error:
+        quota.reserve(QuotaScope(quota, "client"), 150)
+    assert error.value.retry_after == 60  # noqa: PLR2004
+
+
+def test_clients_are_limited_separately(clock: FakeClock) -> None:
+    """使用量はクライアントごとに集計する."""
+    quota = UsageQuota([QuotaLimit(60, 100)])
+    quota.record(QuotaScope(quota, "a"), 100)
+    clock.now = 1.0
+    with pytest.raises(QuotaExceededError):
+        quota.check("a")
+    quota.check("b", 100)
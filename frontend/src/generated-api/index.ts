@@ -8,6 +8,7 @@ export type { OpenAPIConfig } from './core/OpenAPI';
 
 export { ChatMessage } from './models/ChatMessage';
 export type { ChatRequest } from './models/ChatRequest';
+export type { FrameSegment } from './models/FrameSegment';
 export { WebSocketResponse } from './models/WebSocketResponse';
 
 export { XWebsocketService } from './services/XWebsocketService';
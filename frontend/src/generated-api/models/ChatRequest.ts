@@ -19,4 +19,44 @@ export type ChatRequest = {
    * 討論ラウンド数
    */
   debate_rounds?: number;
+  /**
+   * 非同期討論モード（ラウンド間で他システムを待たない）を使用するかどうか
+   */
+  async_debate?: boolean;
+  /**
+   * 応答までの制限時間（ミリ秒）。指定すると討論ラウンド数と生成長を自動で調整する
+   */
+  deadline_ms?: number;
+  /**
+   * カスケードモード（小さなモデルで回答できない質問だけ討論する）を使用するかどうか
+   */
+  cascade?: boolean;
+  /**
+   * 構造化モード（各システムの判定を多数決で集計し、票が割れた場合のみ合議を行う）を使用するかどうか
+   */
+  structured_verdicts?: boolean;
+  /**
+   * 共有する討論セッションの名前。同じ名前のリクエストは1つの討論の結果を購読する（メッセージが空の場合は購読のみ）
+   */
+  session_id?: string;
+  /**
+   * 下書きかどうか。討論モードで送信前の入力を送ると初期応答の生成を先行して開始し、応答は返さない
+   */
+  draft?: boolean;
+  /**
+   * 管理者用のトークン。サーバーの--profile-tokenと一致した場合、このリクエストの討論をプロファイルする
+   */
+  profile_token?: string;
+  /**
+   * 圧縮形式で応答を受け取るかどうか。続けて生成された応答を配列にまとめて送信し、送信済みの応答を含む応答はその応答への参照を含むsegmentsとして送信する
+   */
+  compact_frames?: boolean;
+  /**
+   * 会話ID。サーバーで会話の記録を保存している場合、保存された会話履歴の後にmessagesを続けて討論し、messagesと各システムの応答を記録する（messagesには新しいメッセージのみを含める）。討論モードでのみ指定できる。新しい会話IDの最初の応答でconversation_tokenを返し、以降のリクエストではそのトークンが必要となる
+   */
+  conversation_id?: string;
+  /**
+   * 会話IDの最初の応答で返されたトークン。会話を続ける場合に指定する
+   */
+  conversation_token?: string;
 };
@@ -0,0 +1,14 @@
+/* generated using openapi-typescript-codegen -- do not edit */
+/* istanbul ignore file */
+/* tslint:disable */
+/* eslint-disable */
+export type FrameSegment = {
+  /**
+   * そのまま連結する文字列
+   */
+  text?: string;
+  /**
+   * 参照先のシステム。このシステムが直前に送信したレスポンスの内容に置き換える
+   */
+  ref?: string;
+};
@@ -2,28 +2,43 @@
 /* istanbul ignore file */
 /* tslint:disable */
 /* eslint-disable */
+import type { FrameSegment } from './FrameSegment';
 export type WebSocketResponse = {
   /**
-   * レスポンスを生成するシステム（MAGI）
+   * レスポンスを生成するシステム（ペルソナのIDまたはconsensus）
    */
-  system: WebSocketResponse.system;
+  system: string;
   /**
    * レスポンスの内容
    */
   response: string;
   /**
-   * 現在のフェーズ
+   * 現在のフェーズ（トークン使用量の上限や会話IDの誤りによりリクエストを断った場合はrejected、新しい会話を開始した場合はcreated）
    */
   phase?: string;
+  /**
+   * カスケードモードで選択された経路（直接回答または討論）
+   */
+  route?: WebSocketResponse.route;
+  /**
+   * 圧縮形式で参照に置き換えた応答の内容。各要素の文字列と参照先の応答を順に連結するとレスポンスの内容になる（この場合responseは空）
+   */
+  segments?: Array<FrameSegment>;
+  /**
+   * トークン使用量の上限によりリクエストを断った場合（phaseがrejected）に、再び利用できるようになるまでのミリ秒数
+   */
+  retry_after_ms?: number;
+  /**
+   * 新しい会話IDを使用した場合に返す、その会話を続けるためのトークン（phaseがcreated）。GET /api/conversations/{conversation_id}ではX-Conversation-Tokenヘッダーに指定する
+   */
+  conversation_token?: string;
 };
 export namespace WebSocketResponse {
   /**
-   * レスポンスを生成するシステム（MAGI）
+   * カスケードモードで選択された経路（直接回答または討論）
    */
-  export enum system {
-    MELCHIOR = 'melchior',
-    BALTHASAR = 'balthasar',
-    CASPER = 'casper',
-    CONSENSUS = 'consensus',
+  export enum route {
+    DIRECT = 'direct',
+    DEBATE = 'debate',
   }
 }
@@ -11,6 +11,7 @@ export interface WebSocketOptions {
   onBalthasarResponse?: (response: string, phase?: string) => void;
   onCasperResponse?: (response: string, phase?: string) => void;
   onConsensusResponse?: (response: string, phase?: string) => void;
+  onPersonaResponse?: (system: string, response: string, phase?: string) => void;
   onError?: (error: Error) => void;
 }
 
@@ -39,12 +40,14 @@ export class MagiWebSocketClient {
       onBalthasarResponse,
       onCasperResponse,
       onConsensusResponse,
+      onPersonaResponse,
       onError,
     } = options;
 
     // WebSocketエンドポイントの決定
     const wsEndpoint = debate ? '/api/debate/ws' : '/api/chat/ws';
     const baseUrl = OpenAPI.BASE || 'http://localhost:8000';
+    // ブラウザはAPIキーを送信せず、サーバーが接続元のアドレスで識別する
     const wsUrl = `${baseUrl.replace('http', 'ws')}${wsEndpoint}`;
 
     // WebSocketの生成
@@ -60,6 +63,8 @@ export class MagiWebSocketClient {
         stream: true,
         debate,
         debate_rounds: debateRounds,
+        // 応答をまとめて受け取り、送信済みの応答は参照として受け取る
+        compact_frames: true,
       };
       console.log('送信データ:', requestData);
 
@@ -67,36 +72,67 @@ export class MagiWebSocketClient {
       socket.send(JSON.stringify(requestData));
     };
 
+    // システムごとの直前の応答（圧縮形式の参照を復元するために保持する）
+    const latestResponses: Record<string, string> = {};
+
+    // 1つの応答を処理するハンドラ
+    const handleResponse = (data: WebSocketResponse) => {
+      // 参照に置き換えられた部分を、参照先のシステムの直前の応答で復元する
+      const response = data.segments
+        ? data.segments
+            .map((segment) => segment.text ?? latestResponses[segment.ref ?? ''] ?? '')
+            .join('')
+        : data.response;
+      latestResponses[data.system] = response;
+      console.log('パースしたデータ:', { ...data, response });
+
+      // トークン使用量の上限などによりリクエストが断られた場合はエラーとして扱う
+      if (data.phase === 'rejected') {
+        console.warn('リクエストが断られました:', response, data.retry_after_ms);
+        if (onError) {
+          onError(new Error(response));
+        }
+        return;
+      }
+
+      // システムごとの応答を処理
+      if (data.system === 'melchior') {
+        console.log('MELCHIORの応答を処理:', response, data.phase);
+        if (onMelchiorResponse) {
+          onMelchiorResponse(response, data.phase);
+        }
+      } else if (data.system === 'balthasar') {
+        console.log('BALTHASARの応答を処理:', response, data.phase);
+        if (onBalthasarResponse) {
+          onBalthasarResponse(response, data.phase);
+        }
+      } else if (data.system === 'casper') {
+        console.log('CASPERの応答を処理:', response, data.phase);
+        if (onCasperResponse) {
+          onCasperResponse(response, data.phase);
+        }
+      } else if (data.system === 'consensus') {
+        console.log('最終合議結果を処理:', response, data.phase);
+        if (onConsensusResponse) {
+          onConsensusResponse(response, data.phase);
+        }
+      } else if (onPersonaResponse) {
+        // 設定ファイルで追加されたペルソナの応答
+        onPersonaResponse(data.system, response, data.phase);
+      } else {
+        console.warn('不明なシステムからの応答:', data);
+      }
+    };
+
     // メッセージ受信時のハンドラ
     socket.onmessage = (event: MessageEvent) => {
       try {
         console.log('WebSocketから受信したデータ:', event.data);
-        const data = JSON.parse(event.data) as WebSocketResponse;
-        console.log('パースしたデータ:', data);
-
-        // システムごとの応答を処理
-        if (data.system === 'melchior') {
-          console.log('MELCHIORの応答を処理:', data.response, data.phase);
-          if (onMelchiorResponse) {
-            onMelchiorResponse(data.response, data.phase);
-          }
-        } else if (data.system === 'balthasar') {
-          console.log('BALTHASARの応答を処理:', data.response, data.phase);
-          if (onBalthasarResponse) {
-            onBalthasarResponse(data.response, data.phase);
-          }
-        } else if (data.system === 'casper') {
-          console.log('CASPERの応答を処理:', data.response, data.phase);
-          if (onCasperResponse) {
-            onCasperResponse(data.response, data.phase);
-          }
-        } else if (data.system === 'consensus') {
-          console.log('最終合議結果を処理:', data.response, data.phase);
-          if (onConsensusResponse) {
-            onConsensusResponse(data.response, data.phase);
-          }
-        } else {
-          console.warn('不明なシステムからの応答:', data);
+        const data = JSON.parse(event.data) as WebSocketResponse | WebSocketResponse[];
+
+        // 圧縮形式では続けて生成された応答が配列にまとめられている
+        for (const frame of Array.isArray(data) ? data : [data]) {
+          handleResponse(frame);
         }
       } catch (error) {
         console.error('WebSocketメッセージの処理中にエラーが発生しました:', error);